@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+"""
+Structured timing and throughput metrics for the subsetting containers.
+
+Each stage of a job records its wall time, the bytes received and sent over
+the network (object storage traffic inside a pod), bytes explicitly read or
+written by the job, peak resident memory and the number of dask tasks that
+ran. Stages are echoed as JSON lines as they finish, and the whole job can be
+written to a file as JSON or Prometheus text so that Argo can collect it as
+an output parameter.
+
+This file is shared by the containers. The build script of each container
+copies it into the build context next to the entry script, when running a
+script outside of its image add containers/common to PYTHONPATH.
+
+Configuration is read from the environment by metrics_from_env:
+
+    METRICS_FILE      path to write the job metrics to when it finishes
+    METRICS_FORMAT    "json" (default) or "prometheus"
+"""
+
+import os
+import json
+import time
+import resource
+from pathlib import Path
+from contextlib import contextmanager
+
+METRICS_FORMATS = ["json", "prometheus"]
+
+# prefix of every prometheus metric name
+PROMETHEUS_PREFIX = "hydroshare_job"
+
+
+def network_bytes():
+    """
+    Returns the total bytes received and sent on every interface except
+    loopback. Dask workers talk to each other over loopback, so inside a pod
+    this is the traffic to and from object storage.
+    """
+    rx = tx = 0
+    try:
+        with open("/proc/net/dev", "r") as f:
+            for line in f.readlines()[2:]:
+                iface, data = line.split(":", 1)
+                if iface.strip() == "lo":
+                    continue
+                fields = data.split()
+                rx += int(fields[0])
+                tx += int(fields[8])
+    except OSError:
+        pass
+    return rx, tx
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory in bytes of this process and of its
+    finished child processes.
+    """
+    # ru_maxrss is reported in kilobytes on linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return own, children
+
+
+def path_size(path):
+    """
+    Returns the size in bytes of a file, or of every file below a directory.
+    """
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def _worker_stats(dask_worker):
+    """runs on each dask worker, see Metrics._dask_stats"""
+    return {
+        "tasks": dask_worker.state.executed_count,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+class Metrics:
+    """
+    Collects the metrics of a job, one record per stage.
+
+    Parameters
+    ----------
+    job: str
+        name of the job, e.g. the container name.
+    client: dask.distributed.Client
+        client whose workers are included in the task counts and memory.
+    path: str
+        file to write the job metrics to in finish.
+    fmt: str
+        "json" or "prometheus".
+    echo: bool
+        print every stage as a JSON line when it finishes.
+    """
+
+    def __init__(self, job, client=None, path=None, fmt="json", echo=True):
+        if fmt not in METRICS_FORMATS:
+            raise ValueError(f"metrics format must be one of {METRICS_FORMATS}")
+        self.job = job
+        self.client = client
+        self.path = path
+        self.fmt = fmt
+        self.echo = echo
+        self.stages = []
+        self.start = time.perf_counter()
+
+    def _dask_stats(self):
+        """
+        Returns the number of tasks executed so far and the peak memory of
+        the dask workers, or None if there is no client.
+        """
+        if self.client is None:
+            return None
+        try:
+            stats = self.client.run(_worker_stats).values()
+        except Exception:
+            return None
+        return {
+            "tasks": sum(s["tasks"] for s in stats),
+            "peak_rss": max((s["peak_rss"] for s in stats), default=0),
+        }
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measures a stage of the job. The yielded record can be updated with
+        counts that are only known to the caller, e.g.
+
+            with metrics.stage("saving") as rec:
+                ...
+                rec["bytes_written"] += path_size(output)
+        """
+        rec = {
+            "job": self.job,
+            "stage": name,
+            "bytes_read": 0,
+            "bytes_written": 0,
+        }
+        rx, tx = network_bytes()
+        dask_before = self._dask_stats()
+        start = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            rec["wall_seconds"] = round(time.perf_counter() - start, 6)
+            rx_after, tx_after = network_bytes()
+            rec["net_rx_bytes"] = rx_after - rx
+            rec["net_tx_bytes"] = tx_after - tx
+            rec["peak_rss_bytes"], rec["peak_child_rss_bytes"] = peak_rss()
+            dask_after = self._dask_stats()
+            if dask_before is not None and dask_after is not None:
+                rec["dask_tasks"] = dask_after["tasks"] - dask_before["tasks"]
+                rec["worker_peak_rss_bytes"] = dask_after["peak_rss"]
+            self.stages.append(rec)
+            if self.echo:
+                print(json.dumps(rec), flush=True)
+
+    def summary(self):
+        """
+        Returns the totals of the job across its stages.
+        """
+        total = {
+            "job": self.job,
+            "stage": "total",
+            "wall_seconds": round(time.perf_counter() - self.start, 6),
+        }
+        for key in ("bytes_read", "bytes_written", "net_rx_bytes",
+                    "net_tx_bytes", "dask_tasks"):
+            total[key] = sum(s.get(key, 0) for s in self.stages)
+        for key in ("peak_rss_bytes", "peak_child_rss_bytes",
+                    "worker_peak_rss_bytes"):
+            total[key] = max((s.get(key, 0) for s in self.stages), default=0)
+        return total
+
+    def to_json(self):
+        """
+        Returns the job metrics as a JSON document.
+        """
+        return json.dumps({"stages": self.stages, "total": self.summary()})
+
+    def to_prometheus(self):
+        """
+        Returns the job metrics in the Prometheus text exposition format,
+        with one sample per stage and metric.
+        """
+        records = self.stages + [self.summary()]
+        keys = []
+        for rec in records:
+            for key, value in rec.items():
+                if isinstance(value, (int, float)) and key not in keys:
+                    keys.append(key)
+
+        lines = []
+        for key in keys:
+            name = f"{PROMETHEUS_PREFIX}_{key}"
+            lines.append(f"# TYPE {name} gauge")
+            for rec in records:
+                if key not in rec:
+                    continue
+                stage = rec["stage"].replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(
+                    f'{name}{{job="{self.job}",stage="{stage}"}} {rec[key]}'
+                )
+        return "\n".join(lines) + "\n"
+
+    def finish(self):
+        """
+        Writes the job metrics to the metrics file, if one was given.
+        """
+        if self.path is None:
+            return
+        text = self.to_json() if self.fmt == "json" else self.to_prometheus()
+        path = Path(self.path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_text(text)
+        tmp.replace(path)
+
+
+def metrics_from_env(job, client=None, echo=True):
+    """
+    Returns a Metrics configured by the METRICS_FILE and METRICS_FORMAT
+    environment variables.
+    """
+    return Metrics(
+        job,
+        client=client,
+        path=os.environ.get("METRICS_FILE") or None,
+        fmt=os.environ.get("METRICS_FORMAT", "json"),
+        echo=echo,
+    )
+
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark of the AORC collection pipeline.
+
+A synthetic AORC dataset on the full NWM grid is generated and served from
+a local s3 stand-in, so the numbers don't depend on the network or on the
+public bucket. By default a moto server is started in this process, which
+requires moto[server]. Pass --endpoint to use a running MinIO or other s3
+compatible server instead.
+
+Hourly LDASIN files are written as NetCDF4 with their kerchunk headers laid
+out like the retrospective bucket. Every combination of date range,
+watershed size, timesteps per group and worker count then runs in a fresh
+process, so peak memory is measured per case. Each case times the combining
+of the headers, load_zarr, add_spatial_metadata, clip_aorc_by_shapefile and
+the saving of the groups on a local dask cluster.
+
+    python benchmark.py --hours 6 --hours 24 --workers 1 --workers 4
+"""
+
+import os
+import json
+import time
+import queue
+import socket
+import logging
+import tempfile
+import itertools
+import multiprocessing
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional
+
+import numpy
+import ujson
+import pandas
+import xarray
+import geopandas
+from s3fs import S3FileSystem
+from shapely import affinity
+from kerchunk.hdf import SingleHdf5ToZarr
+from typer import run, Option
+from typing_extensions import Annotated
+
+from grid import wrf_proj
+from manifest import ENDPOINT_VARIABLE
+
+# first timestep of the synthetic dataset
+START = datetime(2010, 1, 1)
+
+# variables of the LDASIN_DOMAIN1 forcing files
+VARIABLES = ["LWDOWN", "PSFC", "Q2D", "RAINRATE", "SWDOWN", "T2D", "U2D", "V2D"]
+
+# the NWM 1 km grid
+GRID_X = -2303999.25 + 1000.0 * numpy.arange(4608)
+GRID_Y = -1919999.375 + 1000.0 * numpy.arange(3840)
+
+WATERSHED = str(Path(__file__).parent / "map-reduce-testing" / "watershed.shp")
+
+
+def main(
+    hours: Annotated[
+        List[int],
+        Option(help="Number of hourly timesteps to collect, repeat to run several")
+    ] = [6, 24],
+    watershed_scale: Annotated[
+        List[float],
+        Option(help="Factor to scale the width and height of the watershed by, "
+                    "repeat to run several")
+    ] = [1.0],
+    timesteps_per_group: Annotated[
+        List[int],
+        Option(help="Number of timesteps per group, repeat to run several")
+    ] = [3, 10],
+    workers: Annotated[
+        List[int],
+        Option(help="Number of dask workers, repeat to run several")
+    ] = [1, 2],
+    worker_mem_limit: Annotated[
+        str,
+        Option(help="Memory limit of each dask worker")
+    ] = "3GB",
+    writer: Annotated[
+        str,
+        Option(help="Writer used to save the groups: stream or batch")
+    ] = "batch",
+    shapefile: Annotated[
+        str,
+        Option(help="Watershed to clip the dataset to")
+    ] = WATERSHED,
+    chunk_size: Annotated[
+        int,
+        Option(help="Size of the square HDF5 chunks in the synthetic files")
+    ] = 768,
+    endpoint: Annotated[
+        Optional[str],
+        Option(help="Endpoint of a running s3 compatible server to use "
+                    "instead of starting moto")
+    ] = None,
+    key: Annotated[
+        str,
+        Option(help="Access key used to upload the synthetic dataset")
+    ] = "benchmark",
+    secret: Annotated[
+        str,
+        Option(help="Secret key used to upload the synthetic dataset")
+    ] = "benchmark",
+    bucket: Annotated[
+        str,
+        Option(help="Bucket to upload the synthetic dataset to")
+    ] = "aorc-benchmark",
+    cache_dir: Annotated[
+        Optional[str],
+        Option(help="Cache directory shared by every case. By default each "
+                    "case starts with an empty cache")
+    ] = None,
+    output: Annotated[
+        str,
+        Option(help="File to append the results to as JSON lines")
+    ] = "benchmark-results.jsonl",
+    verbose: Annotated[
+        bool,
+        Option("--verbose", help="Turn on verbose text output")
+    ] = False,
+):
+
+    # set verbosity level
+    if verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    server = None
+    if endpoint is None:
+        server, endpoint = start_moto()
+
+    # the pipeline, and every process it starts, reads from this endpoint
+    os.environ[ENDPOINT_VARIABLE] = endpoint
+
+    try:
+        workdir = Path(tempfile.mkdtemp(prefix="aorc-benchmark-"))
+        s3 = S3FileSystem(key=key, secret=secret,
+                          client_kwargs={"endpoint_url": endpoint})
+        s3bucket = generate_dataset(s3, bucket, max(hours), workdir, chunk_size)
+        spatial_source = str(workdir / "template.nc")
+        write_template(spatial_source)
+
+        cases = itertools.product(hours, watershed_scale, timesteps_per_group, workers)
+        for n_hours, scale, group_size, n_workers in cases:
+            casedir = workdir / f"{n_hours}h-{scale}x-{group_size}g-{n_workers}w"
+            casedir.mkdir()
+            case = dict(
+                start_date=START,
+                end_date=START + timedelta(hours=n_hours - 1),
+                hours=n_hours,
+                shapefile=scale_watershed(shapefile, scale, casedir),
+                watershed_scale=scale,
+                timesteps_per_group=group_size,
+                workers=n_workers,
+                worker_mem_limit=worker_mem_limit,
+                writer=writer,
+                s3bucket=s3bucket,
+                spatial_source=spatial_source,
+                cache_dir=cache_dir or str(casedir / "cache"),
+                outdir=str(casedir / "output"),
+            )
+            logging.info(f"Running case {casedir.name}")
+            result = run_isolated(case)
+            report(result)
+            with open(output, "a") as f:
+                f.write(json.dumps(result, default=str) + "\n")
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def start_moto():
+    """
+    Starts a moto s3 server on a free local port and returns it with its
+    endpoint.
+    """
+    from moto.server import ThreadedMotoServer
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    return server, f"http://127.0.0.1:{port}"
+
+
+def write_template(path: str) -> None:
+    """
+    Writes the spatial metadata template of the NWM grid, the synthetic
+    counterpart of WRF_Hydro_NWM_geospatial_data_template_land_GIS.nc.
+    """
+    crs = xarray.DataArray(0, attrs={"spatial_ref": wrf_proj().crs.to_wkt()})
+    xarray.Dataset({"crs": crs}, coords={"x": GRID_X, "y": GRID_Y}).to_netcdf(path)
+
+
+def synthetic_hour(ts: datetime) -> xarray.Dataset:
+    """
+    Returns an hour of synthetic forcing. The fields are smooth so that
+    they compress about as well as the real data.
+    """
+    hour = (ts - START).total_seconds() / 3600
+    cols = numpy.linspace(0, 8 * numpy.pi, len(GRID_X), dtype="float32")
+    rows = numpy.linspace(0, 6 * numpy.pi, len(GRID_Y), dtype="float32")
+    field = numpy.sin(cols + hour / 24)[None, :] * numpy.cos(rows)[:, None]
+
+    data_vars = {
+        name: (
+            ("valid_time", "Time", "south_north", "west_east"),
+            (field * (i + 1) + i)[None, None].astype("float32"),
+        )
+        for i, name in enumerate(VARIABLES)
+    }
+    # kerchunk uses 0 as the fill value of the time coordinate, so time is
+    # counted from an epoch well before the data
+    minutes = int((ts - datetime(1970, 1, 1)).total_seconds() // 60)
+    ds = xarray.Dataset(data_vars, coords={"valid_time": [minutes]})
+    ds.valid_time.attrs["units"] = "minutes since 1970-01-01 00:00:00"
+    return ds
+
+
+def generate_dataset(
+    s3: S3FileSystem, bucket: str, hours: int, workdir: Path, chunk_size: int
+) -> str:
+    """
+    Uploads hourly LDASIN files and their kerchunk headers to the bucket,
+    with the headers laid out like the retrospective bucket.
+
+    Returns
+    -------
+    str
+        url of the forcing prefix, to use as the s3 bucket of the pipeline.
+    """
+    if not s3.exists(bucket):
+        s3.mkdir(bucket)
+
+    local = workdir / "hour.nc"
+    for ts in pandas.date_range(START, periods=hours, freq="H"):
+        name = f"{ts:%Y%m%d%H}.LDASIN_DOMAIN1"
+        header = f"{bucket}/forcing/{ts.year}/{ts:%Y%m%d%H}.LDASIN_DOMAIN1.json"
+        if s3.exists(header):
+            continue
+
+        logging.info(f"Generating {name}")
+        ds = synthetic_hour(ts.to_pydatetime())
+        chunks = (1, 1, chunk_size, chunk_size)
+        encoding = {v: {"zlib": True, "chunksizes": chunks} for v in VARIABLES}
+        ds.to_netcdf(local, encoding=encoding)
+
+        url = f"s3://{bucket}/data/{name}"
+        s3.put(str(local), url)
+        with open(local, "rb") as f:
+            refs = SingleHdf5ToZarr(f, url=url).translate()
+        s3.pipe(header, ujson.dumps(refs).encode("utf-8"))
+
+    local.unlink(missing_ok=True)
+    return f"s3://{bucket}/forcing/"
+
+
+def scale_watershed(shapefile: str, scale: float, casedir: Path) -> str:
+    """
+    Returns a shapefile with the geometries scaled about their centroid to
+    benchmark larger watersheds.
+    """
+    if scale == 1.0:
+        return shapefile
+    gdf = geopandas.read_file(shapefile)
+    origin = gdf.unary_union.centroid
+    gdf.geometry = gdf.geometry.apply(
+        lambda g: affinity.scale(g, xfact=scale, yfact=scale, origin=origin)
+    )
+    path = casedir / "watershed.shp"
+    gdf.to_file(path)
+    return str(path)
+
+
+def run_isolated(case: dict) -> dict:
+    """
+    Runs a case in a new process so that its peak memory is not affected by
+    the cases before it.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(case, results))
+    proc.start()
+    try:
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                if not proc.is_alive():
+                    return dict(case, error=f"exited with code {proc.exitcode}")
+    finally:
+        proc.join()
+
+
+def _run_case(case: dict, results: multiprocessing.Queue) -> None:
+    try:
+        results.put(run_case(case))
+    except Exception as e:
+        logging.exception("Case failed")
+        results.put(dict(case, error=repr(e)))
+
+
+def run_case(case: dict) -> dict:
+    """
+    Runs the pipeline stages for a single case and returns their metrics.
+    """
+    from dask.distributed import Client
+
+    from entry import (
+        add_spatial_metadata,
+        clip_aorc_by_shapefile,
+        load_zarr,
+        watershed_window,
+    )
+    from instrumentation import Metrics, path_size
+    from ledger import pending_groups
+    from manifest import find_headers
+    from references import combine_headers, write_reference
+    from tasks import run_groups
+
+    cache_dir = Path(case["cache_dir"])
+    outpath = Path(case["outdir"])
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    outpath.mkdir(parents=True, exist_ok=True)
+
+    client = Client(
+        n_workers=case["workers"],
+        threads_per_worker=1,
+        memory_limit=case["worker_mem_limit"],
+    )
+    metrics = Metrics("aorc-benchmark", client=client, echo=False)
+    start, end = case["start_date"], case["end_date"]
+
+    try:
+        with metrics.stage("combine_headers"):
+            headers = find_headers(start, end, case["s3bucket"], cache_dir)
+            reference = outpath.parent / "reference.json"
+            write_reference(combine_headers(headers), reference, "json")
+
+        with metrics.stage("load_zarr"):
+            ds = load_zarr(start, end, case["s3bucket"], cache_dir,
+                           reference=str(reference))
+
+        with metrics.stage("add_spatial_metadata"):
+            window = watershed_window(case["shapefile"], case["spatial_source"],
+                                      cache_dir)
+            ds = add_spatial_metadata(ds.isel(window), case["spatial_source"],
+                                      cache_dir, window=window)
+
+        with metrics.stage("clip_aorc_by_shapefile"):
+            ds = clip_aorc_by_shapefile(ds, case["shapefile"], cache_dir)
+
+        # the same description of the dataset that entry.main sends to the
+        # workers
+        spec = dict(
+            start_date=start,
+            end_date=end,
+            shapefile=case["shapefile"],
+            s3bucket=case["s3bucket"],
+            cache_dir=str(cache_dir),
+            spatial_source=case["spatial_source"],
+            reference=str(reference),
+            worker_mem_limit=case["worker_mem_limit"],
+            timesteps_per_group=case["timesteps_per_group"],
+        )
+        groups = pending_groups(pandas.DatetimeIndex(ds.time.values), set(),
+                                case["timesteps_per_group"])
+        with metrics.stage(f"{case['writer']}_save") as rec:
+            results = run_groups(client, spec, groups, outpath,
+                                 writer=case["writer"])
+            rec["bytes_written"] = path_size(outpath)
+        failed = sum(1 for _, _, success in results if not success)
+    finally:
+        client.close()
+
+    return dict(
+        case,
+        cells=int(ds.sizes["y"] * ds.sizes["x"]),
+        data_bytes=int(ds.nbytes),
+        failed_groups=failed,
+        stages=metrics.stages,
+        total=metrics.summary(),
+    )
+
+
+def report(result: dict) -> None:
+    """
+    Prints a one line summary of a case.
+    """
+    name = (f"{result['hours']}h {result['watershed_scale']}x "
+            f"{result['timesteps_per_group']}/group {result['workers']} worker(s)")
+    if "error" in result:
+        print(f"{name}: failed, {result['error']}")
+        return
+
+    stages = ", ".join(f"{s['stage']} {s['wall_seconds']:.2f}s"
+                       for s in result["stages"])
+    save = result["stages"][-1]
+    throughput = save["bytes_written"] / max(save["wall_seconds"], 1e-9) / 1e6
+    peak = max(result["total"]["peak_rss_bytes"],
+               result["total"]["worker_peak_rss_bytes"]) / 1e6
+    print(f"{name}: {stages}; {throughput:.1f} MB/s written, "
+          f"{peak:.0f} MB peak rss")
+
+
+if __name__ == "__main__":
+    st = time.time()
+    run(main)
+    logging.info(f'Elapsed time: {time.time() - st} seconds')
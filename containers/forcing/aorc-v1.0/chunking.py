@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""
+Chunk planning for the clipped AORC dataset.
+
+Rechunking to one timestep per chunk keeps memory low but, for long date
+ranges, creates tens of thousands of tiny dask tasks. The plan computed here
+sizes chunks in bytes instead: as many timesteps as fit in a fraction of the
+worker memory, aligned to the native chunking of the source data.
+"""
+
+import math
+import logging
+from enum import Enum
+
+import xarray
+from dask.utils import format_bytes, parse_bytes
+
+
+class ChunkingMode(str, Enum):
+    """choices of the --chunking option of the entry script"""
+
+    time = "time"
+    adaptive = "adaptive"
+
+
+# fraction of the worker memory limit that a single chunk of every variable
+# may occupy. Workers hold several chunks at once while reading, combining
+# and writing, so this is deliberately conservative.
+MEMORY_FRACTION = 0.1
+
+# upper bound on chunk size regardless of the worker memory limit
+MAX_CHUNK_BYTES = parse_bytes("256MB")
+
+
+def native_chunks(ds: xarray.Dataset) -> dict:
+    """
+    Returns the largest chunk size of each dimension across the data
+    variables. For a dataset opened with chunks={} this is the chunking of
+    the source store, clipped to the extent of the dataset.
+    """
+    chunks = {}
+    for var in ds.data_vars.values():
+        for dim, sizes in var.chunksizes.items():
+            chunks[dim] = max(chunks.get(dim, 1), max(sizes))
+    return chunks
+
+
+def plan_chunks(
+    ds: xarray.Dataset, worker_mem_limit: str, max_time: int = None
+) -> dict:
+    """
+    Chooses time and space chunk sizes for a dataset from its size, the
+    worker memory limit and the native chunk layout of the source data.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset
+        dataset to plan chunks for, usually already clipped to a watershed.
+    worker_mem_limit: str
+        memory limit of each dask worker, e.g. 3GB.
+    max_time: int
+        maximum number of timesteps per chunk, e.g. the number of timesteps
+        that each worker processes at a time.
+
+    Returns
+    -------
+    dict
+        chunk sizes that can be passed to Dataset.chunk.
+    """
+    budget = min(parse_bytes(worker_mem_limit) * MEMORY_FRACTION, MAX_CHUNK_BYTES)
+    native = native_chunks(ds)
+
+    # bytes needed to hold a single timestep of every variable
+    step_bytes = sum(
+        var.dtype.itemsize * math.prod(var.sizes[d] for d in var.dims if d != "time")
+        for var in ds.data_vars.values()
+        if "time" in var.dims
+    )
+
+    chunks = {"time": 1, "y": -1, "x": -1}
+    if step_bytes > budget:
+        # a single timestep doesn't fit, split the rows instead
+        rows = max(int(budget // (step_bytes / ds.sizes["y"])), 1)
+        if "y" in native and rows > native["y"]:
+            rows -= rows % native["y"]
+        chunks["y"] = rows
+    else:
+        steps = max(int(budget // max(step_bytes, 1)), 1)
+        if max_time is not None:
+            steps = min(steps, max_time)
+        # read whole source chunks so they aren't fetched more than once
+        nt = native.get("time", 1)
+        if steps > nt:
+            steps -= steps % nt
+        chunks["time"] = min(steps, ds.sizes["time"])
+
+    n_chunks = math.ceil(ds.sizes["time"] / chunks["time"])
+    if chunks["y"] != -1:
+        n_chunks *= math.ceil(ds.sizes["y"] / chunks["y"])
+    logging.info(
+        f"Chunk plan: {chunks}, {format_bytes(step_bytes)} per timestep, "
+        f"{format_bytes(budget)} budget, {n_chunks} chunks per variable "
+        f"(native chunks {native})"
+    )
+    return chunks
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+Consolidated output for the AORC forcing.
+
+Instead of one NetCDF file per hour, the clipped forcing can be written to a
+single chunked and compressed Zarr store, or merged from that store into a
+single NetCDF file with an unlimited time dimension. The spatial metadata is
+stored once and shared by every timestep. Hourly LDASIN files for WRF-Hydro
+can be produced from either output later with export.py.
+"""
+
+import logging
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import Tuple
+
+import numpy
+import zarr
+import xarray
+from numcodecs import Blosc
+
+from ledger import hourly_filename, record_store
+
+class OutputFormat(str, Enum):
+    """choices of the --output-format option of the entry script"""
+
+    hourly = "hourly"
+    zarr = "zarr"
+    netcdf = "netcdf"
+
+
+def store_time_chunk(store: Path) -> int:
+    """
+    Returns the time chunk size of the data variables of an existing store.
+    """
+    group = zarr.open_group(str(store), mode="r")
+    for name, array in group.arrays():
+        dims = array.attrs.get("_ARRAY_DIMENSIONS", [])
+        if name != "time" and "time" in dims:
+            return array.chunks[dims.index("time")]
+    raise ValueError(f"{store} has no data variables along time")
+
+
+def store_times(store: Path) -> numpy.ndarray:
+    """
+    Returns the time coordinate of a store, which groups are positioned
+    against when they are written.
+    """
+    with xarray.open_zarr(store, consolidated=False) as existing:
+        return existing.time.values
+
+
+def store_offset(ds: xarray.Dataset, store: Path) -> int:
+    """
+    Returns the position of the first timestep of ds in an existing store,
+    checking that every timestep and the x and y coordinates of ds are in
+    the store, so that resuming never writes data to the wrong place.
+    """
+    with xarray.open_zarr(store, consolidated=False) as existing:
+        for dim in ("x", "y"):
+            if not numpy.array_equal(existing[dim].values, ds[dim].values):
+                raise ValueError(
+                    f"The {dim} coordinates of {store} do not match the requested "
+                    "watershed, remove the store or use another output directory"
+                )
+        times = existing.time.values
+    offset = int(numpy.searchsorted(times, ds.time.values[0]))
+    if not numpy.array_equal(times[offset : offset + ds.sizes["time"]], ds.time.values):
+        raise ValueError(
+            f"{store} covers {times[0]} - {times[-1]}, which does not contain the "
+            f"requested {ds.time.values[0]} - {ds.time.values[-1]}, remove the "
+            "store or use another output directory"
+        )
+    return offset
+
+
+def init_store(
+    ds: xarray.Dataset, store: Path, timesteps_per_group: int, compression_level: int
+) -> Tuple[int, int]:
+    """
+    Creates a Zarr store with the layout of a dataset, writing only the
+    metadata and the coordinates. Data is written later, one group of
+    timesteps at a time, by zarr_save. An existing store is left untouched
+    so that interrupted jobs can resume writing into it, as long as it
+    holds every timestep and cell of ds.
+
+    Groups must line up with the time chunks of the store, otherwise
+    concurrent groups write to the same chunk. A resumed store keeps the
+    chunking it was created with, so its time chunk size is returned and
+    must be used as the group size instead of timesteps_per_group, along
+    with the position of ds in the store that groups are aligned to.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset
+        the clipped dataset that will be written to the store.
+    store: pathlib.Path
+        location of the Zarr store.
+    timesteps_per_group: int
+        number of timesteps in each group, used as the time chunk size so
+        that groups never write to the same chunk.
+    compression_level: int
+        zstd compression level of the data variables.
+
+    Returns
+    -------
+    Tuple[int, int]
+        number of timesteps in each group written to the store, and the
+        position of the first timestep of ds in the store.
+    """
+    if store.exists():
+        chunk = store_time_chunk(store)
+        offset = store_offset(ds, store)
+        logging.info(f"Resuming writes into {store}")
+        if chunk != timesteps_per_group:
+            logging.warning(
+                f"{store} was created with {chunk} timesteps per chunk, "
+                f"writing groups of {chunk} instead of {timesteps_per_group}"
+            )
+        return chunk, offset
+
+    logging.info(f"Initializing {store}")
+    compressor = Blosc(cname="zstd", clevel=compression_level, shuffle=Blosc.BITSHUFFLE)
+    encoding = {
+        name: {"compressor": compressor} for name, var in ds.data_vars.items()
+    }
+    template = ds.chunk({"time": timesteps_per_group, "y": -1, "x": -1})
+
+    # drop the chunking and compression inherited from the source store
+    for var in template.variables.values():
+        for key in ("chunks", "preferred_chunks", "compressor", "filters"):
+            var.encoding.pop(key, None)
+
+    template.to_zarr(store, mode="w-", compute=False, encoding=encoding)
+    return timesteps_per_group, 0
+
+
+def zarr_save(
+    args,
+    store: Path,
+    ledger: Path = None,
+    output_format: str = "zarr",
+    scheduler: str = None,
+):
+    """
+    Writes a group of timesteps into its region of a Zarr store created by
+    init_store, and records the hours in the ledger once the write is
+    complete, under the output format the store is written for. The group
+    is computed with the given dask scheduler, the default one if None.
+    """
+    ds = args[0]
+    start = args[1]
+    end = args[2]
+
+    try:
+        # position of the group within the store's own time axis, which may
+        # start before ds when a job is resumed with a later start date
+        group = ds.sel(time=slice(start, end))
+        times = store_times(store)
+        i0 = int(numpy.searchsorted(times, group.time.values[0]))
+        i1 = i0 + group.sizes["time"]
+        if not numpy.array_equal(times[i0:i1], group.time.values):
+            raise ValueError(f"{start} - {end} is not in the time axis of {store}")
+
+        # only variables along time are written, the coordinates were
+        # written when the store was created
+        group = group.drop_vars(
+            [name for name, var in group.variables.items() if "time" not in var.dims]
+        )
+        group = group.chunk({"time": -1, "y": -1, "x": -1})
+        for var in group.variables.values():
+            var.encoding.pop("chunks", None)
+            var.encoding.pop("preferred_chunks", None)
+
+        logging.info(f"Writing data for {start} - {end} to {store}")
+        write = group.to_zarr(store, region={"time": slice(i0, i1)}, compute=False)
+        write.compute(scheduler=scheduler)
+
+        if ledger is not None:
+            names = [
+                hourly_filename(datetime.utcfromtimestamp(t.astype(int) * 1e-9))
+                for t in group.time.values
+            ]
+            record_store(ledger, store, names, output_format)
+
+        return (start, end, True)
+
+    except Exception:
+        logging.exception(f"Failed to save data for {start} - {end}")
+        return (start, end, False)
+
+
+def finalize_store(store: Path) -> None:
+    """
+    Consolidates the metadata of a completed store so it opens with a
+    single read.
+    """
+    zarr.consolidate_metadata(str(store))
+
+
+def merge_netcdf(store: Path, outfile: Path, compression_level: int) -> None:
+    """
+    Merges a completed Zarr store into a single NetCDF file with an
+    unlimited time dimension.
+
+    Parameters
+    ----------
+    store: pathlib.Path
+        location of the Zarr store.
+    outfile: pathlib.Path
+        path of the NetCDF file to create.
+    compression_level: int
+        zlib compression level of the data variables.
+    """
+    logging.info(f"Merging {store} into {outfile}")
+    ds = xarray.open_zarr(store)
+    encoding = {
+        name: {"zlib": True, "complevel": compression_level}
+        for name in ds.data_vars
+    }
+    tmp = outfile.with_name(f".{outfile.name}.tmp")
+    ds.to_netcdf(tmp, unlimited_dims=["time"], encoding=encoding)
+    tmp.replace(outfile)
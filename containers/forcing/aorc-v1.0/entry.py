@@ -1,25 +1,56 @@
 #!/usr/bin/env python3
 
-from datetime import datetime, timedelta
+from datetime import datetime
 
+import os
 import time
 import numpy
 import xarray
-import pyproj
 import pandas
 import geopandas
 import rioxarray
-import dask.bag as db
-from s3fs import S3FileSystem
+import shutil
+import tempfile
 from dask.distributed import Client
 from dask import distributed
-from kerchunk.combine import MultiZarrToZarr
+
+from consolidated import (
+    OutputFormat,
+    finalize_store,
+    init_store,
+    merge_netcdf,
+)
+from chunking import ChunkingMode, plan_chunks
+from grid import grid_window, load_grid, wrf_proj
+from instrumentation import metrics_from_env, path_size
+from ledger import (
+    completed_files,
+    forget,
+    hourly_filename,
+    ledger_path,
+    pending_groups,
+    record,
+)
+from manifest import find_headers
+from mask import apply_mask, load_mask
+from references import (
+    ReferenceFormat,
+    ReferencePeriod,
+    combine_headers,
+    open_period_references,
+    open_reference,
+    write_reference,
+)
+from tasks import Writer, run_groups
 
 import logging
 from pathlib import Path
-from typer import run, Argument, Option
+from concurrent.futures import ThreadPoolExecutor
+from typer import run, Argument, Exit, Option
+from typing import Union
 from typing_extensions import Annotated
 
+SPATIAL_SOURCE = "http://thredds.hydroshare.org/thredds/dodsC/hydroshare/resources/2a8a3566e1c84b8eb3871f30841a3855/data/contents/WRF_Hydro_NWM_geospatial_data_template_land_GIS.nc"
 
 
 def main(
@@ -51,6 +82,68 @@ def main(
         str,
         Option(help="Memory limit per worker, e.g. 3GB")
     ] = "3GB",
+    cache_dir: Annotated[
+        str,
+        Option(help="Directory used to cache header manifests, references and the "
+                    "spatial grid between runs. Mount a shared volume here to "
+                    "reuse it across jobs")
+    ] = str(Path.home() / ".cache" / "aorc"),
+    reference_period: Annotated[
+        ReferencePeriod,
+        Option(help="Combine and cache the headers by period so they are reused "
+                    "by later runs")
+    ] = ReferencePeriod.none,
+    reference_format: Annotated[
+        ReferenceFormat,
+        Option(help="Format of the cached combined references")
+    ] = ReferenceFormat.json,
+    header_concurrency: Annotated[
+        int,
+        Option(help="Maximum number of json headers downloaded at once")
+    ] = 32,
+    header_retries: Annotated[
+        int,
+        Option(help="Number of times to retry a json header that fails to download")
+    ] = 3,
+    chunking: Annotated[
+        ChunkingMode,
+        Option(help="'time' rechunks to one timestep per chunk, 'adaptive' sizes "
+                    "chunks from the clipped extent and --worker-mem-limit")
+    ] = ChunkingMode.time,
+    output_format: Annotated[
+        OutputFormat,
+        Option(help="'hourly' writes one LDASIN_DOMAIN1 file per hour, 'zarr' a "
+                    "single Zarr store and 'netcdf' a single NetCDF file. Use "
+                    "export.py to create hourly files later")
+    ] = OutputFormat.hourly,
+    compression_level: Annotated[
+        int,
+        Option(help="Compression level of the zarr and netcdf output formats")
+    ] = 5,
+    writer: Annotated[
+        Writer,
+        Option(help="'stream' writes each hourly file as soon as its data is read "
+                    "while the next block is fetched, 'batch' loads each group "
+                    "into memory before writing it")
+    ] = Writer.stream,
+    read_ahead: Annotated[
+        int,
+        Option(help="Number of blocks of timesteps the streaming writer reads ahead")
+    ] = 1,
+    retries: Annotated[
+        int,
+        Option(help="Number of times to retry groups of timesteps that fail")
+    ] = 2,
+    verify_checksums: Annotated[
+        bool,
+        Option("--verify-checksums",
+               help="Verify the checksum of previously completed files on restart "
+                    "instead of only their size")
+    ] = False,
+    clip_buffer: Annotated[
+        int,
+        Option(help="Number of grid cells to pad the watershed extent by before clipping")
+    ] = 2,
     verbose: Annotated[
         bool,
         Option("--verbose", help="Turn on verbose text output")] = False,
@@ -76,53 +169,215 @@ def main(
     if client is None:
         client = Client()
 
+    # per-stage timings and throughput, see instrumentation.py
+    metrics = metrics_from_env("aorc-v1.0", client=client, echo=verbose)
+
+    # description of the clipped dataset. This is all that is sent to the
+    # workers, each of which opens the dataset once and reuses it.
+    spec = dict(
+        start_date=start_date,
+        end_date=end_date,
+        shapefile=shapefile,
+        s3bucket=s3_bucket,
+        cache_dir=cache_dir,
+        reference_period=reference_period.value,
+        reference_format=reference_format.value,
+        header_concurrency=header_concurrency,
+        header_retries=header_retries,
+        chunking=chunking.value,
+        worker_mem_limit=worker_mem_limit,
+        timesteps_per_group=timesteps_per_group,
+        clip_buffer=clip_buffer,
+    )
+
+    # combine the headers once up front and save the result so workers
+    # only need to open a local file
+    job_reference = None
+    if reference_period == ReferencePeriod.none:
+        with metrics.stage("combining references"):
+            headers = find_headers(start_date, end_date, s3_bucket, Path(cache_dir))
+            logging.info(f"Found {len(headers)} files")
+            logging.info("Loading data using MultiZarrToZarr")
+            refs = combine_headers(
+                headers, concurrency=header_concurrency, retries=header_retries
+            )
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            fd, job_reference = tempfile.mkstemp(suffix=".json", dir=cache_dir)
+            os.close(fd)
+            write_reference(refs, Path(job_reference), "json")
+            spec["reference"] = job_reference
+            del refs
+
+    try:
+        with metrics.stage("opening dataset"):
+            ds = open_clipped_dataset(**spec)
+
+        # consolidated outputs are written into a single zarr store by all
+        # workers. For netcdf the store is merged into one file at the end.
+        store = None
+        offset = 0
+        save_with = writer.value
+        if output_format != OutputFormat.hourly:
+            name = "aorc.zarr" if output_format == OutputFormat.zarr else ".aorc.zarr"
+            store = outpath / name
+            timesteps_per_group, offset = init_store(
+                ds, store, timesteps_per_group, compression_level
+            )
+            spec["timesteps_per_group"] = timesteps_per_group
+            save_with = "zarr"
+
+        # skip the hours that a previous run of this job already completed
+        # for the same output and group the rest into runs of at most
+        # timesteps_per_group hours
+        ledger = ledger_path(outpath)
+        done = completed_files(
+            ledger,
+            verify_checksums=verify_checksums,
+            output_format=output_format.value,
+            store=store,
+        )
+        times = pandas.DatetimeIndex(ds.time.values)
+        groups = pending_groups(times, done, timesteps_per_group, offset)
+
+        # debugging
+        for group in groups:
+            logging.info(f'{str(group[0])} -> {str(group[1])}')
+
+        logging.info(f'Processing {len(groups)} group(s) of data, each containing ~{timesteps_per_group} timesteps')
+
+        # retry the groups that failed, up to the requested number of times
+        with metrics.stage("collecting") as rec:
+            size = path_size(outpath)
+            for attempt in range(retries + 1):
+                if len(groups) == 0:
+                    break
+                if attempt > 0:
+                    logging.info(f'Retrying {len(groups)} failed group(s), attempt {attempt} of {retries}')
+                results = run_groups(
+                    client,
+                    spec,
+                    groups,
+                    outpath,
+                    writer=save_with,
+                    read_ahead=read_ahead,
+                    ledger=ledger,
+                    store=store,
+                    output_format=output_format.value,
+                )
+                groups = [(start, end) for start, end, success in results if not success]
+            rec["bytes_written"] = path_size(outpath) - size
+    finally:
+        if job_reference is not None:
+            os.remove(job_reference)
+
+    if len(groups) > 0:
+        for start, end in groups:
+            logging.error(f'Failed to collect data for {start} - {end}')
+        metrics.finish()
+        raise Exit(code=1)
+
+    if store is not None:
+        finalize_store(store)
+    if output_format == OutputFormat.netcdf:
+        with metrics.stage("merging netcdf") as rec:
+            merge_netcdf(store, outpath / "aorc.nc", compression_level)
+            rec["bytes_written"] = path_size(outpath / "aorc.nc")
+
+        # the intermediate store and its ledger entries are no longer needed
+        shutil.rmtree(store)
+        forget(ledger, output_format.value, store)
+
+    metrics.finish()
+    logging.info("Operation Completed Successfully")
+
+
+def open_clipped_dataset(
+    start_date: datetime,
+    end_date: datetime,
+    shapefile: str,
+    s3bucket: str,
+    cache_dir: str,
+    spatial_source: str = SPATIAL_SOURCE,
+    reference: str = None,
+    reference_period: str = "none",
+    reference_format: str = "json",
+    header_concurrency: int = 32,
+    header_retries: int = 3,
+    chunking: str = "time",
+    worker_mem_limit: str = "3GB",
+    timesteps_per_group: int = 10,
+    clip_buffer: int = 2,
+) -> xarray.Dataset:
+    """
+    Opens the AORC forcing for a date range, clipped to a watershed.
+
+    Parameters
+    ----------
+    start_date: datetime.datetime
+        start datetime for collecting aorc data.
+    end_date: datetime.datetime
+        end datetime for collecting aorc data.
+    shapefile: str
+        path to an ESRI Shapefile that will be used to clip the AORC data.
+    s3bucket: str
+        url to the s3 bucket containing aorc data.
+    cache_dir: str
+        directory containing the local caches.
+    spatial_source: str
+        Path to the file used to provide the missing spatial metadata.
+    reference: str
+        path to a combined reference for the date range. If None, the
+        reference is built according to reference_period.
+    reference_period, reference_format, header_concurrency, header_retries,
+    chunking: see load_zarr.
+    worker_mem_limit: str
+        memory limit per worker, used to plan adaptive chunks.
+    timesteps_per_group: int
+        number of timesteps saved by each task, used to plan adaptive chunks.
+    clip_buffer: int
+        number of grid cells to pad the watershed extent by before clipping.
 
+    Returns
+    -------
+    xarray.Dataset
+        The clipped dataset with spatial metadata.
+    """
     # load the zarr headers into an xarray dataset
-    ds = load_zarr(start_date, end_date, s3_bucket)
+    ds = load_zarr(
+        start_date,
+        end_date,
+        s3bucket,
+        Path(cache_dir),
+        reference=reference,
+        reference_period=reference_period,
+        reference_format=reference_format,
+        header_concurrency=header_concurrency,
+        header_retries=header_retries,
+        chunking=chunking,
+    )
+
+    # select the grid window that covers the watershed before attaching
+    # any coordinates so the rest of the pipeline only sees the subset
+    window = watershed_window(shapefile, spatial_source, Path(cache_dir), clip_buffer)
+    ds = ds.isel(window)
 
     # add spatial metadata to the AORC forcing
     # this is necessary for spatial subsetting
     ds = add_spatial_metadata(
         ds,
-        spatial_source="http://thredds.hydroshare.org/thredds/dodsC/hydroshare/resources/2a8a3566e1c84b8eb3871f30841a3855/data/contents/WRF_Hydro_NWM_geospatial_data_template_land_GIS.nc",
+        spatial_source=spatial_source,
+        cache_dir=Path(cache_dir),
+        window=window,
     )
 
     # clip the data spatially to the extent of the input watershed
-    ds = clip_aorc_by_shapefile(ds, shapefile)
-
-    # save to hourly files
-    st = datetime.utcfromtimestamp(ds.time[0].values.astype(int) * 1e-9)
-    et = datetime.utcfromtimestamp(ds.time[-1].values.astype(int) * 1e-9)
-    
-    # adjust end date to be an hour later than provided. This is 
-    # necessary so that the entire time range that was specified
-    # is downloaded without repetitive downloads.
-    et_padded = et + timedelta(hours=1)
-    
-    # compute number of bins such that each has approx 10 timesteps
-    bins = pandas.date_range(start=st, end=et, freq=f'{timesteps_per_group}H').union([st, et_padded])
-    
-    # create input parameters
-    input_params = []
-    for i in range(0, len(bins)-1):
-        et_reduced = bins[i+1] - timedelta(hours=1)
-        input_params.append([ds, bins[i], et_reduced, outpath])
-     
-    # debugging
-    for param in input_params:
-        t = ds.sel(time=slice(param[1],
-                              param[2])).time
-        logging.info(f'{str(t.values[0])} -> {str(t.values[-1])}')
-    
-    # create a bag of jobs to submit to Dask
-    b = db.from_sequence(input_params, npartitions=3)
-    b = b.map(batch_save)
+    ds = clip_aorc_by_shapefile(ds, shapefile, cache_dir=Path(cache_dir))
 
-    logging.info(f'Processing {len(bins) - 1} group(s) of data, each containing ~{timesteps_per_group} timesteps')
+    # size the chunks of the clipped data in bytes rather than hours
+    if chunking == "adaptive":
+        ds = ds.chunk(plan_chunks(ds, worker_mem_limit, max_time=timesteps_per_group))
 
-    results = b.compute()
-
-    logging.info("Operation Completed Successfully")
+    return ds
 
 
 def __create_ds_and_paths(ds, outpath):
@@ -130,11 +385,11 @@ def __create_ds_and_paths(ds, outpath):
     paths = []
     for t in times:
         ts = datetime.utcfromtimestamp(t.astype(int) * 1e-9)
-        paths.append(f'{outpath}/{ts.strftime("%Y%m%d%H%M")}.LDASIN_DOMAIN1')
+        paths.append(f'{outpath}/{hourly_filename(ts)}')
     return datasets, paths
 
 
-def batch_save(args):
+def batch_save(args, ledger: Path = None, scheduler: str = None):
     ds = args[0]
     start = args[1]
     end = args[2]
@@ -144,21 +399,101 @@ def batch_save(args):
         # load the dataset into memory
         logging.info(f"Collecting data for {start} - {end}")
         ds = ds.sel(time=slice(start, end))
-        ds = ds.load()
+        ds = ds.load(scheduler=scheduler)
     
         # save to disk
         logging.info(f"Saving data for {start} - {end}")
         datasets, paths = __create_ds_and_paths(ds, outpath)
         xarray.save_mfdataset(datasets, paths)
-        
+
+        # mark the hours as complete
+        if ledger is not None:
+            for path in paths:
+                record(ledger, path)
+
+        return (start, end, True)
+
+    except Exception:
+        logging.exception(f"Failed to save data for {start} - {end}")
+        return (start, end, False)
+
+
+def stream_save(
+    args, read_ahead: int = 1, ledger: Path = None, scheduler: str = None
+):
+    """
+    Saves a group of timesteps to hourly files without loading the whole
+    group into memory. Data is read one dask time chunk at a time, one hour
+    when the data is chunked with time=1, and the next read_ahead chunks are
+    fetched in the background while the current one is written. Peak memory
+    is bounded by read_ahead + 1 chunks regardless of the group size. Each
+    file is added to the ledger, if one is given, once it is complete. The
+    chunks are read with the given dask scheduler, the default one if None.
+    """
+    ds = args[0]
+    start = args[1]
+    end = args[2]
+    outpath = args[3]
+
+    try:
+        ds = ds.sel(time=slice(start, end))
+
+        # split the group on the time chunk boundaries so that each source
+        # chunk is read exactly once
+        try:
+            sizes = ds.chunksizes.get("time", (1,) * ds.sizes["time"])
+        except ValueError:
+            sizes = (1,) * ds.sizes["time"]
+        offsets = numpy.cumsum((0,) + tuple(sizes))
+        blocks = [slice(offsets[i], offsets[i + 1]) for i in range(len(sizes))]
+
+        logging.info(f"Streaming data for {start} - {end} in {len(blocks)} block(s)")
+        with ThreadPoolExecutor(max_workers=max(read_ahead, 1)) as pool:
+            pending = [
+                pool.submit(ds.isel(time=block).load, scheduler=scheduler)
+                for block in blocks[:read_ahead + 1]
+            ]
+            for i in range(len(blocks)):
+                block = pending.pop(0).result()
+
+                for t in range(block.sizes["time"]):
+                    hour = block.isel(time=t)
+                    ts = datetime.utcfromtimestamp(hour.time.values.astype(int) * 1e-9)
+                    path = f'{outpath}/{hourly_filename(ts)}'
+
+                    # write to a temporary file so partially written hours
+                    # are never left behind under the final name
+                    hour.to_netcdf(f"{path}.tmp")
+                    os.replace(f"{path}.tmp", path)
+                    if ledger is not None:
+                        record(ledger, path)
+                del block
+
+                # the block has been written, start fetching the next one
+                nxt = i + read_ahead + 1
+                if nxt < len(blocks):
+                    pending.append(
+                        pool.submit(ds.isel(time=blocks[nxt]).load, scheduler=scheduler)
+                    )
+
         return (start, end, True)
 
-    except:
+    except Exception:
+        logging.exception(f"Failed to save data for {start} - {end}")
         return (start, end, False)
 
 
 def load_zarr(
-    start_date: datetime, end_date: datetime, s3bucket: str
+    start_date: datetime,
+    end_date: datetime,
+    s3bucket: str,
+    cache_dir: Path,
+    reference: Union[dict, str] = None,
+    reference_period: str = "none",
+    reference_format: str = "json",
+    header_concurrency: int = 32,
+    header_retries: int = 3,
+    chunking: str = "time",
 ) -> xarray.Dataset:
     """
     Creates an xarray Dataset from data stored in s3.
@@ -171,6 +506,25 @@ def load_zarr(
         end datetime for collecting aorc data.
     s3bucket: str
         url to the s3 bucket containing aorc data.
+    cache_dir: pathlib.Path
+        directory containing the local cache of header manifests and
+        combined references.
+    reference: Union[dict, str]
+        combined reference, or path to one, covering the date range. If
+        provided, the headers are not looked up or combined.
+    reference_period: str
+        "month" or "year" to build, cache, and reuse combined references for
+        each period, or "none" to combine the headers on every run.
+    reference_format: str
+        format of the cached combined references, "json" or "parquet".
+    header_concurrency: int
+        maximum number of json headers downloaded at once.
+    header_retries: int
+        number of times to retry a json header that fails to download.
+    chunking: str
+        "time" to rechunk to one timestep per chunk, or "adaptive" to keep
+        the native chunking of the source so the chunks can be planned once
+        the dataset has been clipped.
 
     Returns
     -------
@@ -179,60 +533,41 @@ def load_zarr(
         headers provided.
 
     """
-    # create an instace of the S3FileSystem class from s3fs
-    s3 = S3FileSystem(anon=True)
-
-    # todo: this doesn't seem super efficient. A regex solution would probably
-    # be better but a quick search indicated that it's not supported
-    # in the s3fs library
-    year = start_date.year
-    headers = []  # list to store json headers in
-    while year <= end_date.year:
-
-        # list files in bucket
-        logging.info(f"Collecting files for {year}")
-        all_files = s3.ls(f"{s3bucket}{year}")
-
-        for f in all_files:
-            parts = f.split("/")
-            dt = datetime.strptime(parts[-1].split(".")[0], "%Y%m%d%H")
-
-            if dt < start_date:
-                # continue until the start time is reached
-                continue
-
-            if dt > end_date:
-                # exit early
-                break
-
-            # save the url to the json header
-            parts[0] += ".s3.amazonaws.com"
-            parts.insert(0, "https:/")
-            headers.append("/".join(parts))
-
-        # increment year
-        year += 1
-
-    logging.info(f"Found {len(headers)} files")
-
-    logging.info("Loading data using MultiZarrToZarr")
-    mzz = MultiZarrToZarr(
-        headers,
-        remote_protocol="s3",
-        remote_options={"anon": True},
-        concat_dims=["valid_time"],
-    )
-
-    # open the dataset
-    d = mzz.translate()
-    backend_args = {
-        "consolidated": False,
-        "storage_options": {"fo": d},
-        "consolidated": False,
-    }
-
-    # lazy load dataset
-    ds = xarray.open_dataset("reference://", engine="zarr", backend_kwargs=backend_args)
+    if reference is not None:
+        logging.info("Loading combined reference")
+        ds = open_reference(reference, chunks={} if chunking == "adaptive" else None)
+        ds = ds.sel(valid_time=slice(start_date, end_date))
+    elif reference_period != "none":
+        # open the cached references for each month or year that overlaps
+        # the requested range, building any that don't exist yet
+        logging.info(f"Loading combined references by {reference_period}")
+        ds = open_period_references(
+            start_date,
+            end_date,
+            s3bucket,
+            cache_dir,
+            reference_period,
+            reference_format,
+            concurrency=header_concurrency,
+            retries=header_retries,
+        )
+    else:
+        # look up the json headers in the local manifest cache. The bucket is
+        # only listed for years that have not been cached yet or when the
+        # requested range extends past the cached keys.
+        logging.info("Collecting header files")
+        headers = find_headers(start_date, end_date, s3bucket, cache_dir)
+
+        logging.info(f"Found {len(headers)} files")
+
+        logging.info("Loading data using MultiZarrToZarr")
+        d = combine_headers(
+            headers, concurrency=header_concurrency, retries=header_retries
+        )
+
+        # lazy load dataset, using dask chunks that match the source when
+        # the chunks will be planned later
+        ds = open_reference(d, chunks={} if chunking == "adaptive" else None)
 
     # squeeze along the Time dimension to remove it since we have valid_time
     ds = ds.squeeze(dim="Time")
@@ -241,7 +576,8 @@ def load_zarr(
     ds = ds.rename({"valid_time": "time", "south_north": "y", "west_east": "x"})
 
     # rechunk the dataset to solve the memory limit issue
-    ds = ds.chunk(chunks={"time": 1})
+    if chunking == "time":
+        ds = ds.chunk(chunks={"time": 1})
 
     logging.info("Dataset loaded successfully")
     logging.info(f"{ds.dims}")
@@ -249,7 +585,9 @@ def load_zarr(
     return ds
 
 
-def add_spatial_metadata(ds: xarray.Dataset, spatial_source: str) -> xarray.Dataset:
+def add_spatial_metadata(
+    ds: xarray.Dataset, spatial_source: str, cache_dir: Path, window: dict = None
+) -> xarray.Dataset:
     """
     Adds missing spatial metadata to the AORC forcing data.
 
@@ -262,6 +600,14 @@ def add_spatial_metadata(ds: xarray.Dataset, spatial_source: str) -> xarray.Data
         Path to the file used to provide the missing spatial metadata. For
         Example: WRF_Hydro_NWM_geospatial_data_template_land_GIS.nc.
 
+    cache_dir: pathlib.Path
+        Directory containing the local cache of the spatial grid. The grid is
+        computed from spatial_source the first time it is needed.
+
+    window: dict
+        x and y index slices that ds has already been subset to, as returned
+        by watershed_window. If None, ds is expected to cover the full grid.
+
     Returns
     -------
     xarray.Dataset
@@ -269,34 +615,16 @@ def add_spatial_metadata(ds: xarray.Dataset, spatial_source: str) -> xarray.Data
 
     """
 
-    # load the spatial metadata source
-    logging.info(f"Loading spatial metadata from {spatial_source}")
-    ds_meta = xarray.open_dataset(spatial_source)
+    # load the cached grid. lat and lon are memory-mapped so only the cells
+    # that remain after clipping are read from disk.
+    grid = load_grid(spatial_source, cache_dir)
+    x, y, lon, lat = grid["x"], grid["y"], grid["lon"], grid["lat"]
+    if window is not None:
+        x, y = x[window["x"]], y[window["y"]]
+        lon = numpy.array(lon[window["y"], window["x"]])
+        lat = numpy.array(lat[window["y"], window["x"]])
 
     logging.info(f"Adding spatial metadata")
-    # create meshgrid for x,y dimensions
-    x = ds_meta.x.values
-    y = ds_meta.y.values
-    X, Y = numpy.meshgrid(x, y)
-
-    # define the input crs
-    wrf_proj = pyproj.Proj(
-        proj="lcc",
-        lat_1=30.0,
-        lat_2=60.0,
-        lat_0=40.0000076293945,
-        lon_0=-97.0,  # Center point
-        a=6370000,
-        b=6370000,
-    )
-
-    # define the output crs
-    wgs_proj = pyproj.Proj(proj="latlong", datum="WGS84")
-
-    # transform X, Y into Lat, Lon
-    transformer = pyproj.Transformer.from_crs(wrf_proj.crs, wgs_proj.crs)
-    lon, lat = transformer.transform(X, Y)
-
     ds = ds.assign_coords(lon=(["y", "x"], lon))
     ds = ds.assign_coords(lat=(["y", "x"], lat))
     ds = ds.assign_coords(x=x)
@@ -322,7 +650,7 @@ def add_spatial_metadata(ds: xarray.Dataset, spatial_source: str) -> xarray.Data
 
     # add crs to netcdf file
     ds.rio.write_crs(
-        ds_meta.crs.attrs["spatial_ref"], inplace=True
+        grid["crs"], inplace=True
     ).rio.set_spatial_dims(
         x_dim="x",
         y_dim="y",
@@ -336,7 +664,61 @@ def add_spatial_metadata(ds: xarray.Dataset, spatial_source: str) -> xarray.Data
     return ds
 
 
-def clip_aorc_by_shapefile(ds: xarray.Dataset, shapefile: str) -> xarray.Dataset:
+def read_watershed(shapefile: str) -> geopandas.GeoDataFrame:
+    """
+    Reads a shapefile and transforms it into the projection of the AORC data.
+
+    Parameters
+    ----------
+    shapefile: str
+        path to an ESRI Shapefile.
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+        The shapefile geometries in the AORC lambert conformal conic srs.
+    """
+    # load shapefile using geopandas and convert to aorc srs
+    logging.info("Reading input Shapefile and transforming srs")
+    gdf = geopandas.read_file(shapefile)
+    return gdf.to_crs(wrf_proj().crs)
+
+
+def watershed_window(
+    shapefile: str, spatial_source: str, cache_dir: Path, buffer: int = 2
+) -> dict:
+    """
+    Computes the grid index window that covers a watershed. This is a cheap
+    lookup against the cached 1-D grid coordinates, so the dataset can be
+    reduced to the watershed extent before any coordinates or geometry masks
+    are applied to it.
+
+    Parameters
+    ----------
+    shapefile: str
+        path to an ESRI Shapefile of the watershed.
+    spatial_source: str
+        Path to the file used to provide the missing spatial metadata.
+    cache_dir: pathlib.Path
+        Directory containing the local cache of the spatial grid.
+    buffer: int
+        number of grid cells to pad the watershed extent by.
+
+    Returns
+    -------
+    dict
+        x and y index slices that can be passed to Dataset.isel.
+    """
+    gdf = read_watershed(shapefile)
+    grid = load_grid(spatial_source, cache_dir)
+    window = grid_window(grid["x"], grid["y"], gdf.total_bounds, buffer)
+    logging.info(f"Watershed grid window: {window}")
+    return window
+
+
+def clip_aorc_by_shapefile(
+    ds: xarray.Dataset, shapefile: str, cache_dir: Path = None
+) -> xarray.Dataset:
     """
     Performs spatial clip of data using bounding box.
 
@@ -348,6 +730,10 @@ def clip_aorc_by_shapefile(ds: xarray.Dataset, shapefile: str) -> xarray.Dataset
     shapefile: str
         path to an ESRI Shapefile that will be used to clip the AORC data.
 
+    cache_dir: pathlib.Path
+        Directory containing the local cache of rasterized watershed masks.
+        If None, the geometries are rasterized by rioxarray on every call.
+
 
     Returns
     -------
@@ -355,28 +741,19 @@ def clip_aorc_by_shapefile(ds: xarray.Dataset, shapefile: str) -> xarray.Dataset
         An xarray dataset that has been clipped to the input Shapefile.
     """
 
-    # load shapefile using geopandas and convert to aorc srs
-    logging.info("Reading input Shapefile and transforming srs")
-    gdf = geopandas.read_file(shapefile)
-
-    # convert these data into the projection of our forcing data
-    target_crs = pyproj.Proj(
-        proj="lcc",
-        lat_1=30.0,
-        lat_2=60.0,
-        lat_0=40.0000076293945,
-        lon_0=-97.0,  # Center point
-        a=6370000,
-        b=6370000,
-    )
-
-    gdf = gdf.to_crs(target_crs.crs)
+    gdf = read_watershed(shapefile)
 
     # clip AORC to the extent of the hydrofabric geometries
     logging.info("Clipping Dataset to Shapefile extent")
-    ds = ds.rio.clip(
-        gdf.geometry.values, gdf.crs, drop=True, invert=False, from_disk=True
-    )
+    if cache_dir is None:
+        ds = ds.rio.clip(
+            gdf.geometry.values, gdf.crs, drop=True, invert=False, from_disk=True
+        )
+    else:
+        # reuse the rasterized mask from previous runs over the same
+        # watershed and grid window
+        mask, window = load_mask(gdf.to_crs(ds.rio.crs), ds, cache_dir)
+        ds = apply_mask(ds, mask, window)
 
     logging.info("Successfully clipped Dataset")
     return ds
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Exports hourly LDASIN_DOMAIN1 files for WRF-Hydro from the consolidated
+AORC output written by entry.py with --output-format zarr or netcdf.
+"""
+
+import time
+import logging
+from pathlib import Path
+from datetime import datetime
+from typing import Optional
+
+import xarray
+from typer import run, Argument, Exit, Option
+from typing_extensions import Annotated
+
+from entry import stream_save
+
+
+def main(
+    source: Annotated[
+        str,
+        Argument(help="Path to the aorc.zarr store or aorc.nc file to export")
+    ],
+    outdir: Annotated[
+        str,
+        Argument(help="Path to save the hourly LDASIN_DOMAIN1 files")] = "./aorc",
+    start_date: Annotated[
+        Optional[datetime],
+        Option(help="First timestep to export, defaults to the start of the data")
+    ] = None,
+    end_date: Annotated[
+        Optional[datetime],
+        Option(help="Last timestep to export, defaults to the end of the data")
+    ] = None,
+    verbose: Annotated[
+        bool,
+        Option("--verbose", help="Turn on verbose text output")] = False,
+):
+
+    # set verbosity level
+    if verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    outpath = Path(outdir)
+    outpath.mkdir(parents=True, exist_ok=True)
+
+    export_hourly(source, outpath, start_date, end_date)
+
+
+def export_hourly(
+    source: str,
+    outpath: Path,
+    start_date: datetime = None,
+    end_date: datetime = None,
+) -> None:
+    """
+    Writes one LDASIN_DOMAIN1 file per timestep of a consolidated output.
+
+    Parameters
+    ----------
+    source: str
+        path to a Zarr store or NetCDF file written by entry.py.
+    outpath: pathlib.Path
+        directory to save the hourly files in.
+    start_date: datetime.datetime
+        first timestep to export. Defaults to the first timestep of source.
+    end_date: datetime.datetime
+        last timestep to export. Defaults to the last timestep of source.
+    """
+    if Path(source).is_dir():
+        ds = xarray.open_zarr(source)
+    else:
+        ds = xarray.open_dataset(source, chunks={"time": 1})
+
+    start = start_date or ds.time.values[0]
+    end = end_date or ds.time.values[-1]
+
+    logging.info(f"Exporting {source} to {outpath}")
+    _, _, success = stream_save([ds, start, end, outpath])
+    if not success:
+        raise Exit(code=1)
+
+
+if __name__ == "__main__":
+    st = time.time()
+    run(main)
+    logging.info(f'Elapsed time: {time.time() - st} seconds')
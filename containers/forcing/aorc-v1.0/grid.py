@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""
+Local cache of the NWM/AORC spatial grid.
+
+The x/y coordinates, the projected lat/lon of every cell, and the CRS of the
+1km CONUS grid never change, so they are computed once from the NWM
+geospatial template and stored as .npy files. The lat/lon arrays are opened
+memory-mapped so that only the cells that survive a spatial subset are ever
+read from disk.
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy
+import pyproj
+import xarray
+
+# number of grid rows projected at a time when building the cache
+BLOCK_ROWS = 256
+
+
+def wrf_proj() -> pyproj.Proj:
+    """
+    Returns the lambert conformal conic projection of the WRF-Hydro grid.
+    """
+    return pyproj.Proj(
+        proj="lcc",
+        lat_1=30.0,
+        lat_2=60.0,
+        lat_0=40.0000076293945,
+        lon_0=-97.0,  # Center point
+        a=6370000,
+        b=6370000,
+    )
+
+
+def grid_cache_path(cache_dir: Path, spatial_source: str) -> Path:
+    """
+    Returns the directory that holds the cached grid for a spatial source.
+    """
+    key = hashlib.sha1(spatial_source.encode("utf-8")).hexdigest()[:16]
+    return Path(cache_dir) / "grid" / key
+
+
+def build_grid_cache(spatial_source: str, path: Path) -> None:
+    """
+    Computes the grid coordinates from the spatial metadata source and saves
+    them to the cache. The lat/lon arrays are projected in blocks of rows and
+    written straight to disk so the full CONUS meshgrid is never held in
+    memory.
+
+    Parameters
+    ----------
+    spatial_source: str
+        Path or url to the file used to provide the spatial metadata. For
+        Example: WRF_Hydro_NWM_geospatial_data_template_land_GIS.nc.
+    path: pathlib.Path
+        Directory to save the cached grid in.
+    """
+    logging.info(f"Loading spatial metadata from {spatial_source}")
+    ds_meta = xarray.open_dataset(spatial_source)
+    x = ds_meta.x.values
+    y = ds_meta.y.values
+    crs = ds_meta.crs.attrs["spatial_ref"]
+
+    # build in a temporary directory and move it into place once complete
+    # so that concurrent jobs never read a partially written grid
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.mkdir(parents=True, exist_ok=True)
+    numpy.save(tmp / "x.npy", x)
+    numpy.save(tmp / "y.npy", y)
+    with open(tmp / "crs.wkt", "w") as f:
+        f.write(crs)
+
+    # transform X, Y into Lat, Lon
+    logging.info("Projecting grid coordinates into lat/lon")
+    wgs_proj = pyproj.Proj(proj="latlong", datum="WGS84")
+    transformer = pyproj.Transformer.from_crs(wrf_proj().crs, wgs_proj.crs)
+    shape = (len(y), len(x))
+    lon = numpy.lib.format.open_memmap(
+        tmp / "lon.npy", mode="w+", dtype="float64", shape=shape
+    )
+    lat = numpy.lib.format.open_memmap(
+        tmp / "lat.npy", mode="w+", dtype="float64", shape=shape
+    )
+    for i in range(0, len(y), BLOCK_ROWS):
+        X, Y = numpy.meshgrid(x, y[i : i + BLOCK_ROWS])
+        lon[i : i + BLOCK_ROWS], lat[i : i + BLOCK_ROWS] = transformer.transform(X, Y)
+    lon.flush()
+    lat.flush()
+    del lon, lat
+
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another job finished building the same grid first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_grid(spatial_source: str, cache_dir: Path) -> dict:
+    """
+    Loads the cached grid for a spatial source, building it first if it
+    does not exist.
+
+    Parameters
+    ----------
+    spatial_source: str
+        Path or url to the file used to provide the spatial metadata.
+    cache_dir: pathlib.Path
+        root directory of the local cache.
+
+    Returns
+    -------
+    dict
+        x and y coordinate arrays, memory-mapped lat and lon arrays with
+        shape (y, x), and the crs as well known text.
+    """
+    path = grid_cache_path(cache_dir, spatial_source)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        build_grid_cache(spatial_source, path)
+
+    logging.info(f"Loading cached spatial grid from {path}")
+    with open(path / "crs.wkt", "r") as f:
+        crs = f.read()
+
+    return {
+        "x": numpy.load(path / "x.npy"),
+        "y": numpy.load(path / "y.npy"),
+        "lat": numpy.load(path / "lat.npy", mmap_mode="r"),
+        "lon": numpy.load(path / "lon.npy", mmap_mode="r"),
+        "crs": crs,
+    }
+
+
+def grid_window(
+    x: numpy.ndarray, y: numpy.ndarray, bounds: tuple, buffer: int = 2
+) -> dict:
+    """
+    Converts a bounding box in grid coordinates into integer index slices.
+
+    Parameters
+    ----------
+    x: numpy.ndarray
+        x coordinates of the grid cell centers.
+    y: numpy.ndarray
+        y coordinates of the grid cell centers.
+    bounds: tuple
+        (minx, miny, maxx, maxy) in the projection of the grid.
+    buffer: int
+        number of extra cells to include on each side of the bounding box.
+
+    Returns
+    -------
+    dict
+        x and y slices that can be passed directly to Dataset.isel.
+    """
+    minx, miny, maxx, maxy = bounds
+
+    slices = {}
+    for dim, coords, lo, hi in (("x", x, minx, maxx), ("y", y, miny, maxy)):
+        res = abs(coords[1] - coords[0])
+        idx = numpy.nonzero((coords >= lo - res / 2) & (coords <= hi + res / 2))[0]
+        if len(idx) == 0:
+            raise ValueError(f"Bounds {bounds} do not overlap the grid")
+        slices[dim] = slice(
+            int(max(idx[0] - buffer, 0)), int(min(idx[-1] + buffer + 1, len(coords)))
+        )
+
+    return slices
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""
+Completion ledger for the hourly AORC output files.
+
+Every file is recorded once it has been completely written, along with its
+size and checksum. A job that is restarted in the same output directory
+reads the ledger and only collects the hours that are missing.
+
+Entries are kept per output, the output format and the store the hour was
+written to, so hours written by an hourly run do not count as written to a
+consolidated store in the same directory, and the other way around.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+
+import pandas
+
+LEDGER_NAME = ".aorc-ledger.jsonl"
+
+
+def ledger_path(outpath: Path) -> Path:
+    """
+    Returns the default location of the ledger for an output directory.
+    """
+    return Path(outpath) / LEDGER_NAME
+
+
+def file_checksum(path: str) -> str:
+    """
+    Returns the sha256 hex digest of a file.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def record(ledger: Path, path: str) -> None:
+    """
+    Appends a completely written file to the ledger. Each entry is a single
+    line written with one append, so concurrent workers can share a ledger.
+
+    Parameters
+    ----------
+    ledger: pathlib.Path
+        path to the ledger file.
+    path: str
+        path to the file that was written.
+    """
+    entry = {
+        "output": "hourly",
+        "file": Path(path).name,
+        "size": os.path.getsize(path),
+        "sha256": file_checksum(path),
+    }
+    line = (json.dumps(entry) + "\n").encode("utf-8")
+    fd = os.open(ledger, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def record_store(
+    ledger: Path, store: Path, names: List[str], output_format: str
+) -> None:
+    """
+    Appends hours that were written into a consolidated store to the ledger.
+    The store handles the integrity of its own chunks, so only the name of
+    the store is recorded for each hour.
+
+    Parameters
+    ----------
+    ledger: pathlib.Path
+        path to the ledger file.
+    store: pathlib.Path
+        path to the store the hours were written to.
+    names: List[str]
+        hourly file names of the hours that were written.
+    output_format: str
+        output format the store is written for, "zarr" or "netcdf".
+    """
+    store = Path(store).name
+    lines = "".join(
+        json.dumps({"output": output_format, "file": name, "store": store}) + "\n"
+        for name in names
+    ).encode("utf-8")
+    fd = os.open(ledger, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, lines)
+    finally:
+        os.close(fd)
+
+
+def entry_output(entry: dict) -> Tuple[str, str]:
+    """
+    Returns the output format and store name an entry was written to. Entries
+    written before outputs were recorded only count for hourly files.
+    """
+    output = entry.get("output", "hourly" if "store" not in entry else None)
+    return output, entry.get("store")
+
+
+def read_entries(ledger: Path) -> List[dict]:
+    """
+    Returns every complete entry of the ledger, in the order they were added.
+    """
+    entries = []
+    with open(ledger, "r") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # a line cut short by a preempted write
+                continue
+    return entries
+
+
+def completed_files(
+    ledger: Path,
+    verify_checksums: bool = False,
+    output_format: str = "hourly",
+    store: Path = None,
+) -> set:
+    """
+    Returns the names of the files in the ledger that still exist on disk
+    with the recorded size, and optionally the recorded checksum. Hours
+    written to a consolidated store are complete while the store exists.
+    Only entries of the given output are considered.
+
+    Parameters
+    ----------
+    ledger: pathlib.Path
+        path to the ledger file.
+    verify_checksums: bool
+        recompute the checksum of every file instead of only checking sizes.
+    output_format: str
+        output format of the job, "hourly", "zarr" or "netcdf".
+    store: pathlib.Path
+        store the job writes into, None for hourly files.
+
+    Returns
+    -------
+    set
+        Names of the completed files.
+    """
+    if not ledger.exists():
+        return set()
+
+    key = (output_format, Path(store).name if store is not None else None)
+    entries = {}
+    for entry in read_entries(ledger):
+        if entry_output(entry) == key:
+            entries[entry["file"]] = entry
+
+    done = set()
+    for name, entry in entries.items():
+        if "store" in entry:
+            if (ledger.parent / entry["store"]).exists():
+                done.add(name)
+            continue
+
+        path = ledger.parent / name
+        try:
+            if os.path.getsize(path) != entry["size"]:
+                continue
+        except OSError:
+            continue
+        if verify_checksums and file_checksum(path) != entry["sha256"]:
+            continue
+        done.add(name)
+
+    logging.info(f"Ledger lists {len(done)} completed file(s)")
+    return done
+
+
+def forget(ledger: Path, output_format: str, store: Path = None) -> None:
+    """
+    Removes the entries of one output from the ledger, e.g. once an
+    intermediate store has been deleted. Entries of other outputs are kept.
+
+    Parameters
+    ----------
+    ledger: pathlib.Path
+        path to the ledger file.
+    output_format: str
+        output format of the entries to remove.
+    store: pathlib.Path
+        store of the entries to remove, None for hourly files.
+    """
+    if not ledger.exists():
+        return
+
+    key = (output_format, Path(store).name if store is not None else None)
+    keep = [e for e in read_entries(ledger) if entry_output(e) != key]
+    if len(keep) == 0:
+        ledger.unlink(missing_ok=True)
+        return
+
+    tmp = ledger.with_name(f"{ledger.name}.{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        for entry in keep:
+            f.write(json.dumps(entry) + "\n")
+    os.replace(tmp, ledger)
+
+
+def hourly_filename(ts: datetime) -> str:
+    """
+    Returns the name of the hourly output file for a timestep.
+    """
+    return f'{ts.strftime("%Y%m%d%H%M")}.LDASIN_DOMAIN1'
+
+
+def pending_groups(
+    times: pandas.DatetimeIndex, done: set, timesteps_per_group: int, offset: int = 0
+) -> List[Tuple[datetime, datetime]]:
+    """
+    Groups the timesteps that have not been completed yet into contiguous
+    runs of at most timesteps_per_group hours. Groups never cross a multiple
+    of timesteps_per_group counted from offset positions before the first
+    timestep, so that they line up with the chunks of a store that starts
+    earlier than times.
+
+    Parameters
+    ----------
+    times: pandas.DatetimeIndex
+        every timestep in the requested range.
+    done: set
+        names of the files that were already completed.
+    timesteps_per_group: int
+        maximum number of timesteps in each group.
+    offset: int
+        position of the first timestep in the store the groups are written
+        to, 0 for hourly files.
+
+    Returns
+    -------
+    List[Tuple[datetime.datetime, datetime.datetime]]
+        first and last timestep of each group.
+    """
+    groups = []
+    run = []
+    for i, t in enumerate(times):
+        missing = hourly_filename(t) not in done
+        if missing:
+            run.append(t)
+        # close the group at a chunk boundary, when a completed hour breaks
+        # the run, or at the end of the range
+        if run and (
+            (offset + i + 1) % timesteps_per_group == 0
+            or not missing
+            or i == len(times) - 1
+        ):
+            groups.append((run[0], run[-1]))
+            run = []
+    return groups
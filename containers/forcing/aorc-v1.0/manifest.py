@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+"""
+On-disk manifest of the AORC kerchunk headers stored in s3.
+
+Listing a year of the retrospective bucket and parsing every key is
+expensive and the result rarely changes, so the sorted list of header keys
+for each bucket/year is cached locally. Lookups are a binary search on the
+hourly timestamps encoded in the key names.
+"""
+
+import os
+import json
+import bisect
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from s3fs import S3FileSystem
+
+# header keys are named YYYYMMDDHH.<suffix>, so the timestamps sort
+# lexicographically in the same order as chronologically
+TIME_FORMAT = "%Y%m%d%H"
+
+# environment variable holding the endpoint of an s3 compatible store, e.g.
+# minio, to read the aorc data from instead of aws
+ENDPOINT_VARIABLE = "AORC_S3_ENDPOINT"
+
+
+def s3_options() -> dict:
+    """
+    Returns the storage options for anonymous access to the aorc bucket.
+    """
+    options = {"anon": True}
+    endpoint = os.environ.get(ENDPOINT_VARIABLE)
+    if endpoint:
+        options["client_kwargs"] = {"endpoint_url": endpoint}
+    return options
+
+
+def bucket_cache_name(s3bucket: str) -> str:
+    """
+    Returns a filesystem-safe name for a bucket url, used to namespace the
+    local caches of different buckets.
+    """
+    return s3bucket.replace("s3://", "").strip("/").replace("/", "_")
+
+
+def manifest_path(cache_dir: Path, s3bucket: str, year: int) -> Path:
+    """
+    Returns the location of the manifest for a bucket and year.
+
+    Parameters
+    ----------
+    cache_dir: pathlib.Path
+        root directory of the local cache.
+    s3bucket: str
+        url to the s3 bucket containing aorc data.
+    year: int
+        year of data described by the manifest.
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the manifest json file.
+    """
+    return Path(cache_dir) / "manifests" / bucket_cache_name(s3bucket) / f"{year}.json"
+
+
+def load_manifest(path: Path) -> dict:
+    """
+    Loads a manifest from disk, returning an empty manifest if it does not
+    exist or cannot be read.
+    """
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        if len(manifest["times"]) != len(manifest["keys"]):
+            raise ValueError("manifest times and keys are misaligned")
+        return manifest
+    except FileNotFoundError:
+        pass
+    except (ValueError, KeyError) as e:
+        logging.warning(f"Ignoring unreadable manifest {path}: {e}")
+    return {"times": [], "keys": [], "complete": False}
+
+
+def save_manifest(path: Path, manifest: dict) -> None:
+    """
+    Writes a manifest to disk. The file is written to a temporary location
+    and moved into place so concurrent jobs sharing a cache never read a
+    partially written manifest.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+
+def list_new_keys(
+    s3: S3FileSystem, s3bucket: str, year: int, start_after: Optional[str] = None
+) -> List[str]:
+    """
+    Lists the header keys for a year, optionally only those that sort after
+    a given key.
+
+    Parameters
+    ----------
+    s3: s3fs.S3FileSystem
+        filesystem used to list the bucket.
+    s3bucket: str
+        url to the s3 bucket containing aorc data.
+    year: int
+        year of data to list.
+    start_after: str
+        full path (bucket/key) of the last key already known. Only keys after
+        this one are listed.
+
+    Returns
+    -------
+    List[str]
+        Sorted list of full paths (bucket/key) to the header files.
+    """
+    bucket, prefix, _ = s3.split_path(f"{s3bucket}{year}")
+    kwargs = {"Bucket": bucket, "Prefix": f"{prefix}/"}
+    if start_after is not None:
+        kwargs["StartAfter"] = start_after.split("/", 1)[1]
+
+    keys = []
+    while True:
+        resp = s3.call_s3("list_objects_v2", **kwargs)
+        keys.extend(f"{bucket}/{obj['Key']}" for obj in resp.get("Contents", []))
+        if not resp.get("IsTruncated"):
+            break
+        kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+
+    return sorted(keys)
+
+
+def key_time(key: str) -> str:
+    """
+    Returns the YYYYMMDDHH timestamp encoded in a header key.
+    """
+    return key.split("/")[-1].split(".")[0]
+
+
+def key_to_url(key: str) -> str:
+    """
+    Converts a full path (bucket/key) into the https url of the header.
+    """
+    endpoint = os.environ.get(ENDPOINT_VARIABLE)
+    if endpoint:
+        return f"{endpoint.rstrip('/')}/{key}"
+
+    parts = key.split("/")
+    parts[0] += ".s3.amazonaws.com"
+    parts.insert(0, "https:/")
+    return "/".join(parts)
+
+
+def update_manifest(
+    s3: S3FileSystem, s3bucket: str, year: int, manifest: dict, until: str
+) -> bool:
+    """
+    Extends a manifest with any keys that were added to the bucket since it
+    was last refreshed. Nothing is listed if the manifest already covers the
+    requested time or contains the entire year.
+
+    Parameters
+    ----------
+    s3: s3fs.S3FileSystem
+        filesystem used to list the bucket.
+    s3bucket: str
+        url to the s3 bucket containing aorc data.
+    year: int
+        year of data described by the manifest.
+    manifest: dict
+        manifest to update in place.
+    until: str
+        last YYYYMMDDHH timestamp that the manifest needs to cover.
+
+    Returns
+    -------
+    bool
+        True if the manifest was modified.
+    """
+    times = manifest["times"]
+    if manifest["complete"] or (len(times) > 0 and times[-1] >= until):
+        return False
+
+    start_after = manifest["keys"][-1] if len(times) > 0 else None
+    logging.info(
+        f"Listing {'new ' if start_after else ''}header files for {year}"
+    )
+    new_keys = [
+        k
+        for k in list_new_keys(s3, s3bucket, year, start_after)
+        if len(key_time(k)) == 10 and key_time(k).isdigit()
+    ]
+    manifest["keys"].extend(new_keys)
+    manifest["times"].extend(key_time(k) for k in new_keys)
+    manifest["complete"] = len(times) > 0 and times[-1] >= f"{year}123123"
+
+    return True
+
+
+def find_headers(
+    start_date: datetime,
+    end_date: datetime,
+    s3bucket: str,
+    cache_dir: Path,
+    s3: Optional[S3FileSystem] = None,
+) -> List[str]:
+    """
+    Finds the urls of the json headers within a date range, using the local
+    manifest cache and refreshing it from s3 only when necessary.
+
+    Parameters
+    ----------
+    start_date: datetime.datetime
+        start datetime for collecting aorc data.
+    end_date: datetime.datetime
+        end datetime for collecting aorc data.
+    s3bucket: str
+        url to the s3 bucket containing aorc data.
+    cache_dir: pathlib.Path
+        root directory of the local cache.
+    s3: s3fs.S3FileSystem
+        filesystem used to list the bucket. An anonymous filesystem is
+        created if one is not provided.
+
+    Returns
+    -------
+    List[str]
+        Chronologically sorted urls to the json headers.
+    """
+    if s3 is None:
+        s3 = S3FileSystem(**s3_options())
+
+    start = start_date.strftime(TIME_FORMAT)
+    end = end_date.strftime(TIME_FORMAT)
+
+    headers = []
+    for year in range(start_date.year, end_date.year + 1):
+        path = manifest_path(cache_dir, s3bucket, year)
+        manifest = load_manifest(path)
+        if update_manifest(s3, s3bucket, year, manifest, min(end, f"{year}123123")):
+            save_manifest(path, manifest)
+
+        times = manifest["times"]
+        lo = bisect.bisect_left(times, start)
+        hi = bisect.bisect_right(times, end)
+        headers.extend(key_to_url(k) for k in manifest["keys"][lo:hi])
+
+    return headers
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""
+Cache of rasterized watershed masks.
+
+Rasterizing detailed hydrofabric polygons is a noticeable part of each job,
+and the same watersheds are requested repeatedly with different date ranges.
+Masks are therefore cached on disk, keyed by a hash of the geometries, the
+target grid and the CRS, and applied to the data with a vectorized where.
+"""
+
+import os
+import hashlib
+import logging
+from pathlib import Path
+from typing import Tuple
+
+import numpy
+import xarray
+import geopandas
+from rasterio import features
+
+
+def mask_key(gdf: geopandas.GeoDataFrame, x: numpy.ndarray, y: numpy.ndarray) -> str:
+    """
+    Returns a hash identifying a set of geometries rasterized onto a grid.
+
+    Parameters
+    ----------
+    gdf: geopandas.GeoDataFrame
+        geometries that will be rasterized.
+    x: numpy.ndarray
+        x coordinates of the target grid.
+    y: numpy.ndarray
+        y coordinates of the target grid.
+
+    Returns
+    -------
+    str
+        hex digest of the geometries, grid coordinates and crs.
+    """
+    h = hashlib.sha256()
+    for geom in gdf.geometry.values:
+        h.update(geom.wkb)
+    h.update(gdf.crs.to_wkt().encode("utf-8"))
+    h.update(numpy.ascontiguousarray(x, dtype="float64").tobytes())
+    h.update(numpy.ascontiguousarray(y, dtype="float64").tobytes())
+    return h.hexdigest()
+
+
+def rasterize_mask(
+    gdf: geopandas.GeoDataFrame, ds: xarray.Dataset
+) -> Tuple[numpy.ndarray, dict]:
+    """
+    Rasterizes geometries onto the grid of a dataset and trims the result to
+    the rows and columns that contain at least one cell inside the
+    geometries.
+
+    Parameters
+    ----------
+    gdf: geopandas.GeoDataFrame
+        geometries in the crs of the dataset.
+    ds: xarray.Dataset
+        dataset with spatial dims and a crs set through rioxarray.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, dict]
+        boolean mask that is True inside the geometries, and the index
+        window of ds that the mask covers.
+    """
+    shape = (ds.rio.height, ds.rio.width)
+    mask = features.geometry_mask(
+        gdf.geometry.values,
+        out_shape=shape,
+        transform=ds.rio.transform(recalc=True),
+        invert=True,
+        all_touched=False,
+    )
+
+    rows = numpy.nonzero(mask.any(axis=1))[0]
+    cols = numpy.nonzero(mask.any(axis=0))[0]
+    if len(rows) == 0:
+        raise ValueError("No data found in bounds of the input geometries")
+
+    window = {
+        ds.rio.y_dim: slice(int(rows[0]), int(rows[-1]) + 1),
+        ds.rio.x_dim: slice(int(cols[0]), int(cols[-1]) + 1),
+    }
+    return mask[window[ds.rio.y_dim], window[ds.rio.x_dim]], window
+
+
+def load_mask(
+    gdf: geopandas.GeoDataFrame, ds: xarray.Dataset, cache_dir: Path
+) -> Tuple[numpy.ndarray, dict]:
+    """
+    Returns the cached mask of geometries on the grid of a dataset,
+    rasterizing and caching it if it does not exist.
+
+    Parameters
+    ----------
+    gdf: geopandas.GeoDataFrame
+        geometries in the crs of the dataset.
+    ds: xarray.Dataset
+        dataset with spatial dims and a crs set through rioxarray.
+    cache_dir: pathlib.Path
+        root directory of the local cache.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, dict]
+        boolean mask that is True inside the geometries, and the index
+        window of ds that the mask covers.
+    """
+    x_dim, y_dim = ds.rio.x_dim, ds.rio.y_dim
+    key = mask_key(gdf, ds[x_dim].values, ds[y_dim].values)
+    path = Path(cache_dir) / "masks" / f"{key}.npz"
+
+    if path.exists():
+        logging.info(f"Loading cached watershed mask {key[:12]}")
+        with numpy.load(path) as f:
+            window = {
+                y_dim: slice(*f["rows"].tolist()),
+                x_dim: slice(*f["cols"].tolist()),
+            }
+            return f["mask"], window
+
+    logging.info("Rasterizing watershed mask")
+    mask, window = rasterize_mask(gdf, ds)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.stem}.{os.getpid()}.tmp.npz")
+    numpy.savez(
+        tmp,
+        mask=mask,
+        rows=numpy.array([window[y_dim].start, window[y_dim].stop]),
+        cols=numpy.array([window[x_dim].start, window[x_dim].stop]),
+    )
+    os.replace(tmp, path)
+
+    return mask, window
+
+
+def apply_mask(ds: xarray.Dataset, mask: numpy.ndarray, window: dict) -> xarray.Dataset:
+    """
+    Trims a dataset to a mask window and sets the cells outside the mask to
+    missing.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset
+        dataset to mask.
+    mask: numpy.ndarray
+        boolean mask that is True for the cells to keep.
+    window: dict
+        index window of ds that the mask covers.
+
+    Returns
+    -------
+    xarray.Dataset
+        The masked dataset.
+    """
+    y_dim, x_dim = list(window.keys())
+    ds = ds.isel(window)
+    return ds.where(xarray.DataArray(mask, dims=(y_dim, x_dim)))
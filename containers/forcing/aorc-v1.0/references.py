@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+"""
+Combined kerchunk references for the AORC forcing.
+
+Combining the hourly json headers with MultiZarrToZarr is the slowest part
+of opening the dataset. These helpers combine the headers once per month or
+year, store the result in the local cache as a json or parquet reference
+file, and open only the periods overlapping a requested time range.
+"""
+
+import os
+import shutil
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from enum import Enum
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import ujson
+import xarray
+import aiohttp
+from kerchunk.combine import MultiZarrToZarr
+
+from manifest import bucket_cache_name, find_headers, s3_options
+
+
+class ReferencePeriod(str, Enum):
+    """choices of the --reference-period option of the entry script"""
+
+    none = "none"
+    month = "month"
+    year = "year"
+
+
+class ReferenceFormat(str, Enum):
+    """choices of the --reference-format option of the entry script"""
+
+    json = "json"
+    parquet = "parquet"
+
+
+# http status codes that are worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+# seconds allowed to open a connection and between reads of a response,
+# neither includes the time a request waits for its turn
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+
+
+async def _fetch_header(
+    session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
+    url: str,
+    retries: int,
+    backoff: float,
+) -> dict:
+    """
+    Downloads and parses a single json header, retrying transient failures
+    with exponential backoff. The semaphore is only held while a request is
+    in flight, not while waiting to retry it.
+    """
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                async with session.get(url) as resp:
+                    resp.raise_for_status()
+                    return ujson.loads(await resp.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            permanent = (
+                isinstance(e, aiohttp.ClientResponseError)
+                and e.status not in RETRY_STATUS
+            )
+            if permanent or attempt == retries:
+                raise
+            delay = backoff * 2**attempt
+            logging.warning(f"Retrying {url} in {delay:.1f}s: {e!r}")
+            await asyncio.sleep(delay)
+
+
+async def _fetch_headers(
+    headers: List[str], concurrency: int, retries: int, backoff: float
+) -> List[dict]:
+    # a single session keeps connections alive between requests and the
+    # semaphore bounds the number of requests in flight, so that requests
+    # queued behind it do not time out waiting for a pooled connection
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(
+        total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+    )
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await asyncio.gather(
+            *[
+                _fetch_header(session, semaphore, url, retries, backoff)
+                for url in headers
+            ]
+        )
+
+
+def fetch_headers(
+    headers: List[str], concurrency: int = 32, retries: int = 3, backoff: float = 0.5
+) -> List[dict]:
+    """
+    Concurrently downloads json headers over a shared http session.
+
+    Parameters
+    ----------
+    headers: List[str]
+        urls to the json headers.
+    concurrency: int
+        maximum number of requests in flight at once.
+    retries: int
+        number of times to retry a header that fails to download.
+    backoff: float
+        seconds to wait before the first retry, doubled for each subsequent
+        retry.
+
+    Returns
+    -------
+    List[dict]
+        Parsed headers in the same order as the input urls.
+    """
+    return asyncio.run(_fetch_headers(headers, concurrency, retries, backoff))
+
+
+def combine_headers(
+    headers: List[str], concurrency: int = 32, retries: int = 3
+) -> dict:
+    """
+    Combines hourly json headers into a single reference dictionary. The
+    headers are prefetched concurrently and handed to MultiZarrToZarr in
+    memory rather than being read one at a time.
+
+    Parameters
+    ----------
+    headers: List[str]
+        urls to the json headers that will be combined.
+    concurrency: int
+        maximum number of headers downloaded at once.
+    retries: int
+        number of times to retry a header that fails to download.
+
+    Returns
+    -------
+    dict
+        kerchunk references for the combined dataset.
+    """
+    logging.info(f"Fetching {len(headers)} headers, {concurrency} at a time")
+    indicts = fetch_headers(headers, concurrency=concurrency, retries=retries)
+
+    mzz = MultiZarrToZarr(
+        headers,
+        indicts=indicts,
+        remote_protocol="s3",
+        remote_options=s3_options(),
+        concat_dims=["valid_time"],
+    )
+    return mzz.translate()
+
+
+def open_reference(
+    fo: Union[dict, str], chunks: Union[dict, None] = None
+) -> xarray.Dataset:
+    """
+    Lazily opens a kerchunk reference as an xarray Dataset.
+
+    Parameters
+    ----------
+    fo: Union[dict, str]
+        reference dictionary, path to a json reference file, or path to a
+        parquet reference directory.
+    chunks: dict
+        chunks passed to xarray.open_dataset. Use {} to open the variables
+        as dask arrays with the native zarr chunking.
+
+    Returns
+    -------
+    xarray.Dataset
+        Dataset backed by the references.
+    """
+    backend_args = {
+        "consolidated": False,
+        "storage_options": {
+            "fo": fo,
+            "remote_protocol": "s3",
+            "remote_options": s3_options(),
+        },
+    }
+    return xarray.open_dataset(
+        "reference://", engine="zarr", chunks=chunks, backend_kwargs=backend_args
+    )
+
+
+def reference_periods(
+    start_date: datetime, end_date: datetime, period: str
+) -> List[Tuple[str, datetime, datetime]]:
+    """
+    Splits a date range into the calendar months or years that overlap it.
+
+    Parameters
+    ----------
+    start_date: datetime.datetime
+        start of the date range.
+    end_date: datetime.datetime
+        end of the date range.
+    period: str
+        length of each period, either "month" or "year".
+
+    Returns
+    -------
+    List[Tuple[str, datetime.datetime, datetime.datetime]]
+        A name for each period along with its first and last hour.
+    """
+    periods = []
+    if period == "year":
+        for year in range(start_date.year, end_date.year + 1):
+            periods.append(
+                (f"{year}", datetime(year, 1, 1), datetime(year, 12, 31, 23))
+            )
+    elif period == "month":
+        year, month = start_date.year, start_date.month
+        while (year, month) <= (end_date.year, end_date.month):
+            first = datetime(year, month, 1)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+            last = datetime(year, month, 1) - timedelta(hours=1)
+            periods.append((first.strftime("%Y-%m"), first, last))
+    else:
+        raise ValueError(f"Unsupported reference period: {period}")
+    return periods
+
+
+def write_reference(refs: dict, path: Path, fmt: str) -> None:
+    """
+    Saves a reference dictionary to disk. Output is written to a temporary
+    location and moved into place so that concurrent jobs sharing a cache
+    never open a partially written reference.
+
+    Parameters
+    ----------
+    refs: dict
+        kerchunk references to save.
+    path: pathlib.Path
+        destination json file or parquet directory.
+    fmt: str
+        output format, either "json" or "parquet".
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+    if fmt == "json":
+        with open(tmp, "w") as f:
+            ujson.dump(refs, f)
+        os.replace(tmp, path)
+    elif fmt == "parquet":
+        # imported here so that fastparquet is only needed for parquet output
+        from kerchunk.df import refs_to_dataframe
+
+        refs_to_dataframe(refs, str(tmp))
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another job finished writing the same period first
+            shutil.rmtree(tmp, ignore_errors=True)
+    else:
+        raise ValueError(f"Unsupported reference format: {fmt}")
+
+
+def period_reference(
+    name: str,
+    start_date: datetime,
+    end_date: datetime,
+    s3bucket: str,
+    cache_dir: Path,
+    fmt: str,
+    concurrency: int = 32,
+    retries: int = 3,
+) -> Union[dict, str]:
+    """
+    Returns the combined reference for a single period, building and
+    caching it if it does not exist yet.
+
+    Parameters
+    ----------
+    name: str
+        name of the period, e.g. 2010 or 2010-01.
+    start_date: datetime.datetime
+        first hour of the period.
+    end_date: datetime.datetime
+        last hour of the period.
+    s3bucket: str
+        url to the s3 bucket containing aorc data.
+    cache_dir: pathlib.Path
+        root directory of the local cache.
+    fmt: str
+        format of the cached reference, either "json" or "parquet".
+    concurrency: int
+        maximum number of headers downloaded at once when building.
+    retries: int
+        number of times to retry a header that fails to download.
+
+    Returns
+    -------
+    Union[dict, str]
+        Path to the cached reference, or the reference dictionary itself if
+        the period is incomplete in the bucket and was therefore not cached.
+    """
+    suffix = "json" if fmt == "json" else "parq"
+    path = (
+        Path(cache_dir) / "references" / bucket_cache_name(s3bucket) / f"{name}.{suffix}"
+    )
+    if path.exists():
+        return str(path)
+
+    logging.info(f"Building combined reference for {name}")
+    headers = find_headers(start_date, end_date, s3bucket, cache_dir)
+    refs = combine_headers(headers, concurrency=concurrency, retries=retries)
+
+    # only cache periods that are completely available in the bucket, otherwise
+    # later runs would never see the hours that are added afterwards
+    expected = int((end_date - start_date) / timedelta(hours=1)) + 1
+    if len(headers) < expected:
+        logging.info(
+            f"Not caching reference for {name}, found {len(headers)} of "
+            f"{expected} hours"
+        )
+        return refs
+
+    write_reference(refs, path, fmt)
+    return str(path)
+
+
+def open_period_references(
+    start_date: datetime,
+    end_date: datetime,
+    s3bucket: str,
+    cache_dir: Path,
+    period: str,
+    fmt: str,
+    concurrency: int = 32,
+    retries: int = 3,
+) -> xarray.Dataset:
+    """
+    Opens the cached monthly or yearly references that overlap a date range
+    and lazily concatenates them along valid_time.
+
+    Parameters
+    ----------
+    start_date: datetime.datetime
+        start datetime for collecting aorc data.
+    end_date: datetime.datetime
+        end datetime for collecting aorc data.
+    s3bucket: str
+        url to the s3 bucket containing aorc data.
+    cache_dir: pathlib.Path
+        root directory of the local cache.
+    period: str
+        length of each cached reference, either "month" or "year".
+    fmt: str
+        format of the cached references, either "json" or "parquet".
+    concurrency: int
+        maximum number of headers downloaded at once when building.
+    retries: int
+        number of times to retry a header that fails to download.
+
+    Returns
+    -------
+    xarray.Dataset
+        Dataset covering start_date through end_date.
+    """
+    datasets = []
+    for name, st, et in reference_periods(start_date, end_date, period):
+        fo = period_reference(
+            name, st, et, s3bucket, cache_dir, fmt, concurrency, retries
+        )
+
+        # open with dask chunks so that concatenating the periods does not
+        # load any data
+        datasets.append(open_reference(fo, chunks={}))
+
+    if len(datasets) == 1:
+        ds = datasets[0]
+    else:
+        ds = xarray.concat(
+            datasets,
+            dim="valid_time",
+            data_vars="minimal",
+            coords="minimal",
+            compat="override",
+        )
+
+    return ds.sel(valid_time=slice(start_date, end_date))
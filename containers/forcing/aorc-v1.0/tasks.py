@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Distribution of the AORC save jobs across dask workers.
+
+Tasks only carry a small description of the dataset and the time range to
+save. Each worker process opens the clipped dataset once, the first time it
+receives a task, and reuses it for every later task. The dataset and its
+dask graph are therefore never serialized, and the scheduler is free to
+balance the groups between workers as they finish.
+"""
+
+import json
+import logging
+import threading
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import List, Tuple
+
+import xarray
+from dask.distributed import Client
+
+
+
+class Writer(str, Enum):
+    """choices of the --writer option of the entry script"""
+
+    stream = "stream"
+    batch = "batch"
+
+
+# datasets opened by this process, keyed by their serialized spec
+_DATASETS = {}
+_LOCK = threading.Lock()
+
+
+def worker_dataset(spec: dict) -> xarray.Dataset:
+    """
+    Returns the clipped dataset described by spec, opening it the first time
+    it is requested by this process.
+
+    Parameters
+    ----------
+    spec: dict
+        keyword arguments of entry.open_clipped_dataset.
+
+    Returns
+    -------
+    xarray.Dataset
+        The clipped dataset.
+    """
+    key = json.dumps(spec, sort_keys=True, default=str)
+    with _LOCK:
+        if key not in _DATASETS:
+            # imported here to avoid a circular import with the entry script
+            from entry import open_clipped_dataset
+
+            logging.info("Opening dataset on worker")
+            _DATASETS[key] = open_clipped_dataset(**spec)
+        return _DATASETS[key]
+
+
+def save_group(
+    start: datetime,
+    end: datetime,
+    spec: dict,
+    outpath: Path,
+    writer: str = "stream",
+    read_ahead: int = 1,
+    ledger: Path = None,
+    store: Path = None,
+    output_format: str = "hourly",
+) -> Tuple[datetime, datetime, bool]:
+    """
+    Saves a single group of timesteps to hourly files.
+
+    Parameters
+    ----------
+    start: datetime.datetime
+        first timestep of the group.
+    end: datetime.datetime
+        last timestep of the group.
+    spec: dict
+        keyword arguments of entry.open_clipped_dataset.
+    outpath: pathlib.Path
+        directory to save the hourly files in.
+    writer: str
+        "stream", "batch" or "zarr", see entry.stream_save, entry.batch_save
+        and consolidated.zarr_save.
+    read_ahead: int
+        number of blocks the streaming writer reads ahead.
+    ledger: pathlib.Path
+        ledger to record completed files in.
+    store: pathlib.Path
+        Zarr store to write into when writer is "zarr".
+    output_format: str
+        output format the hours are recorded under in the ledger.
+
+    Returns
+    -------
+    Tuple[datetime.datetime, datetime.datetime, bool]
+        The time range of the group and whether it was saved successfully.
+    """
+    from entry import batch_save, stream_save
+    from consolidated import zarr_save
+
+    try:
+        ds = worker_dataset(spec)
+    except Exception:
+        logging.exception(f"Failed to open dataset for {start} - {end}")
+        return (start, end, False)
+
+    # read the data with threads local to this worker rather than submitting
+    # the reads back to the cluster from inside a task. The scheduler is
+    # passed to each compute call, setting it in the dask config would change
+    # it for every task running in this worker process
+    if writer == "zarr":
+        return zarr_save(
+            [ds, start, end, outpath],
+            store,
+            ledger=ledger,
+            output_format=output_format,
+            scheduler="threads",
+        )
+    if writer == "stream":
+        return stream_save(
+            [ds, start, end, outpath],
+            read_ahead=read_ahead,
+            ledger=ledger,
+            scheduler="threads",
+        )
+    return batch_save([ds, start, end, outpath], ledger=ledger, scheduler="threads")
+
+
+def run_groups(
+    client: Client,
+    spec: dict,
+    groups: List[Tuple[datetime, datetime]],
+    outpath: Path,
+    writer: str = "stream",
+    read_ahead: int = 1,
+    ledger: Path = None,
+    store: Path = None,
+    output_format: str = "hourly",
+) -> List[Tuple[datetime, datetime, bool]]:
+    """
+    Submits one task per group of timesteps and waits for them to finish.
+
+    Parameters
+    ----------
+    client: dask.distributed.Client
+        client connected to the cluster that will run the tasks.
+    spec: dict
+        keyword arguments of entry.open_clipped_dataset.
+    groups: List[Tuple[datetime.datetime, datetime.datetime]]
+        first and last timestep of each group.
+    outpath: pathlib.Path
+        directory to save the hourly files in.
+    writer: str
+        "stream", "batch" or "zarr".
+    read_ahead: int
+        number of blocks the streaming writer reads ahead.
+    ledger: pathlib.Path
+        ledger to record completed files in.
+    store: pathlib.Path
+        Zarr store to write into when writer is "zarr".
+    output_format: str
+        output format the hours are recorded under in the ledger.
+
+    Returns
+    -------
+    List[Tuple[datetime.datetime, datetime.datetime, bool]]
+        The result of each group, in the order they were submitted.
+    """
+    logging.info(f"Submitting {len(groups)} group(s)")
+
+    starts, ends = zip(*groups)
+    futures = client.map(
+        save_group,
+        starts,
+        ends,
+        spec=spec,
+        outpath=outpath,
+        writer=writer,
+        read_ahead=read_ahead,
+        ledger=ledger,
+        store=store,
+        output_format=output_format,
+        pure=False,
+    )
+    return client.gather(futures)
@@ -0,0 +1,76 @@
+import sys
+from pathlib import Path
+
+import numpy
+import pandas
+import pytest
+import xarray
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from consolidated import init_store, zarr_save  # noqa: E402
+from ledger import pending_groups  # noqa: E402
+
+
+def forcing(start="2020-01-01T00", periods=12, nx=4):
+    """hourly dataset laid out like the clipped forcing, with values that
+    identify their hour"""
+    times = pandas.date_range(start, periods=periods, freq="h")
+    hours = ((times - pandas.Timestamp("2020-01-01")) // pandas.Timedelta("1h")).values
+    data = numpy.broadcast_to(
+        hours[:, None, None].astype("float32"), (periods, 3, nx)
+    ).copy()
+    return xarray.Dataset(
+        {"APCP_surface": (("time", "y", "x"), data)},
+        coords={
+            "time": times,
+            "y": numpy.arange(3) * 1000.0,
+            "x": numpy.arange(nx) * 1000.0,
+        },
+    ).chunk({"time": 1})
+
+
+def write_all(ds, store, timesteps_per_group, offset):
+    times = pandas.DatetimeIndex(ds.time.values)
+    for start, end in pending_groups(times, set(), timesteps_per_group, offset):
+        assert zarr_save((ds, start, end), store, scheduler="synchronous")[2]
+
+
+def test_resume_with_later_start(tmp_path):
+    store = tmp_path / "aorc.zarr"
+    full = forcing()
+    tpg, offset = init_store(full, store, 4, compression_level=1)
+    assert (tpg, offset) == (4, 0)
+
+    # the first run only wrote the first group before being interrupted
+    start, end = pending_groups(pandas.DatetimeIndex(full.time.values), set(), tpg)[0]
+    assert zarr_save((full, start, end), store, scheduler="synchronous")[2]
+
+    # the job is resumed with a start date inside the store
+    resumed = forcing("2020-01-01T06", periods=6)
+    tpg, offset = init_store(resumed, store, 3, compression_level=1)
+    assert (tpg, offset) == (4, 6)
+
+    # groups stay on the chunks of the store
+    groups = pending_groups(pandas.DatetimeIndex(resumed.time.values), set(), tpg, offset)
+    assert [(s.hour, e.hour) for s, e in groups] == [(6, 7), (8, 11)]
+    write_all(resumed, store, tpg, offset)
+
+    out = xarray.open_zarr(store)
+    values = out.APCP_surface.values[:, 0, 0]
+    numpy.testing.assert_array_equal(values[:4], numpy.arange(4))
+    assert numpy.isnan(values[4:6]).all()
+    numpy.testing.assert_array_equal(values[6:], numpy.arange(6, 12))
+
+
+def test_resume_outside_store(tmp_path):
+    store = tmp_path / "aorc.zarr"
+    init_store(forcing(), store, 4, compression_level=1)
+
+    # hours after the end of the store would be dropped
+    with pytest.raises(ValueError, match="does not contain"):
+        init_store(forcing("2020-01-01T06", periods=12), store, 4, compression_level=1)
+
+    # a different watershed does not fit the grid of the store
+    with pytest.raises(ValueError, match="x coordinates"):
+        init_store(forcing(nx=5), store, 4, compression_level=1)
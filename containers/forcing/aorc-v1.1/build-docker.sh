@@ -1,5 +1,10 @@
 #!/bin/bash
 
-docker build -f Dockerfile -t cuahsi/pandas-dask:latest .
-
+# instrumentation.py is shared by the containers and lives in containers/common,
+# copy it into the build context for the duration of the build
+cp ../../common/instrumentation.py instrumentation.py
+trap 'rm -f instrumentation.py' EXIT
 
+docker build -f Dockerfile \
+    -t cuahsi/pandas-dask:latest \
+    -t us-central1-docker.pkg.dev/apps-320517/subsetter/aorc:0.0.3 .
@@ -1,27 +1,222 @@
 #!/usr/bin/env python3
 
 import os
+import dask
+import shutil
+import hashlib
 import fsspec
+import numpy as np
 import xarray as xr
 import geopandas
-from time import perf_counter
+from pathlib import Path
+from rasterio import features
+from numcodecs import Blosc
 from dask.distributed import Client
+from instrumentation import metrics_from_env, path_size
 
+OUTPUT_FORMATS = ['netcdf', 'netcdf-monthly', 'zarr']
 
-class catchtime:
-    def __init__(self, msg):
-        self.msg = msg + '...'
-    def __enter__(self):
-        print(self.msg, end='', flush=True)
-        self.start = perf_counter()
-        return self
 
-    def __exit__(self, type, value, traceback):
-        self.time = perf_counter() - self.start
-        self.readout = f'{self.time:.3f} seconds'
-        print(self.readout)
+def mask_key(gdf, ds):
+    """hash of the geometries, target grid and crs used to rasterize a mask"""
+    h = hashlib.sha256()
+    for geom in gdf.geometry.values:
+        h.update(geom.wkb)
+    h.update(ds.rio.crs.to_wkt().encode('utf-8'))
+    h.update(np.ascontiguousarray(ds[ds.rio.x_dim].values, dtype='float64').tobytes())
+    h.update(np.ascontiguousarray(ds[ds.rio.y_dim].values, dtype='float64').tobytes())
+    return h.hexdigest()
 
-def collect_data():
+
+def load_mask(gdf, ds, cache_dir):
+    """
+    Returns the boolean watershed mask and the (row, col) window of ds that
+    it covers. Masks are cached in cache_dir keyed by mask_key so repeated
+    requests for the same watershed skip rasterizing the geometries.
+    """
+    gdf = gdf.to_crs(ds.rio.crs)
+    path = Path(cache_dir) / f'{mask_key(gdf, ds)}.npz'
+    if path.exists():
+        with np.load(path) as f:
+            return f['mask'], slice(*f['rows'].tolist()), slice(*f['cols'].tolist())
+
+    mask = features.geometry_mask(gdf.geometry.values,
+                                  out_shape=(ds.rio.height, ds.rio.width),
+                                  transform=ds.rio.transform(recalc=True),
+                                  invert=True)
+    rows = np.nonzero(mask.any(axis=1))[0]
+    cols = np.nonzero(mask.any(axis=0))[0]
+    if len(rows) == 0:
+        raise ValueError('No data found in bounds of the input geometries')
+    rows = slice(int(rows[0]), int(rows[-1]) + 1)
+    cols = slice(int(cols[0]), int(cols[-1]) + 1)
+    mask = mask[rows, cols]
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.stem}.{os.getpid()}.tmp.npz')
+    np.savez(tmp, mask=mask,
+             rows=np.array([rows.start, rows.stop]),
+             cols=np.array([cols.start, cols.stop]))
+    os.replace(tmp, path)
+    return mask, rows, cols
+
+
+def parse_chunks(value):
+    """parses a chunk shape such as 'time:720,latitude:128,longitude:128'"""
+    chunks = {}
+    for item in value.split(','):
+        dim, size = item.split(':')
+        chunks[dim.strip()] = int(size)
+    return chunks
+
+
+def uniform_chunks(ds):
+    """
+    Returns the largest dask chunk of every chunked dimension of ds. Selecting
+    a window of the source store leaves the first and last chunks of a
+    dimension smaller than the rest, which zarr cannot store, so ds is
+    rechunked to these sizes before it is written to zarr.
+    """
+    return {dim: max(sizes) for dim, sizes in ds.chunks.items()}
+
+
+def output_encoding(ds, output_format, compression_level):
+    """
+    Returns the encoding of every data variable for the output format. Chunks
+    are the largest dask chunk along each dimension, as in uniform_chunks,
+    since the first chunk of a window can be a single cell. The chunking and
+    compression inherited from the source store are replaced in the
+    returned encoding, the encoding of the variables of ds is left as is.
+    """
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        encoding[name] = {
+            key: value for key, value in var.encoding.items()
+            if key not in ('chunks', 'preferred_chunks', 'compressor', 'filters')
+        }
+        chunks = None if var.chunks is None else tuple(max(c) for c in var.chunks)
+        if output_format == 'zarr':
+            encoding[name]['compressor'] = Blosc(cname='zstd',
+                                                 clevel=compression_level,
+                                                 shuffle=Blosc.BITSHUFFLE)
+            if chunks is not None:
+                encoding[name]['chunks'] = chunks
+        else:
+            encoding[name]['zlib'] = compression_level > 0
+            encoding[name]['complevel'] = compression_level
+            if chunks is not None:
+                encoding[name]['chunksizes'] = chunks
+    return encoding
+
+
+def save_netcdf(ds, output_file, compression_level):
+    """writes ds to a single netcdf file through one file handle"""
+    encoding = output_encoding(ds, 'netcdf', compression_level)
+    write_job = ds.to_netcdf(output_file,
+                             mode='w',
+                             format='NETCDF4',
+                             encoding=encoding,
+                             compute=False)
+    write_job.compute()
+    return [output_file]
+
+
+def save_netcdf_monthly(ds, output_file, compression_level):
+    """
+    Writes one netcdf file per month next to output_file. Every shard has its
+    own file handle, so the shards are written by the dask workers in
+    parallel instead of waiting on a single hdf5 lock.
+    """
+    output_file = Path(output_file)
+    months, shards = zip(*ds.groupby(ds.time.dt.strftime('%Y%m').rename('month')))
+    paths = [output_file.with_name(f'{output_file.stem}_{m}{output_file.suffix}')
+             for m in months]
+    write_jobs = []
+    for shard, path in zip(shards, paths):
+        shard = shard.drop_vars('month', errors='ignore')
+        encoding = output_encoding(shard, 'netcdf', compression_level)
+        write_jobs.append(shard.to_netcdf(path,
+                                          mode='w',
+                                          format='NETCDF4',
+                                          encoding=encoding,
+                                          compute=False))
+    dask.compute(*write_jobs)
+    return paths
+
+
+def save_zarr(ds, output_file, compression_level):
+    """
+    Writes ds to a zarr store next to output_file. ds is first rechunked to
+    uniform chunks, then each dask chunk is a zarr chunk, so every worker
+    writes its chunks directly without locking.
+    """
+    store = Path(output_file).with_suffix('.zarr')
+    ds = ds.chunk(uniform_chunks(ds))
+    encoding = output_encoding(ds, 'zarr', compression_level)
+    ds.to_zarr(store, mode='w', encoding=encoding, consolidated=True)
+    return [store]
+
+
+def merge_outputs(paths, output_file, output_format, compression_level):
+    """merges the shards or zarr store into a single netcdf file"""
+    if output_format == 'zarr':
+        ds = xr.open_zarr(paths[0])
+    else:
+        ds = xr.open_mfdataset(paths, combine='by_coords')
+    encoding = {name: {'zlib': compression_level > 0,
+                       'complevel': compression_level}
+                for name in ds.data_vars}
+    ds.to_netcdf(output_file,
+                 mode='w',
+                 format='NETCDF4',
+                 unlimited_dims=['time'],
+                 encoding=encoding)
+    ds.close()
+
+    # the intermediate outputs are no longer needed
+    for path in paths:
+        if Path(path).is_dir():
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def parse_bbox(value):
+    """parses a bounding box such as 'west,south,east,north'"""
+    return tuple(float(v) for v in value.split(','))
+
+
+def index_range(index, lo, hi):
+    """
+    Returns the slice of positions in a monotonic index that fall between lo
+    and hi, whether the index is increasing or decreasing.
+    """
+    if index.is_monotonic_decreasing and not index.is_monotonic_increasing:
+        return index.slice_indexer(hi, lo)
+    return index.slice_indexer(lo, hi)
+
+
+def selection_window(ds, start_date, end_date, bbox, buffer=1):
+    """
+    Resolves a time range and a bounding box to index ranges of ds. The
+    coordinates are read from the consolidated metadata, so this runs before
+    any data is touched, and selecting with the result keeps every chunk
+    outside of the window out of the dask graph. The spatial window is
+    padded by buffer cells so that cells on the edge of the bounding box
+    are kept for clipping.
+    """
+    window = {'time': index_range(ds.get_index('time'), start_date, end_date)}
+    west, south, east, north = bbox
+    for dim, lo, hi in ((ds.rio.x_dim, west, east), (ds.rio.y_dim, south, north)):
+        rng = index_range(ds.get_index(dim), lo, hi)
+        if rng.stop <= rng.start:
+            raise ValueError('No data found in bounds of the input geometries')
+        window[dim] = slice(max(rng.start - buffer, 0),
+                            min(rng.stop + buffer, ds.sizes[dim]))
+    return window
+
+
+def collect_data(metrics):
     bucket_url = os.environ["BUCKET_URL"]
     key=os.environ["KEY"]
     secret=os.environ["SECRET"]
@@ -29,35 +224,66 @@ def collect_data():
     start_date=os.environ["START_DATE"]
     end_date=os.environ["END_DATE"]
     output_file=os.environ["OUTPUT_FILE"]
+    mask_cache_dir=os.environ.get("MASK_CACHE_DIR")
+    output_format=os.environ.get("OUTPUT_FORMAT", "netcdf")
+    merge_output=os.environ.get("MERGE_OUTPUT", "false").lower() == "true"
+    compression_level=int(os.environ.get("COMPRESSION_LEVEL", "0"))
+    output_chunks=os.environ.get("OUTPUT_CHUNKS")
+    bbox=os.environ.get("BBOX")
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'OUTPUT_FORMAT must be one of {OUTPUT_FORMATS}')
 
-    with catchtime('loading zarr'):
+    with metrics.stage('loading zarr'):
         ds = xr.open_zarr(fsspec.get_mapper(bucket_url,
                               anon=False,
                               key=key,
                               secret=secret), consolidated=True)
 
-    with catchtime('clipping zarr'):
+    with metrics.stage('slicing zarr'):
         gdf = geopandas.read_file(shape_file)
         ds.rio.write_crs('EPSG:4326', inplace=True)
-        ds = ds.rio.clip(gdf.geometry.values,
-                          gdf.crs,
-                          drop=True,
-                          invert=False, from_disk=True)
+        if not bbox:
+            bbox = gdf.to_crs(ds.rio.crs).total_bounds
+        else:
+            bbox = parse_bbox(bbox)
+        window = selection_window(ds, start_date, end_date, bbox)
+        ds = ds.isel(window)
 
+    with metrics.stage('clipping zarr'):
+        if mask_cache_dir is None:
+            ds = ds.rio.clip(gdf.geometry.values,
+                              gdf.crs,
+                              drop=True,
+                              invert=False, from_disk=True)
+        else:
+            mask, rows, cols = load_mask(gdf, ds, mask_cache_dir)
+            y_dim, x_dim = ds.rio.y_dim, ds.rio.x_dim
+            ds = ds.isel({y_dim: rows, x_dim: cols})
+            ds = ds.where(xr.DataArray(mask, dims=(y_dim, x_dim)))
 
-    with catchtime('slicing zarr'):
-        ds = ds.sel(time=slice(start_date, end_date))
+    if output_chunks is not None:
+        # align the dask chunks with the output chunks so that no two tasks
+        # write to the same chunk
+        ds = ds.chunk(parse_chunks(output_chunks))
 
-    with catchtime('saving netcdf'):
-        write_job = ds.to_netcdf(output_file,
-                             mode='w',
-                             format='NETCDF4',
-                             compute=False)
-        write_job.compute()
+    save = {'netcdf': save_netcdf,
+            'netcdf-monthly': save_netcdf_monthly,
+            'zarr': save_zarr}[output_format]
+    with metrics.stage(f'saving {output_format}') as rec:
+        paths = save(ds, output_file, compression_level)
+        rec['bytes_written'] = sum(path_size(p) for p in paths)
+
+    if merge_output and output_format != 'netcdf':
+        with metrics.stage('merging outputs') as rec:
+            merge_outputs(paths, output_file, output_format, compression_level)
+            rec['bytes_written'] = path_size(output_file)
 
 
 if __name__ == '__main__':
     n_workers = int(os.environ['N_WORKERS'])
     memory_limit = os.environ['MEMORY_LIMIT']
     client = Client(n_workers=n_workers, memory_limit=memory_limit)
-    collect_data()
+    metrics = metrics_from_env('aorc-v1.1', client=client)
+    collect_data(metrics)
+    metrics.finish()
@@ -0,0 +1,83 @@
+import sys
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import rioxarray  # noqa: F401, registers the rio accessor
+
+HERE = Path(__file__).parent
+sys.path.insert(0, str(HERE))
+sys.path.insert(0, str(HERE.parent.parent / 'common'))
+
+# the collector is a script with dashes in its name, load it by path
+spec = importlib.util.spec_from_file_location(
+    'collect_aorc', HERE / 'collect-aorc-forcing-v1.1.py'
+)
+collect = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(collect)
+
+
+def source_dataset(tmp_path):
+    """small store laid out like the aorc v1.1 zarr, opened lazily"""
+    times = pd.date_range('2020-01-01', periods=48, freq='h')
+    lat = np.arange(30.0, 40.0, 0.25)
+    lon = np.arange(-100.0, -90.0, 0.25)
+    data = np.random.default_rng(0).random((len(times), len(lat), len(lon)))
+    ds = xr.Dataset(
+        {'APCP_surface': (('time', 'latitude', 'longitude'), data.astype('float32'))},
+        coords={'time': times, 'latitude': lat, 'longitude': lon},
+    )
+    ds.chunk({'time': 24, 'latitude': 16, 'longitude': 16}).to_zarr(
+        tmp_path / 'source.zarr', consolidated=True
+    )
+    ds = xr.open_zarr(tmp_path / 'source.zarr', consolidated=True)
+    ds.rio.write_crs('EPSG:4326', inplace=True)
+    return ds
+
+
+def test_save_zarr_bbox_subset(tmp_path):
+    ds = source_dataset(tmp_path)
+    window = collect.selection_window(
+        ds, '2020-01-01T05:00', '2020-01-02T07:00', (-97.3, 32.1, -93.6, 36.8)
+    )
+    subset = ds.isel(window)
+
+    # the window starts inside source chunks, leaving irregular dask chunks
+    assert any(c[0] != max(c) for c in subset.chunks.values())
+
+    paths = collect.save_zarr(subset, tmp_path / 'out.nc', compression_level=1)
+
+    out = xr.open_zarr(paths[0])
+    expected = xr.open_zarr(tmp_path / 'source.zarr').isel(window)
+    assert out.APCP_surface.shape == expected.APCP_surface.shape
+    np.testing.assert_array_equal(out.APCP_surface.values,
+                                  expected.APCP_surface.values)
+    chunks = out.APCP_surface.encoding['chunks']
+    assert chunks == tuple(max(c) for c in subset.APCP_surface.chunks)
+    compressor = out.APCP_surface.encoding['compressor']
+    assert (compressor.cname, compressor.clevel) == ('zstd', 1)
+
+
+@pytest.mark.parametrize('save', ['save_netcdf', 'save_netcdf_monthly'])
+def test_save_netcdf_encoding(tmp_path, save):
+    ds = source_dataset(tmp_path)
+    window = collect.selection_window(
+        ds, '2020-01-01T05:00', '2020-01-02T07:00', (-97.3, 32.1, -93.6, 36.8)
+    )
+    subset = ds.isel(window)
+    inherited = dict(subset.APCP_surface.encoding)
+
+    paths = getattr(collect, save)(subset, tmp_path / 'out.nc', compression_level=4)
+
+    # the hdf5 chunks are the full dask chunks, not the partial first ones
+    for path in paths:
+        with xr.open_dataset(path) as out:
+            encoding = out.APCP_surface.encoding
+            assert encoding['chunksizes'] == tuple(
+                max(c) for c in subset.APCP_surface.chunks
+            )
+            assert encoding['zlib'] and encoding['complevel'] == 4
+    assert subset.APCP_surface.encoding == inherited
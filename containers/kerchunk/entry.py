@@ -1,38 +1,622 @@
 #!/usr/bin/env python3
 
+import os
+import shutil
 import ujson
+import base64
+import hashlib
+import threading
 import typer
 import fsspec
 import typing
 import kerchunk.hdf
 from tqdm import tqdm
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from kerchunk.netCDF3 import NetCDF3ToZarr
 from kerchunk.hdf import SingleHdf5ToZarr
+from kerchunk.combine import MultiZarrToZarr
+from instrumentation import metrics_from_env, path_size
 
-def main(indir: Path = typer.Argument(..., help='directory of input files to process'), 
-         outdir: Path = typer.Argument(Path("/tmp"), help="directory to save output")):
-       
-    kerchunk_directory_of_files(indir, outdir)
+# leading bytes that identify each supported file format
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+NETCDF3_SIGNATURES = (b'CDF\x01', b'CDF\x02')
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
 
+# default size in bytes below which chunks are stored inside the references
+INLINE_THRESHOLD = 100
 
-def kerchunk_directory_of_files(indir:  Path = Path('.'),
-                                outdir: Path = Path('/tmp')) -> None:
-    
+COMBINED_FORMATS = ['parquet', 'json']
+COMBINED_NAMES = {'parquet': 'combined.parq', 'json': 'combined.json'}
+
+# per-file references are written as json, or as parquet sharded by variable
+# when a file has more references than the shard threshold and the format is
+# auto, so readers can load the variables they need without parsing the rest
+REFERENCE_FORMATS = ['auto', 'json', 'parquet']
+SHARD_THRESHOLD = 100000
+
+# remote inputs are read through fsspec with a block cache, so only the byte
+# ranges holding headers and chunk offsets are fetched rather than whole files
+BLOCK_SIZE = 1 << 20
+CACHE_TYPES = ['blockcache', 'readahead', 'bytes', 'first', 'none']
+
+# sidecar file in the output directory that records the inputs that have
+# been indexed, used by the incremental mode
+STATE_NAME = '.kerchunk-state.json'
+
+# names of the dimension that files are usually combined along, in order of
+# preference
+CONCAT_CANDIDATES = ['time', 'valid_time', 'reference_time', 'Time', 't']
+
+def main(indir: str = typer.Argument(..., help='directory of input files to process, '
+                                               'a local path or an s3://, gs:// or '
+                                               'https:// url'),
+         outdir: Path = typer.Argument(Path("/tmp"), help="directory to save output"),
+         workers: int = typer.Option(1, help="number of processes used to index files"),
+         concurrency: int = typer.Option(1, help="number of threads used to index files "
+                                                 "when --workers is 1, for remote inputs"),
+         block_size: int = typer.Option(BLOCK_SIZE, help="bytes fetched per request "
+                                                         "from remote inputs"),
+         cache_type: str = typer.Option('blockcache', help="fsspec cache for remote inputs: "
+                                                           "blockcache, readahead, bytes, "
+                                                           "first or none"),
+         storage_options: str = typer.Option('{}', help="json object of fsspec options for "
+                                                        "remote inputs, e.g. "
+                                                        '{"anon": true}'),
+         inline_threshold: int = typer.Option(INLINE_THRESHOLD,
+                                              help="chunks smaller than this many bytes are "
+                                                   "stored inside the references, 0 to disable"),
+         combine: bool = typer.Option(False, help="also write a single reference that "
+                                                  "combines every file"),
+         concat_dim: typing.Optional[str] = typer.Option(None, help="dimension to combine "
+                                                                    "along, detected if not set"),
+         combined_format: str = typer.Option('parquet', help="format of the combined "
+                                                             "reference: parquet or json"),
+         reference_format: str = typer.Option('auto', help="format of the per-file "
+                                                           "references: json, parquet or auto"),
+         shard_threshold: int = typer.Option(SHARD_THRESHOLD, help="files with more references "
+                                                                   "than this are written as "
+                                                                   "parquet in auto format"),
+         record_size: int = typer.Option(10000, help="number of references per parquet file"),
+         incremental: bool = typer.Option(False, help="only index files that are new or "
+                                                      "changed since the last run")):
+
+    if combined_format not in COMBINED_FORMATS:
+        raise typer.BadParameter(f'combined format must be one of {COMBINED_FORMATS}')
+    if reference_format not in REFERENCE_FORMATS:
+        raise typer.BadParameter(f'reference format must be one of {REFERENCE_FORMATS}')
+    if cache_type not in CACHE_TYPES:
+        raise typer.BadParameter(f'cache type must be one of {CACHE_TYPES}')
+
+    options = remote_options(indir, ujson.loads(storage_options),
+                             block_size=block_size, cache_type=cache_type)
+
+    metrics = metrics_from_env("kerchunk")
+    names, changed, deleted = kerchunk_directory_of_files(indir, outdir, metrics,
+                                                          workers=workers,
+                                                          inline_threshold=inline_threshold,
+                                                          incremental=incremental,
+                                                          concurrency=concurrency,
+                                                          storage_options=options,
+                                                          reference_format=reference_format,
+                                                          shard_threshold=shard_threshold,
+                                                          record_size=record_size)
+    combined = None
+    if not changed and (outdir/COMBINED_NAMES[combined_format]).exists():
+        print('No inputs changed, keeping the combined reference')
+    elif combine and len(names) > 0:
+        with metrics.stage('combining') as rec:
+            combined = combine_references([outdir/n for n in names], outdir,
+                                          concat_dim=concat_dim,
+                                          fmt=combined_format,
+                                          record_size=record_size)
+            rec['bytes_written'] = path_size(combined)
+
+    # combined references left by earlier runs still point at the deleted
+    # inputs, drop any that were not just rebuilt
+    if deleted:
+        for name in COMBINED_NAMES.values():
+            if outdir/name != combined and (outdir/name).exists():
+                print(f'Removing {name}, it references deleted inputs')
+                remove_reference(outdir/name)
+    metrics.finish()
+
+
+def detect_concat_dim(refs: dict) -> str:
+    """
+    Picks the dimension to combine references along: the first of the usual
+    time dimension names that is present, otherwise a one dimensional
+    coordinate with CF time units.
+    """
+    refs = refs.get('refs', refs)
+    for name in CONCAT_CANDIDATES:
+        if f'{name}/.zarray' in refs:
+            return name
+    for key in refs:
+        name = key[:-len('/.zattrs')]
+        if key.endswith('/.zattrs') and is_cf_time(refs, name):
+            return name
+    raise ValueError('could not detect a dimension to combine along, '
+                     'set one with --concat-dim')
+
+
+def is_cf_time(refs: dict, name: str) -> bool:
+    """whether name is a one dimensional coordinate with CF time units"""
+    refs = refs.get('refs', refs)
+    attrs = refs.get(f'{name}/.zattrs', '{}')
+    attrs = ujson.loads(attrs) if isinstance(attrs, str) else attrs
+    return ' since ' in str(attrs.get('units', '')) and \
+        attrs.get('_ARRAY_DIMENSIONS') == [name]
+
+
+def combine_references(paths: typing.List[Path], outdir: Path,
+                       concat_dim: typing.Optional[str] = None,
+                       fmt: str = 'parquet',
+                       record_size: int = 10000) -> Path:
+    """
+    Combines per-file references into a single reference along concat_dim,
+    replacing any previous combined reference in outdir. Parquet output can
+    be opened lazily, one record at a time, through fsspec's
+    LazyReferenceMapper so large datasets open without parsing every
+    reference up front.
+    """
+    paths = sorted(str(p) for p in paths)
+    first = load_metadata(paths[0])
+    if concat_dim is None:
+        concat_dim = detect_concat_dim(first)
+
+    # time coordinates are decoded so that files whose times are stored
+    # relative to different reference dates are combined correctly
+    coo_map = None
+    if is_cf_time(first, concat_dim):
+        coo_map = {concat_dim: f'cf:{concat_dim}'}
+
+    print(f'Combining {len(paths)} references along {concat_dim}')
+    # parquet references are loaded into memory first, MultiZarrToZarr only
+    # opens json references itself
+    paths = [load_references(p) if os.path.isdir(p) else p for p in paths]
+    refs = MultiZarrToZarr(paths, concat_dims=[concat_dim],
+                           coo_map=coo_map).translate()
+
+    outpath = outdir/COMBINED_NAMES[fmt]
+    write_references(refs, outpath, fmt, record_size=record_size)
+    return outpath
+
+
+def count_references(refs: dict) -> int:
+    """number of keys in a reference set, metadata and chunks"""
+    return len(refs.get('refs', refs))
+
+
+def write_json(refs: dict, path: Path) -> None:
+    """
+    Writes a reference set as json one key at a time, so the encoded form
+    of the whole set is never held in memory next to the references.
+    """
+    top = refs if 'refs' in refs else {'version': 1, 'refs': refs}
+    with open(path, 'w') as f:
+        f.write('{')
+        for key, value in top.items():
+            if key != 'refs':
+                f.write(f'{ujson.dumps(key)}:{ujson.dumps(value)},')
+        f.write('"refs":{')
+        for i, (key, value) in enumerate(top['refs'].items()):
+            if i > 0:
+                f.write(',')
+            f.write(f'{ujson.dumps(key)}:{ujson.dumps(value)}')
+        f.write('}}')
+
+
+def write_references(refs: dict, outpath: Path, fmt: str,
+                     record_size: int = 10000) -> None:
+    """
+    Writes a reference set as a json file or a parquet directory, replacing
+    any previous output at outpath. Parquet output holds one directory of
+    record files per variable, which fsspec's LazyReferenceMapper opens one
+    variable and record at a time.
+    """
+    tmp = outpath.with_name(f'.{outpath.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    if fmt == 'parquet':
+        # imported here so that fastparquet is only needed for parquet output
+        from kerchunk.df import refs_to_dataframe
+        refs_to_dataframe(refs, str(tmp), record_size=record_size)
+    else:
+        write_json(refs, tmp)
+
+    # move the previous reference aside so that the new one replaces it in
+    # a single rename, an interrupted job never leaves a partial reference
+    old = outpath.with_name(f'.{outpath.name}.{os.getpid()}.{threading.get_ident()}.old')
+    if outpath.exists():
+        os.rename(outpath, old)
+    os.rename(tmp, outpath)
+    remove_reference(old)
+
+
+def remove_reference(path: Path) -> None:
+    """removes a json or parquet reference, if it exists"""
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def load_references(path: str) -> dict:
+    """loads every reference of a parquet directory into a dict"""
+    from fsspec.implementations.reference import LazyReferenceMapper
+    mapper = LazyReferenceMapper(path)
     refs = {}
-    fs = fsspec.filesystem('')
-    flist = fs.glob(f'{indir}/*')
-    with tqdm(total=len(flist)) as pbar:
-        for f in flist:
-            fname = Path(f).name
-            refs[fname] = NetCDF3ToZarr(f).translate()
-            pbar.update(1)
-        pbar.close()
-
-    for name, ref_json in refs.items():
-        outname = '.'.join(name.split('.')[0:-1]) + '.json'
-        with open(outdir/outname, 'w') as outf:
-            ujson.dump(ref_json, outf)
+    for key in mapper:
+        if key == '.zmetadata':
+            continue
+        value = mapper[key]
+        if isinstance(value, bytes):
+            try:
+                value = value.decode()
+            except UnicodeDecodeError:
+                value = 'base64:' + base64.b64encode(value).decode()
+        elif isinstance(value, list):
+            # offsets and sizes come back as numpy integers
+            value = [value[0]] + [int(v) for v in value[1:]]
+        refs[key] = value
+    return {'version': 1, 'refs': refs}
+
+
+def load_metadata(path: str) -> dict:
+    """
+    Loads the references of a json file, or only the zarr metadata of a
+    parquet directory, which is all that is needed to pick the dimension to
+    combine along.
+    """
+    if os.path.isdir(path):
+        with open(os.path.join(path, '.zmetadata')) as f:
+            return {'refs': ujson.load(f)['metadata']}
+    with open(path) as f:
+        return ujson.load(f)
+
+
+def remote_options(url: str, storage_options: dict,
+                   block_size: int = BLOCK_SIZE,
+                   cache_type: str = 'blockcache') -> dict:
+    """
+    Adds the block size and cache type to the fsspec options of a remote
+    url, under the names its filesystem expects. The kerchunk translators
+    open files with fsspec.open, which passes these options to the
+    filesystem rather than to the file, so the cache is configured there.
+    Local paths need no options.
+    """
+    protocol, _ = fsspec.core.split_protocol(url)
+    options = dict(storage_options)
+    if protocol in ('s3', 's3a'):
+        options.setdefault('default_block_size', block_size)
+        options.setdefault('default_cache_type', cache_type)
+    elif protocol in ('gs', 'gcs'):
+        # gcsfs has no filesystem wide cache type
+        options.setdefault('block_size', block_size)
+    elif protocol in ('http', 'https'):
+        options.setdefault('block_size', block_size)
+        options.setdefault('cache_type', cache_type)
+    return options
+
+
+def list_inputs(indir: str, storage_options: dict) -> typing.Dict[str, dict]:
+    """
+    Lists the files in a local directory or below a remote url, returning
+    the fsspec info of each, keyed by local path or full url.
+    """
+    fs, root = fsspec.core.url_to_fs(indir, **storage_options)
+    protocol, _ = fsspec.core.split_protocol(indir)
+    # filesystem instances are shared, so drop any listing cached by an
+    # earlier call in this process
+    fs.invalidate_cache(root)
+    infos = fs.glob(f'{root.rstrip("/")}/*', detail=True)
+    inputs = {}
+    for path, info in sorted(infos.items()):
+        if info.get('type') == 'directory':
+            continue
+        # object stores list keys without their protocol
+        if protocol not in (None, 'file') and '://' not in path:
+            path = f'{protocol}://{path}'
+        inputs[path] = info
+    return inputs
+
+
+def is_local(path: str) -> bool:
+    """whether path is on the local filesystem"""
+    return fsspec.core.split_protocol(path)[0] in (None, 'file')
+
+
+def sniff_format(path: str,
+                 storage_options: typing.Optional[dict] = None) -> typing.Optional[str]:
+    """
+    Identifies the format of a file from its leading bytes. Returns 'hdf5'
+    (which includes NetCDF4), 'netcdf3', 'grib2', 'tiff' or None.
+    """
+    with fsspec.open(path, 'rb', **(storage_options or {})) as f:
+        head = f.read(8)
+
+        if head[:4] in NETCDF3_SIGNATURES:
+            return 'netcdf3'
+        if head[:4] == b'GRIB' and len(head) == 8 and head[7] == 2:
+            return 'grib2'
+        if head[:4] in TIFF_SIGNATURES:
+            return 'tiff'
+
+        # the hdf5 superblock is at the start of the file or, when the file
+        # has a user block, at the next power of two from 512 bytes on
+        offset = 0
+        size = f.seek(0, os.SEEK_END)
+        # only look as far as the first few candidates of a remote file
+        # rather than probing every power of two
+        if not is_local(path):
+            size = min(size, 1 << 16)
+        while offset + 8 <= size:
+            f.seek(offset)
+            if f.read(8) == HDF5_SIGNATURE:
+                return 'hdf5'
+            offset = 512 if offset == 0 else offset * 2
+    return None
+
+
+def translate(f: str, fmt: str, inline_threshold: int,
+              storage_options: typing.Optional[dict] = None
+              ) -> typing.List[typing.Tuple[str, dict]]:
+    """
+    Generates the references of a file with the kerchunk translator for its
+    format. Returns (name, references) pairs, more than one for GRIB2 files
+    that contain messages on several grids or levels.
+    """
+    name = reference_name(f)
+    storage_options = storage_options or {}
+    if fmt == 'hdf5':
+        with fsspec.open(f, 'rb', **storage_options) as h5f:
+            refs = SingleHdf5ToZarr(h5f, url=f,
+                                    inline_threshold=inline_threshold).translate()
+        return [(name, refs)]
+    if fmt == 'netcdf3':
+        return [(name, NetCDF3ToZarr(f, storage_options=storage_options,
+                                     inline_threshold=inline_threshold).translate())]
+    if fmt == 'grib2':
+        # the grib2 and tiff translators are imported here because they
+        # need the optional cfgrib and tifffile packages
+        from kerchunk.grib2 import scan_grib
+        refs = scan_grib(f, storage_options=storage_options,
+                         inline_threshold=inline_threshold)
+        if len(refs) == 1:
+            return [(name, refs[0])]
+        stem = name[:-len('.json')]
+        return [(f'{stem}.{i}.json', r) for i, r in enumerate(refs)]
+    if fmt == 'tiff':
+        from kerchunk.tiff import tiff_to_zarr
+        return [(name, tiff_to_zarr(f, remote_options=storage_options))]
+    raise ValueError(f'unsupported format {fmt}')
+
+
+def file_checksum(path: str) -> str:
+    """sha256 hex digest of a file"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def input_stamp(info: dict) -> typing.Optional[str]:
+    """
+    Returns a marker that changes when an input is modified: the etag or
+    hash of an object, otherwise its modification time.
+    """
+    for key in ('ETag', 'etag', 'md5Hash', 'mtime', 'LastModified', 'updated'):
+        if info.get(key) is not None:
+            return str(info[key])
+    return None
+
+
+def load_state(outdir: Path) -> dict:
+    """
+    Loads the state of previous incremental runs: for each input, its size,
+    modification marker, checksum and the names of its references.
+    """
+    try:
+        with open(outdir/STATE_NAME) as f:
+            return ujson.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(outdir: Path, state: dict) -> None:
+    """saves the incremental state, replacing the previous one atomically"""
+    tmp = outdir/f'.{STATE_NAME}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        ujson.dump(state, f)
+    tmp.replace(outdir/STATE_NAME)
+
+
+def plan_updates(inputs: typing.Dict[str, dict],
+                 state: dict) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """
+    Compares the input files against the incremental state. Returns the
+    files that are new or changed, and the previously indexed files that no
+    longer exist. A file whose size and modification marker are unchanged
+    is skipped without reading it. If only the modification time of a local
+    file changed, its checksum decides. Remote files are not downloaded to
+    be hashed, their etag already identifies their content.
+    """
+    todo = []
+    for f, info in inputs.items():
+        prev = state.get(f)
+        stamp = input_stamp(info)
+        if prev is None or prev['size'] != info['size']:
+            todo.append(f)
+        elif prev.get('modified') != stamp:
+            if is_local(f) and file_checksum(f) == prev['sha256']:
+                prev['modified'] = stamp
+            else:
+                todo.append(f)
+    deleted = [f for f in state if f not in inputs]
+    return todo, deleted
+
+
+def reference_name(path: str, suffix: str = '.json') -> str:
+    """name of the reference written for an input file"""
+    name = Path(path).name
+    return '.'.join(name.split('.')[0:-1]) + suffix
+
+
+def kerchunk_file(f: str, outdir: Path,
+                  inline_threshold: int = INLINE_THRESHOLD,
+                  checksum: bool = False,
+                  storage_options: typing.Optional[dict] = None,
+                  reference_format: str = 'auto',
+                  shard_threshold: int = SHARD_THRESHOLD,
+                  record_size: int = 10000
+                  ) -> typing.Tuple[typing.List[str], int, int, int, typing.Optional[str]]:
+    """
+    Indexes a single file and writes its references straight to outdir.
+    Returns the names of the references along with the bytes read and
+    written, the number of references, and the checksum of a local file if
+    requested, so only these small values travel back to the parent
+    process. Files in an unsupported format are skipped and write no
+    references.
+    """
+    local = is_local(f)
+    sha256 = file_checksum(f) if checksum and local else None
+    fmt = sniff_format(f, storage_options)
+    if fmt is None:
+        print(f'Skipping {f}, unrecognized file format')
+        return [], 0, 0, 0, sha256
+
+    names = []
+    written = 0
+    count = 0
+    for name, ref_json in translate(f, fmt, inline_threshold, storage_options):
+        n = count_references(ref_json)
+        out_fmt = reference_format
+        if out_fmt == 'auto':
+            out_fmt = 'parquet' if n > shard_threshold else 'json'
+        if out_fmt == 'parquet':
+            name = name[:-len('.json')] + '.parq'
+        outpath = outdir/name
+        write_references(ref_json, outpath, out_fmt, record_size=record_size)
+        written += path_size(outpath)
+        count += n
+        names.append(name)
+
+    # only the ranges fetched from a remote file are read, these are counted
+    # by the network metrics of the stage instead
+    return names, path_size(f) if local else 0, written, count, sha256
+
+
+def kerchunk_directory_of_files(indir: str = '.',
+                                outdir: Path = Path('/tmp'),
+                                metrics = None,
+                                workers: int = 1,
+                                inline_threshold: int = INLINE_THRESHOLD,
+                                incremental: bool = False,
+                                concurrency: int = 1,
+                                storage_options: typing.Optional[dict] = None,
+                                reference_format: str = 'auto',
+                                shard_threshold: int = SHARD_THRESHOLD,
+                                record_size: int = 10000
+                                ) -> typing.Tuple[typing.List[str], bool, typing.List[str]]:
+    """
+    Indexes the files in indir, a local directory or a remote url, writing
+    one or more json references per file to outdir. Remote files are read
+    in place, fetching only the byte ranges the translators need. In
+    incremental mode only new and changed files are indexed, and the
+    references of deleted files are removed.
+
+    Returns the names of the references of every file in indir, whether
+    any of them were added, changed or removed by this run, and the
+    previously indexed files that were removed.
+    """
+
+    if metrics is None:
+        metrics = metrics_from_env("kerchunk", echo=False)
+
+    storage_options = storage_options or {}
+    inputs = list_inputs(str(indir), storage_options)
+    flist = list(inputs)
+
+    state = {}
+    todo, deleted = flist, []
+    if incremental:
+        state = load_state(outdir)
+        todo, deleted = plan_updates(inputs, state)
+        print(f'{len(todo)} new or changed file(s), {len(deleted)} deleted, '
+              f'{len(flist) - len(todo)} unchanged')
+
+    for f in deleted:
+        for name in state.pop(f)['refs']:
+            remove_reference(outdir/name)
+
+    names = []
+
+    def finished(f, result):
+        refs, nread, nwritten, count, sha256 = result
+        names.extend(refs)
+        rec['bytes_read'] += nread
+        rec['bytes_written'] += nwritten
+        rec['references'] += count
+        rec['reference_files'] += len(refs)
+        if incremental:
+            # references from a previous version of the file that were not
+            # written again, e.g. a grib2 file with fewer messages
+            for name in set(state.get(f, {}).get('refs', [])) - set(refs):
+                remove_reference(outdir/name)
+            state[f] = {'size': inputs[f]['size'],
+                        'modified': input_stamp(inputs[f]),
+                        'sha256': sha256, 'refs': refs}
+        pbar.update(1)
+
+    options = dict(inline_threshold=inline_threshold, checksum=incremental,
+                   storage_options=storage_options,
+                   reference_format=reference_format,
+                   shard_threshold=shard_threshold, record_size=record_size)
+
+    try:
+        with metrics.stage('indexing') as rec:
+            rec['references'] = 0
+            rec['reference_files'] = 0
+            with tqdm(total=len(todo)) as pbar:
+                if workers > 1 or concurrency > 1:
+                    # each process writes its references as soon as they are
+                    # produced, the parent only keeps track of progress.
+                    # threads suit remote inputs, where indexing mostly waits
+                    # on requests
+                    if workers > 1:
+                        pool = ProcessPoolExecutor(max_workers=workers)
+                    else:
+                        pool = ThreadPoolExecutor(max_workers=concurrency)
+                    error = None
+                    with pool:
+                        futures = {pool.submit(kerchunk_file, f, outdir, **options): f
+                                   for f in todo}
+                        # keep recording the files that finish after one
+                        # fails, so that the next run does not redo them
+                        for future in as_completed(futures):
+                            try:
+                                finished(futures[future], future.result())
+                            except Exception as e:
+                                print(f'Failed to index {futures[future]}: {e!r}')
+                                error = error or e
+                    if error is not None:
+                        raise error
+                else:
+                    for f in todo:
+                        finished(f, kerchunk_file(f, outdir, **options))
+                pbar.close()
+    finally:
+        # the files indexed before a failure are kept in the state
+        if incremental:
+            save_state(outdir, state)
+
+    print(f"Wrote {rec['references']} references to {rec['reference_files']} "
+          f"file(s), {rec['bytes_written']} bytes")
+
+    if incremental:
+        names = [name for f in flist for name in state[f]['refs']]
+
+    return names, len(todo) > 0 or len(deleted) > 0, deleted
 
 if __name__ == "__main__":
     typer.run(main)
@@ -0,0 +1,168 @@
+import sys
+import socket
+from pathlib import Path
+
+import numpy
+import pandas
+import pytest
+import s3fs
+import ujson
+import xarray
+
+HERE = Path(__file__).parent
+sys.path.insert(0, str(HERE))
+sys.path.insert(0, str(HERE.parent / 'common'))
+
+import entry  # noqa: E402
+
+BUCKET = 'inputs'
+START = pandas.Timestamp('2020-01-01')
+
+
+@pytest.fixture(scope='module')
+def s3():
+    """moto s3 server, yields the fsspec options to reach it"""
+    from moto.server import ThreadedMotoServer
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    options = {'key': 'testing', 'secret': 'testing',
+               'client_kwargs': {'endpoint_url': f'http://127.0.0.1:{port}'}}
+    yield options
+    server.stop()
+
+
+@pytest.fixture
+def bucket(s3, request):
+    """empty prefix of the bucket for a single test"""
+    fs = s3fs.S3FileSystem(**s3)
+    if not fs.exists(BUCKET):
+        fs.mkdir(BUCKET)
+    prefix = f'{BUCKET}/{request.node.name}'.replace('[', '-').replace(']', '')
+    yield fs, prefix
+    fs.rm(prefix, recursive=True)
+
+
+def hour(i):
+    """one hour of a small gridded variable, with values that identify it"""
+    return xarray.Dataset(
+        {'precip': (('time', 'y', 'x'), numpy.full((1, 4, 5), i, dtype='float32'))},
+        coords={'time': [START + pandas.Timedelta(hours=i)],
+                'y': numpy.arange(4.0), 'x': numpy.arange(5.0)},
+    )
+
+
+def upload(fs, tmp_path, prefix, i, fmt='NETCDF4'):
+    local = tmp_path / f'hour_{i:02d}.nc'
+    hour(i).to_netcdf(local, format=fmt,
+                      encoding={'time': {'units': 'hours since 2020-01-01'}})
+    fs.put(str(local), f'{prefix}/{local.name}')
+    return f's3://{prefix}/{local.name}'
+
+
+def run(indir, outdir, options, fmt, combine=True):
+    entry.main(indir, outdir, workers=1, concurrency=2,
+               block_size=entry.BLOCK_SIZE, cache_type='blockcache',
+               storage_options=ujson.dumps(options),
+               inline_threshold=entry.INLINE_THRESHOLD, combine=combine,
+               concat_dim=None, combined_format=fmt, reference_format=fmt,
+               shard_threshold=entry.SHARD_THRESHOLD, record_size=10000,
+               incremental=True)
+
+
+def open_combined(path, options):
+    # reference filesystems are cached by their arguments, which stay the
+    # same when the combined reference is rewritten
+    return xarray.open_dataset(
+        'reference://', engine='zarr',
+        backend_kwargs={'consolidated': False,
+                        'storage_options': {'fo': str(path),
+                                            'skip_instance_cache': True,
+                                            'remote_protocol': 's3',
+                                            'remote_options': options}},
+    )
+
+
+def test_list_and_sniff(bucket, tmp_path, s3):
+    fs, prefix = bucket
+    nc4 = upload(fs, tmp_path, prefix, 0)
+    nc3 = upload(fs, tmp_path, prefix, 1, fmt='NETCDF3_64BIT')
+    fs.pipe(f'{prefix}/notes.txt', b'not a data file')
+    fs.mkdir(f'{prefix}/sub')
+    fs.pipe(f'{prefix}/sub/hour_02.nc', b'nested files are not listed')
+
+    inputs = entry.list_inputs(f's3://{prefix}', s3)
+    assert list(inputs) == [nc4, nc3, f's3://{prefix}/notes.txt']
+    assert inputs[nc4]['size'] == fs.size(nc4)
+    assert entry.input_stamp(inputs[nc4]) == fs.info(nc4)['ETag']
+
+    assert entry.sniff_format(nc4, s3) == 'hdf5'
+    assert entry.sniff_format(nc3, s3) == 'netcdf3'
+    assert entry.sniff_format(f's3://{prefix}/notes.txt', s3) is None
+
+
+@pytest.mark.parametrize('fmt', ['json', 'parquet'])
+def test_incremental_updates(bucket, tmp_path, s3, fmt):
+    fs, prefix = bucket
+    indir = f's3://{prefix}'
+    outdir = tmp_path / 'refs'
+    outdir.mkdir()
+    suffix = '.parq' if fmt == 'parquet' else '.json'
+    combined = outdir / f'combined{suffix}'
+    for i in range(2):
+        upload(fs, tmp_path, prefix, i)
+
+    run(indir, outdir, s3, fmt)
+    assert sorted(p.name for p in outdir.glob('hour_*')) == \
+        [f'hour_00{suffix}', f'hour_01{suffix}']
+    with open_combined(combined, s3) as ds:
+        numpy.testing.assert_array_equal(ds.precip.values[:, 0, 0], [0, 1])
+
+    # a new file is the only one indexed again
+    added = upload(fs, tmp_path, prefix, 2)
+    state = entry.load_state(outdir)
+    todo, deleted = entry.plan_updates(entry.list_inputs(indir, s3), state)
+    assert (todo, deleted) == ([added], [])
+
+    run(indir, outdir, s3, fmt)
+    with open_combined(combined, s3) as ds:
+        numpy.testing.assert_array_equal(ds.precip.values[:, 0, 0], [0, 1, 2])
+
+    # a removed file loses its references and its place in the combined one
+    removed = f's3://{prefix}/hour_01.nc'
+    fs.rm(removed)
+    state = entry.load_state(outdir)
+    todo, deleted = entry.plan_updates(entry.list_inputs(indir, s3), state)
+    assert (todo, deleted) == ([], [removed])
+
+    run(indir, outdir, s3, fmt)
+    assert not (outdir / f'hour_01{suffix}').exists()
+    assert removed not in entry.load_state(outdir)
+    with open_combined(combined, s3) as ds:
+        numpy.testing.assert_array_equal(ds.precip.values[:, 0, 0], [0, 2])
+
+
+def test_deletion_invalidates_combined(bucket, tmp_path, s3):
+    fs, prefix = bucket
+    indir = f's3://{prefix}'
+    outdir = tmp_path / 'refs'
+    outdir.mkdir()
+    for i in range(3):
+        upload(fs, tmp_path, prefix, i)
+    run(indir, outdir, s3, 'json')
+    assert (outdir / 'combined.json').exists()
+
+    # runs without --combine only index, but must not leave a combined
+    # reference that points at a removed input
+    upload(fs, tmp_path, prefix, 3)
+    run(indir, outdir, s3, 'json', combine=False)
+    assert (outdir / 'combined.json').exists()
+
+    fs.rm(f'{prefix}/hour_01.nc')
+    run(indir, outdir, s3, 'json', combine=False)
+    assert not (outdir / 'combined.json').exists()
+    assert sorted(p.name for p in outdir.glob('hour_*')) == \
+        ['hour_00.json', 'hour_02.json', 'hour_03.json']
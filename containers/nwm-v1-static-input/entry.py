@@ -5,6 +5,7 @@ import uuid
 import typer
 import subprocess
 from pathlib import Path
+from instrumentation import metrics_from_env, path_size
 
 
 def main(
@@ -23,7 +24,12 @@ def main(
     uid = uuid.uuid4().hex
 
     # run the subsetting operation
-    subset(uid, xmin, xmax, ymin, ymax, nwmv1_data, output_dir)
+    metrics = metrics_from_env("nwm-v1")
+    with metrics.stage("subsetting") as rec:
+        size = path_size(output_dir)
+        subset(uid, xmin, xmax, ymin, ymax, nwmv1_data, output_dir)
+        rec["bytes_written"] = path_size(output_dir) - size
+    metrics.finish()
 
 
 def subset(uid, xmin, xmax, ymin, ymax, nwmv1_data, output_dir="/tmp"):
@@ -1,3 +1,8 @@
 #!/bin/bash
 
+# instrumentation.py is shared by the containers and lives in containers/common,
+# copy it into the build context for the duration of the build
+cp ../common/instrumentation.py instrumentation.py
+trap 'rm -f instrumentation.py' EXIT
+
 docker build -t cuahsi/parflow-subset:v1 .
@@ -1,13 +1,56 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import sys
 import glob
+import gzip
+import json
+import time
+import runpy
 import typer
-import shutil
+import fsspec
+import hashlib
+import logging
+import threading
 import subprocess
+import importlib.util
 from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout, redirect_stderr
 import shapefile
+from instrumentation import metrics_from_env, path_size
+from index import subset_window
+from pfb import clip_pfb
+
+# module of the parflow_subsetter package that subsets the CONUS domain
+SUBSET_MODULE = "pfsubset.subset.tools.subset_conus"
+
+# "in-process" runs the subsetter in this interpreter so numpy, gdal and the
+# parflow tools are only imported once, "subprocess" runs it with python -m
+# and "auto" runs it in a subprocess when the package cannot be found by
+# this interpreter, or cannot be imported in it. "windowed" skips the subsetter and only clips
+# the --pfb-input files with the windowed reader
+SUBSET_MODES = ["auto", "in-process", "subprocess", "windowed"]
+
+# shapefile attribute that holds the ids of the features to subset
+SHAPEFILE_ATTRIBUTE = "ID"
+
+# GeoTIFF in the CONUS data that defines the grid of the subset index
+GRID_FILE = "Domain_Blank_Mask.tif"
+
+# writable directory of the subset index. Mount a shared volume or an index
+# prebuilt with index.py here so that runs reuse each other's windows
+INDEX_DIR = "/srv/index"
+
+# outputs are copied in blocks of this size, and uploaded to object storage
+# in multipart uploads with parts of PART_SIZE bytes
+COPY_BLOCK_SIZE = 8 * 2**20
+PART_SIZE = 64 * 2**20
+
+# pfb outputs at least this large are gzipped when compression is enabled
+COMPRESS_MIN_SIZE = 64 * 2**20
 
 
 def main(
@@ -21,49 +64,188 @@ def main(
         "/srv/domain",
         help="Directory where PFConus data is located/mounted within the container",
     ),
-    output_dir: Path = typer.Argument("/srv/output", help="Directory to save output"),
+    output_dir: str = typer.Argument(
+        "/srv/output",
+        help="Directory to save output, a local path or an s3:// or gs:// url",
+    ),
+    mode: str = typer.Option(
+        "auto",
+        envvar="SUBSET_MODE",
+        help="How to run the subsetter: auto, in-process, subprocess, or "
+        "windowed to only clip the --pfb-input files",
+    ),
+    direct: bool = typer.Option(
+        False,
+        help="Write outputs straight into a local output directory instead "
+        "of copying them there afterwards",
+    ),
+    copy_workers: int = typer.Option(
+        4, help="Number of outputs copied or uploaded at the same time"
+    ),
+    verify: bool = typer.Option(
+        True, help="Verify copied outputs against a checksum of the originals"
+    ),
+    compress: bool = typer.Option(
+        False, help="Gzip large pfb outputs while copying them"
+    ),
+    compress_min_size: int = typer.Option(
+        COMPRESS_MIN_SIZE, help="Size in bytes from which pfb outputs are gzipped"
+    ),
+    part_size: int = typer.Option(
+        PART_SIZE, help="Part size in bytes of multipart uploads to object storage"
+    ),
+    storage_options: str = typer.Option(
+        "{}", help='json object of fsspec options for object storage, e.g. {"anon": true}'
+    ),
+    index_dir: Path = typer.Option(
+        INDEX_DIR,
+        envvar="SUBSET_INDEX_DIR",
+        help="Directory of the index of feature grid windows, only used "
+        "with --pfb-input or in windowed mode",
+    ),
+    grid_file: Optional[Path] = typer.Option(
+        None,
+        help="GeoTIFF on the CONUS grid used to build the index, "
+        f"defaults to {GRID_FILE} in the CONUS data directory. Not needed "
+        "once the index holds the requested features",
+    ),
+    pfb_input: List[str] = typer.Option(
+        [],
+        help="CONUS PFB file to clip to the subset window with ranged reads, "
+        "may be repeated",
+    ),
+    pfb_source: Optional[str] = typer.Option(
+        None,
+        help="Directory or s3:// or gs:// url of the --pfb-input files, "
+        "defaults to the CONUS data directory",
+    ),
 ):
 
-    subset(label, shape_boundary, pfconus_data, output_dir)
+    if mode not in SUBSET_MODES:
+        raise typer.BadParameter(f"mode must be one of {SUBSET_MODES}")
+    if direct and not is_local(output_dir):
+        raise typer.BadParameter("--direct needs a local output directory")
+    if mode == "windowed" and not pfb_input:
+        raise typer.BadParameter("windowed mode needs at least one --pfb-input")
+    if mode == "windowed" and pfb_source is None and not pfconus_data.exists():
+        # windowed runs only need the CONUS data directory for the pfb
+        # inputs, and for the grid file if the index is missing features
+        raise typer.BadParameter(
+            f"The CONUS data directory {pfconus_data} does not exist, "
+            "windowed mode needs --pfb-source to read the pfb inputs from"
+        )
 
+    publish = dict(
+        workers=copy_workers,
+        verify=verify,
+        compress=compress,
+        compress_min_size=compress_min_size,
+        part_size=part_size,
+        storage_options=json.loads(storage_options),
+    )
 
-def subset(
-    name: str, shape_boundary: Path, pfconus_data: Path, output_dir: Path
-) -> None:
+    metrics = metrics_from_env("parflow-v1")
+    result = subset(
+        label,
+        shape_boundary,
+        pfconus_data,
+        output_dir,
+        metrics,
+        mode=mode,
+        direct=direct,
+        publish=publish,
+        index_dir=index_dir,
+        grid_file=grid_file or pfconus_data / GRID_FILE,
+        pfb_inputs=pfb_input,
+        pfb_source=pfb_source or str(pfconus_data),
+        source_options=publish["storage_options"],
+    )
+    metrics.finish()
+
+    if result["returncode"] != 0:
+        raise typer.Exit(code=result["returncode"])
+
+
+def clean_lines(text: str) -> Iterator[str]:
     """
-    Subset the parflow hydrofabric for a given shape boundary
+    Splits subsetter output into non-empty lines. The subsetting library
+    prints the output of the tools it runs as the repr of byte strings,
+    these are unwrapped into their own lines.
+    """
+    for line in text.splitlines():
+        line = line.rstrip()
 
-    Parameters
-    ----------
-    name: str
-        Name or label to give the output subset data
-    shape_boundary: Path
-        Path to the shapefile that represents the area to be subset
-    pfconus_data: Path
-        Path to the Parflow hydrofabric data
-    output_dir: Path
-        Path to save the output results
+        # skip empty lines
+        if line == '':
+            continue
+
+        # this is a hack to deal with strings of byte-strings that the
+        # subsetting library outputs.
+        if line[0:2] == "b'":
+            for l in line[2:-1].split('\\n'):
+                if l == '': continue
+                yield l
+        else:
+            yield line
 
 
-    Returns
-    -------
-    None
+def print_event(event: dict) -> None:
+    """default progress callback, prints the message of each event"""
+    print(event["message"], flush=True)
 
+
+class EventStream(io.TextIOBase):
+    """
+    Text stream that emits a progress event for every line written to it,
+    used to capture the stdout of the in-process subsetter.
     """
 
-    # read shapefile records
-    ids = []
-    with shapefile.Reader(shape_boundary) as shp:
-        for record in shp.records():
-            ids.append(str(record[0]))
+    def __init__(self, emit: Callable[[str, str, str], None]):
+        self.emit = emit
+        self.pending = ""
 
-    # run the subsetting functions
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.pending += text
+        *lines, self.pending = self.pending.split("\n")
+        for line in lines:
+            for l in clean_lines(line):
+                self.emit("stdout", "INFO", l)
+        return len(text)
+
+    def flush(self):
+        for l in clean_lines(self.pending):
+            self.emit("stdout", "INFO", l)
+        self.pending = ""
+
+
+class EventHandler(logging.Handler):
+    """logging handler that emits a progress event for every record"""
+
+    def __init__(self, emit: Callable[[str, str, str], None]):
+        super().__init__()
+        self.emit_event = emit
+
+    def emit(self, record):
+        for l in clean_lines(self.format(record)):
+            self.emit_event("log", record.levelname, l)
+
+
+def subset_args(
+    name: str,
+    shape_boundary: Path,
+    pfconus_data: Path,
+    tmp_output: Path,
+    ids: List[str],
+) -> List[str]:
+    """
+    Command line arguments of the subsetter, shared by both ways of
+    running it.
+    """
     shapefile_name_without_ext = "".join(shape_boundary.name.split(".")[:-1])
-    tmp_output = Path("/tmp/outputs")
-    cmd = [
-        sys.executable,
-        "-m",
-        "pfsubset.subset.tools.subset_conus",
+    args = [
         "-i",
         str(shape_boundary.parent),
         "-s",
@@ -78,22 +260,101 @@ def subset(
         "-n",
         name,  # name for the output files
         "-e",
-        "ID",  # shapefile attribute column name
+        SHAPEFILE_ATTRIBUTE,  # shapefile attribute column name
         "-a",
     ]
 
     # shapefile attribute ids
-    cmd.extend(ids)
-    print(cmd)
+    args.extend(ids)
+    return args
+
+
+def run_in_process(
+    args: List[str],
+    cwd: Path,
+    emit: Callable[[str, str, str], None],
+    raise_import_errors: bool = False,
+) -> int:
+    """
+    Runs the subsetter module as __main__ in this interpreter, exactly as
+    python -m would, turning its output and log records into progress
+    events. Returns the exit code of the module. With raise_import_errors
+    an ImportError, e.g. a dependency that is missing from this
+    interpreter, is raised instead so the caller can fall back to a
+    subprocess.
+    """
+    saved_argv = sys.argv
+    saved_cwd = os.getcwd()
+    saved_parflow_dir = os.environ.get("PARFLOW_DIR")
+
+    # events are handled with the real stdout and stderr, so that a callback
+    # that prints does not write back into the captured output
+    stdout, stderr = sys.stdout, sys.stderr
+
+    def forward(source, level, message):
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            emit(source, level, message)
+
+    # the handler on the root logger also keeps a basicConfig call in the
+    # subsetter from writing the same records to the redirected stderr
+    root = logging.getLogger()
+    saved_level = root.level
+    handler = EventHandler(forward)
+    root.addHandler(handler)
+    if saved_level > logging.INFO:
+        root.setLevel(logging.INFO)
+
+    stream = EventStream(forward)
+    sys.argv = [SUBSET_MODULE] + args
+    os.environ["PARFLOW_DIR"] = "/usr/local"
+    os.chdir(cwd)
+    try:
+        with redirect_stdout(stream), redirect_stderr(stream):
+            runpy.run_module(SUBSET_MODULE, run_name="__main__", alter_sys=True)
+        return 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        forward("stdout", "ERROR", str(e.code))
+        return 1
+    except ImportError as e:
+        if raise_import_errors:
+            raise
+        forward("log", "ERROR", f"{type(e).__name__}: {e}")
+        return 1
+    except Exception as e:
+        forward("log", "ERROR", f"{type(e).__name__}: {e}")
+        return 1
+    finally:
+        stream.flush()
+        root.removeHandler(handler)
+        root.setLevel(saved_level)
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+        if saved_parflow_dir is None:
+            os.environ.pop("PARFLOW_DIR", None)
+        else:
+            os.environ["PARFLOW_DIR"] = saved_parflow_dir
+
+
+def run_subprocess(
+    args: List[str],
+    cwd: Path,
+    emit: Callable[[str, str, str], None],
+) -> int:
+    """
+    Runs the subsetter with python -m in a new interpreter, turning each
+    line of its output into a progress event. Returns its exit code.
+    """
+    cmd = [sys.executable, "-m", SUBSET_MODULE] + args
 
     # collect the environment vars for the subprocess
     environ = os.environ.copy()
     environ["PARFLOW_DIR"] = "/usr/local"
 
-    # run the job
     proc = subprocess.Popen(
         cmd,
-        cwd=output_dir,
+        cwd=cwd,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         env=environ,
@@ -101,32 +362,430 @@ def subset(
 
     # read stdout and log messages
     for line in iter(proc.stdout.readline, b''):
-        line = line.decode('utf-8').rstrip()
-        
-        # skip empty lines
-        if line == '':
-            continue
+        for l in clean_lines(line.decode('utf-8')):
+            emit("stdout", "INFO", l)
 
-        # this is a hack to deal with strings of byte-strings that the 
-        # subsetting library outputs.
-        if line[0:2] == "b'":
-            for l in line[2:-1].split('\\n'):
-                if l == '': continue
-                print(l)
+    proc.stdout.close()
+    return proc.wait()
+
+
+def is_local(path: Union[str, Path]) -> bool:
+    """whether path is on the local filesystem rather than object storage"""
+    return fsspec.core.split_protocol(str(path))[0] in (None, "file")
+
+
+class PartWriter(io.RawIOBase):
+    """
+    binary stream that counts the bytes written through it to another. With
+    a part_size, the bytes are passed on in parts of exactly that size, so
+    that each one becomes a part of a multipart upload, and the MD5 of every
+    part is kept to compute the ETag the store should give the object.
+    """
+
+    def __init__(self, target, part_size: Optional[int] = None):
+        self.target = target
+        self.part_size = part_size
+        self.count = 0
+        self.pending = bytearray()
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.count += len(data)
+        if self.part_size is None:
+            self.target.write(data)
+            return len(data)
+        self.pending += data
+        while len(self.pending) >= self.part_size:
+            self.write_part(bytes(self.pending[: self.part_size]))
+            del self.pending[: self.part_size]
+        return len(data)
+
+    def write_part(self, part):
+        self.parts.append(hashlib.md5(part).digest())
+        self.target.write(part)
+
+    def finish(self):
+        """passes on the last, shorter, part"""
+        if self.pending:
+            self.write_part(bytes(self.pending))
+            self.pending = bytearray()
+
+    def etag(self) -> str:
+        """ETag of a multipart upload of the parts, or of an empty object"""
+        if not self.parts:
+            return hashlib.md5(b"").hexdigest()
+        digest = hashlib.md5(b"".join(self.parts)).hexdigest()
+        return f"{digest}-{len(self.parts)}"
+
+
+def copy_output(
+    src: str,
+    dest: str,
+    verify: bool = True,
+    compress: bool = False,
+    part_size: int = PART_SIZE,
+    storage_options: Optional[dict] = None,
+) -> Tuple[str, int]:
+    """
+    Copies a single output file to a local path or an object storage url.
+    The file is streamed in blocks. A local copy is written under a
+    temporary name, verified, and only then renamed to dest. Object storage
+    receives it directly at dest as a multipart upload of part_size parts,
+    which only becomes visible once it is committed, and is aborted if the
+    copy fails, so an interrupted copy never looks complete.
+
+    Parameters
+    ----------
+    src: str
+        Path of the output file
+    dest: str
+        Path or url to copy it to
+    verify: bool
+        Compare a sha256 of the original with the copy read back from a
+        local destination. Uploads are checked against the ETag of the
+        multipart upload computed from the MD5 of the parts sent, or their
+        size when the store gives no ETag, reading them back would download
+        them again. Stores whose ETags are not MD5 based, such as buckets
+        encrypted with KMS keys, need verify turned off
+    compress: bool
+        Gzip the file while copying it, ".gz" is added to dest
+    part_size: int
+        Size in bytes of the blocks written to dest
+    storage_options: dict
+        fsspec options for object storage
+
+    Returns
+    -------
+    Tuple[str, int]
+        The destination and the number of bytes written to it
+
+    """
+
+    if compress:
+        dest = dest + ".gz"
+    fs, path = fsspec.core.url_to_fs(dest, **(storage_options or {}))
+    local = is_local(dest)
+    if local:
+        parent = fs._parent(path)
+        fs.makedirs(parent, exist_ok=True)
+        name = path.rsplit("/", 1)[-1]
+        target = f"{parent}/.{name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        raw = fs.open(target, "wb")
+    else:
+        target = path
+        raw = fs.open(target, "wb", block_size=part_size, autocommit=False)
+
+    committed = False
+    try:
+        checksum = hashlib.sha256()
+        counter = PartWriter(raw, None if local else part_size)
+        with open(src, "rb") as fin:
+            fout = (
+                gzip.GzipFile(fileobj=counter, mode="wb", compresslevel=6)
+                if compress
+                else counter
+            )
+            for block in iter(lambda: fin.read(COPY_BLOCK_SIZE), b""):
+                checksum.update(block)
+                fout.write(block)
+            if compress:
+                fout.close()
+        counter.finish()
+        raw.close()
+
+        if local:
+            written = fs.size(target)
+            if verify:
+                copied = hashlib.sha256()
+                with open(target, "rb") as f:
+                    fcopy = gzip.GzipFile(fileobj=f, mode="rb") if compress else f
+                    for block in iter(lambda: fcopy.read(COPY_BLOCK_SIZE), b""):
+                        copied.update(block)
+                if copied.hexdigest() != checksum.hexdigest():
+                    raise IOError(f"Copy of {src} to {dest} does not match the original")
+            fs.mv(target, path)
         else:
-            print(line)
+            raw.commit()
+            committed = True
+            info = fs.info(path)
+            written = info["size"]
+            etag = info.get("ETag", "").strip('"')
+            if verify and (
+                written != counter.count or (etag and etag != counter.etag())
+            ):
+                raise IOError(f"Upload of {src} to {dest} does not match the original")
+    except BaseException:
+        try:
+            if local:
+                raw.close()
+                fs.rm(target)
+            elif committed:
+                fs.rm(target)
+            else:
+                # abort the upload, and keep the file from flushing what is
+                # left of it when it is garbage collected
+                raw.discard()
+                raw.closed = True
+        except (OSError, FileNotFoundError):
+            pass
+        raise
+    return dest, written
 
-    proc.stdout.close()
-    proc.wait()
+
+def publish_outputs(
+    files: List[str],
+    output_dir: str,
+    workers: int = 4,
+    verify: bool = True,
+    compress: bool = False,
+    compress_min_size: int = COMPRESS_MIN_SIZE,
+    part_size: int = PART_SIZE,
+    storage_options: Optional[dict] = None,
+) -> List[Tuple[str, int]]:
+    """
+    Copies the output files into a local directory, e.g. a fuse mount, or
+    uploads them straight to object storage, several files at a time.
+
+    Parameters
+    ----------
+    files: List[str]
+        Paths of the output files
+    output_dir: str
+        Local directory or s3:// or gs:// url to copy them to
+    workers: int
+        Number of files copied at the same time
+    verify: bool
+        Verify each copy, see copy_output
+    compress: bool
+        Gzip pfb files of at least compress_min_size bytes
+    compress_min_size: int
+        Size in bytes from which pfb files are gzipped
+    part_size: int
+        Part size in bytes of multipart uploads
+    storage_options: dict
+        fsspec options for object storage
+
+    Returns
+    -------
+    List[Tuple[str, int]]
+        The destination of each file and the bytes written to it
+
+    """
+
+    def copy(filename):
+        dest = f"{str(output_dir).rstrip('/')}/{os.path.basename(filename)}"
+        gz = (
+            compress
+            and filename.endswith(".pfb")
+            and os.path.getsize(filename) >= compress_min_size
+        )
+        return copy_output(
+            filename,
+            dest,
+            verify=verify,
+            compress=gz,
+            part_size=part_size,
+            storage_options=storage_options,
+        )
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        return list(pool.map(copy, files))
+
+
+def subset(
+    name: str,
+    shape_boundary: Path,
+    pfconus_data: Path,
+    output_dir: Union[str, Path],
+    metrics=None,
+    mode: str = "auto",
+    on_event: Callable[[dict], None] = print_event,
+    direct: bool = False,
+    publish: Optional[dict] = None,
+    index_dir: Optional[Path] = None,
+    grid_file: Optional[Path] = None,
+    pfb_inputs: Optional[List[str]] = None,
+    pfb_source: Optional[str] = None,
+    source_options: Optional[dict] = None,
+) -> dict:
+    """
+    Subset the parflow hydrofabric for a given shape boundary
+
+    Parameters
+    ----------
+    name: str
+        Name or label to give the output subset data
+    shape_boundary: Path
+        Path to the shapefile that represents the area to be subset
+    pfconus_data: Path
+        Path to the Parflow hydrofabric data
+    output_dir: Union[str, Path]
+        Path to save the output results, or an s3:// or gs:// url to
+        upload them to
+    metrics: instrumentation.Metrics
+        Collects the timings of the subsetting and copying stages
+    mode: str
+        "in-process", "subprocess", "auto" or "windowed", see SUBSET_MODES
+    on_event: Callable[[dict], None]
+        Called with every progress event as it happens. Events are dicts
+        with the keys time, source ("stdout" or "log"), level and message
+    direct: bool
+        Have the subsetter write straight into a local output_dir
+    publish: dict
+        Keyword arguments of publish_outputs, used to copy the results into
+        output_dir
+    index_dir: Path
+        Directory of the index of feature grid windows, see index.py. The
+        window is only looked up when pfb_inputs are clipped to it
+    grid_file: Path
+        GeoTIFF on the CONUS grid, used to add features to the index
+    pfb_inputs: List[str]
+        Names of CONUS PFB files to clip to the window with pfb.clip_pfb,
+        reading only the byte ranges the window needs
+    pfb_source: str
+        Directory or object storage url of the pfb_inputs, defaults to
+        pfconus_data
+    source_options: dict
+        fsspec options for reading pfb_inputs from object storage
+
+
+    Returns
+    -------
+    dict
+        The mode the subsetter ran in, its return code, the progress
+        events, the paths of the output files copied into output_dir and
+        the grid window (imin, imax, jmin, jmax) of the subset, if known
+
+    """
+
+    if metrics is None:
+        metrics = metrics_from_env("parflow-v1", echo=False)
+
+    # read shapefile records
+    ids = []
+    with shapefile.Reader(shape_boundary) as shp:
+        for record in shp.records():
+            ids.append(str(record[0]))
+
+    # grid window of the requested features, looked up in the index shared
+    # by every run on the same CONUS data. pfsubset finds the window itself,
+    # so it is only needed to clip pfb inputs
+    window = None
+    if index_dir is not None and pfb_inputs:
+        with metrics.stage("locating window"):
+            try:
+                window = subset_window(
+                    index_dir, shape_boundary, ids, grid_file, SHAPEFILE_ATTRIBUTE
+                )
+            except Exception as e:
+                print(f"Could not locate the subset window: {e}")
+        print(f"Subset window (imin, imax, jmin, jmax): {window}")
+
+    tmp_output = Path(output_dir) if direct else Path("/tmp/outputs")
+    args = subset_args(name, shape_boundary, pfconus_data, tmp_output, ids)
+
+    events = []
+
+    def emit(source, level, message):
+        event = {
+            "time": time.time(),
+            "source": source,
+            "level": level,
+            "message": message,
+        }
+        events.append(event)
+        on_event(event)
+
+    fallback = mode == "auto"
+    if mode == "auto":
+        # find_spec imports the parent packages but leaves the module itself
+        # for runpy to execute as __main__
+        try:
+            found = importlib.util.find_spec(SUBSET_MODULE) is not None
+        except ImportError:
+            found = False
+        mode = "in-process" if found else "subprocess"
+    if mode != "windowed":
+        print(f"Running {SUBSET_MODULE} ({mode}) {args}")
+
+    # the subsetter runs in the output directory unless that is in object
+    # storage
+    cwd = Path(output_dir) if is_local(output_dir) else tmp_output
+    cwd.mkdir(parents=True, exist_ok=True)
+
+    # run the subsetting functions
+    returncode = 0
+    if mode != "windowed":
+        with metrics.stage("subsetting") as rec:
+            if mode == "in-process":
+                try:
+                    returncode = run_in_process(
+                        args, cwd, emit, raise_import_errors=fallback
+                    )
+                except ImportError as e:
+                    # the subsetter or one of its dependencies cannot be
+                    # imported here, its own interpreter may still run it
+                    emit(
+                        "log",
+                        "WARNING",
+                        f"Could not import {SUBSET_MODULE} in process "
+                        f"({type(e).__name__}: {e}), running it in a subprocess",
+                    )
+                    mode = "subprocess"
+            if mode != "in-process":
+                returncode = run_subprocess(args, cwd, emit)
+            rec["mode"] = mode
+            rec["returncode"] = returncode
+
+    if mode == "windowed" and not pfb_inputs:
+        print("Windowed mode has no pfb inputs to clip")
+        returncode = 1
+
+    # clip pfb inputs reading only the parts of them inside the window, so
+    # they do not need to be mounted
+    if pfb_inputs:
+        if window is None:
+            print("Cannot clip pfb inputs without a subset window")
+            returncode = returncode or 1
+        else:
+            source = (pfb_source or str(pfconus_data)).rstrip("/")
+            tmp_output.mkdir(parents=True, exist_ok=True)
+            with metrics.stage("clipping pfb inputs") as rec:
+                for pfb_name in pfb_inputs:
+                    dest = tmp_output / f"{name}_{Path(pfb_name).name}"
+                    print(f"Clipping {source}/{pfb_name} to {dest}")
+                    rec["bytes_read"] += clip_pfb(
+                        f"{source}/{pfb_name}", str(dest), window, source_options
+                    )
+                    rec["bytes_written"] += path_size(dest)
 
     print("Subsetting Operation Complete")
 
-    # results are not saved directly to the output directory so we
-    # can support cloud fuse mounting. Copying files into a fuse-mounted
-    # directory is substantially faster than saving them their directly. 
-    print("Moving results into output directory")
-    for filename in glob.glob(os.path.join(tmp_output, '*.*')):
-        shutil.copy(filename, output_dir)
+    filenames = glob.glob(os.path.join(tmp_output, '*.*'))
+    if direct:
+        outputs = filenames
+    else:
+        # results are not saved directly to the output directory so we
+        # can support cloud fuse mounting. Copying files into a fuse-mounted
+        # directory is substantially faster than saving them their directly.
+        print("Moving results into output directory")
+        with metrics.stage("copying outputs") as rec:
+            copied = publish_outputs(filenames, output_dir, **(publish or {}))
+            outputs = [dest for dest, _ in copied]
+            rec["bytes_read"] = sum(path_size(f) for f in filenames)
+            rec["bytes_written"] = sum(written for _, written in copied)
+            rec["files"] = len(copied)
+
+    return {
+        "mode": mode,
+        "returncode": returncode,
+        "events": events,
+        "outputs": outputs,
+        "window": window,
+    }
 
 #    # write metadata file
 #    meta = {'date_processed': str(datetime.now(tz=timezone.utc)),
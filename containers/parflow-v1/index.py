@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+"""
+Spatial index of the ParFlow CONUS grid windows of shapefile features.
+
+Subset requests name their features by the shapefile attribute passed to the
+subsetter with -e/-a, e.g. HUC ids, and the same features are requested over
+and over. The grid window covering each feature is computed once and stored
+in an index directory as two .npy files:
+
+    ids.npy        sorted feature ids
+    windows.npy    (imin, imax, jmin, jmax) of each id
+
+Both are opened memory-mapped and searched with a binary search, so looking
+up the window of a request only touches a few pages of the index no matter
+how many features it holds. i is the column counted from the west edge of the
+grid and j the row counted from the south edge, as in ParFlow files. Upper
+bounds are exclusive.
+
+The index can be prebuilt for every feature of a shapefile with
+
+    python index.py <shapefile> <grid_file> <index_dir>
+
+and mounted into the containers read-only. Features that are missing from
+it are only added when the index directory is writable.
+"""
+
+import os
+import json
+import shutil
+import logging
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy
+import pyproj
+import typer
+import shapefile
+
+# width of the stored ids, longer ids are not indexed
+ID_LENGTH = 32
+
+
+def read_grid(grid_file: Path) -> dict:
+    """
+    Reads the definition of the CONUS grid from a GeoTIFF on that grid, e.g.
+    the domain mask.
+
+    Returns
+    -------
+    dict
+        the gdal geotransform, number of columns and rows, and the crs as
+        well known text.
+    """
+    # imported here, gdal is only needed to build or extend the index
+    from osgeo import gdal
+
+    ds = gdal.Open(str(grid_file))
+    if ds is None:
+        raise FileNotFoundError(f"Could not open grid file {grid_file}")
+    return {
+        "transform": list(ds.GetGeoTransform()),
+        "nx": ds.RasterXSize,
+        "ny": ds.RasterYSize,
+        "crs": ds.GetProjection(),
+    }
+
+
+def bbox_window(grid: dict, bbox: Tuple[float, float, float, float]) -> tuple:
+    """
+    Converts a bounding box in the projection of the grid into the window of
+    grid cells it touches, clipped to the grid.
+
+    Parameters
+    ----------
+    grid: dict
+        grid definition, see read_grid.
+    bbox: tuple
+        (minx, miny, maxx, maxy) in the projection of the grid.
+
+    Returns
+    -------
+    tuple
+        (imin, imax, jmin, jmax), see the module docstring.
+    """
+    x0, dx, _, y0, _, dy = grid["transform"]
+    minx, miny, maxx, maxy = bbox
+    cols = sorted(((minx - x0) / dx, (maxx - x0) / dx))
+    rows = sorted(((miny - y0) / dy, (maxy - y0) / dy))
+
+    imin = max(int(numpy.floor(cols[0])), 0)
+    imax = min(int(numpy.floor(cols[1])) + 1, grid["nx"])
+    # rows of a north-up geotransform count from the top of the grid
+    top = max(int(numpy.floor(rows[0])), 0)
+    bottom = min(int(numpy.floor(rows[1])) + 1, grid["ny"])
+    if dy < 0:
+        jmin, jmax = grid["ny"] - bottom, grid["ny"] - top
+    else:
+        jmin, jmax = top, bottom
+
+    if imin >= imax or jmin >= jmax:
+        raise ValueError(f"Bounds {bbox} do not overlap the grid")
+    return imin, imax, jmin, jmax
+
+
+def union_window(windows: List[tuple]) -> tuple:
+    """smallest window that contains every window"""
+    w = numpy.asarray(windows)
+    return (
+        int(w[:, 0].min()),
+        int(w[:, 1].max()),
+        int(w[:, 2].min()),
+        int(w[:, 3].max()),
+    )
+
+
+def feature_windows(
+    shape_path: Path, grid: dict, attribute: str = "ID"
+) -> Tuple[List[str], List[tuple]]:
+    """
+    Computes the grid window of every feature of a shapefile.
+
+    Every vertex is projected onto the grid rather than only the corners of
+    the bounding box, because the bounding box of a feature is not preserved
+    between projections.
+
+    Parameters
+    ----------
+    shape_path: pathlib.Path
+        the shapefile. Its .prj file gives its projection, without one it is
+        assumed to be in the projection of the grid.
+    grid: dict
+        grid definition, see read_grid.
+    attribute: str
+        name of the attribute that identifies the features.
+
+    Returns
+    -------
+    Tuple[List[str], List[tuple]]
+        the id and window of each feature.
+    """
+    prj = Path(shape_path).with_suffix(".prj")
+    transformer = None
+    if prj.exists():
+        transformer = pyproj.Transformer.from_crs(
+            pyproj.CRS.from_wkt(prj.read_text()),
+            pyproj.CRS.from_wkt(grid["crs"]),
+            always_xy=True,
+        )
+
+    ids, windows = [], []
+    with shapefile.Reader(str(shape_path)) as shp:
+        for rec in shp.iterShapeRecords():
+            points = numpy.asarray(rec.shape.points, dtype="float64")
+            if len(points) == 0:
+                continue
+            x, y = points[:, 0], points[:, 1]
+            if transformer is not None:
+                x, y = transformer.transform(x, y)
+            bbox = (x.min(), y.min(), x.max(), y.max())
+            ids.append(str(rec.record[attribute]))
+            windows.append(bbox_window(grid, bbox))
+    return ids, windows
+
+
+def index_path(index_dir: Path, attribute: str = "ID") -> Path:
+    """directory that holds the index of one shapefile attribute"""
+    return Path(index_dir) / attribute
+
+
+def load_index(index_dir: Path, attribute: str = "ID") -> Optional[dict]:
+    """
+    Opens the index of an attribute memory-mapped, or returns None if it has
+    not been built.
+
+    Returns
+    -------
+    dict
+        the memory-mapped ids and windows arrays and the grid definition.
+    """
+    path = index_path(index_dir, attribute)
+    if not (path / "ids.npy").exists():
+        return None
+    with open(path / "grid.json", "r") as f:
+        grid = json.load(f)
+    return {
+        "ids": numpy.load(path / "ids.npy", mmap_mode="r"),
+        "windows": numpy.load(path / "windows.npy", mmap_mode="r"),
+        "grid": grid,
+    }
+
+
+def lookup(index: dict, ids: List[str]) -> Tuple[List[tuple], List[str]]:
+    """
+    Finds the windows of ids in an index with a binary search.
+
+    Returns
+    -------
+    Tuple[List[tuple], List[str]]
+        the windows of the ids that were found and the ids that were not.
+    """
+    found, missing = [], []
+    n = len(index["ids"])
+    for i in ids:
+        pos = int(numpy.searchsorted(index["ids"], i))
+        if pos < n and index["ids"][pos] == i:
+            found.append(tuple(int(v) for v in index["windows"][pos]))
+        else:
+            missing.append(i)
+    return found, missing
+
+
+def update_index(
+    index_dir: Path, shape_path: Path, grid: dict, attribute: str = "ID"
+) -> int:
+    """
+    Adds the features of a shapefile that are not in the index yet. The new
+    index is written to a temporary directory and swapped in with renames,
+    readers that already have the old one mapped keep reading it.
+
+    Returns
+    -------
+    int
+        the number of features added.
+    """
+    path = index_path(index_dir, attribute)
+    index = load_index(index_dir, attribute)
+    if index is not None and index["grid"] != grid:
+        logging.warning(f"Grid of the index in {path} changed, rebuilding it")
+        index = None
+
+    new_ids, new_windows = feature_windows(shape_path, grid, attribute)
+    keep = [len(i) <= ID_LENGTH for i in new_ids]
+    new_ids = [i for i, k in zip(new_ids, keep) if k]
+    new_windows = [w for w, k in zip(new_windows, keep) if k]
+    if index is not None:
+        _, missing = lookup(index, new_ids)
+        missing = set(missing)
+        new_windows = [w for i, w in zip(new_ids, new_windows) if i in missing]
+        new_ids = [i for i in new_ids if i in missing]
+    if len(new_ids) == 0:
+        return 0
+
+    # features listed more than once keep the union of their windows
+    merged = {}
+    for i, w in zip(new_ids, new_windows):
+        merged[i] = union_window([merged[i], w]) if i in merged else w
+
+    ids = numpy.array(list(merged), dtype=f"<U{ID_LENGTH}")
+    windows = numpy.array(list(merged.values()), dtype="int32").reshape(-1, 4)
+    if index is not None:
+        ids = numpy.concatenate([numpy.asarray(index["ids"]), ids])
+        windows = numpy.concatenate([numpy.asarray(index["windows"]), windows])
+    order = numpy.argsort(ids, kind="stable")
+
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.mkdir(parents=True, exist_ok=True)
+    numpy.save(tmp / "ids.npy", ids[order])
+    numpy.save(tmp / "windows.npy", windows[order])
+    with open(tmp / "grid.json", "w") as f:
+        json.dump(grid, f)
+
+    # move the previous index aside so that the new one replaces it in a
+    # single rename
+    old = path.with_name(f".{path.name}.{os.getpid()}.old")
+    if path.exists():
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    return len(merged)
+
+
+def subset_window(
+    index_dir: Path,
+    shape_path: Path,
+    ids: List[str],
+    grid_file: Path,
+    attribute: str = "ID",
+) -> Optional[tuple]:
+    """
+    Returns the grid window that covers the features ids of a shapefile.
+    Ids that are not in the index yet are added to it first, reading the grid
+    definition from grid_file.
+
+    Returns
+    -------
+    tuple
+        (imin, imax, jmin, jmax), or None if none of the ids could be found.
+    """
+    index = load_index(index_dir, attribute)
+    windows, missing = lookup(index, ids) if index is not None else ([], ids)
+    if len(missing) > 0 and index is None and not Path(grid_file).exists():
+        raise FileNotFoundError(
+            f"There is no index in {index_dir} and the grid file {grid_file} "
+            "needed to build it does not exist, prebuild the index with "
+            "index.py or pass the grid file"
+        )
+    if len(missing) > 0:
+        logging.info(f"Adding {len(missing)} feature(s) to the index in {index_dir}")
+        grid = index["grid"] if index is not None else read_grid(grid_file)
+        update_index(index_dir, shape_path, grid, attribute)
+        windows, missing = lookup(load_index(index_dir, attribute), ids)
+        if len(missing) > 0:
+            logging.warning(f"Features {missing} are not in {shape_path}")
+    if len(windows) == 0:
+        return None
+    return union_window(windows)
+
+
+def main(
+    shape_path: Path = typer.Argument(
+        ..., help="Shapefile of the features to index, e.g. every HUC"
+    ),
+    grid_file: Path = typer.Argument(
+        ..., help="GeoTIFF on the CONUS grid, e.g. the domain mask"
+    ),
+    index_dir: Path = typer.Argument(
+        ..., help="Directory of the index, mounted at /srv/index in the container"
+    ),
+    attribute: str = typer.Option("ID", help="Attribute that identifies the features"),
+):
+    """
+    Builds or extends the index from every feature of a shapefile.
+    """
+    added = update_index(index_dir, shape_path, read_grid(grid_file), attribute)
+    print(f"Added {added} feature(s) to {index_path(index_dir, attribute)}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+"""
+Windowed reads of ParFlow binary (PFB) files.
+
+A PFB file is a 64 byte header followed by the subgrids the domain was split
+into when it was written, each a 36 byte header and its values:
+
+    header     x0, y0, z0 (>f8), nx, ny, nz (>i4), dx, dy, dz (>f8),
+               number of subgrids (>i4)
+    subgrid    ix, iy, iz, nx, ny, nz, rx, ry, rz (>i4), then nz * ny * nx
+               values (>f8) with i varying fastest
+
+The subgrids tile the domain on a P x Q x R process grid in x, then y, then
+z order, and ParFlow gives the first nx % P subgrids along x one more cell
+than the others (likewise in y and z). The offset of every subgrid can
+therefore be computed from the file header and the header of the first
+subgrid, and a window of the domain is read with one byte range per subgrid
+layer it touches: through a memory map for local files and ranged GETs for
+object storage.
+"""
+
+import os
+import mmap
+import itertools
+from typing import List, Optional, Tuple
+
+import numpy
+import fsspec
+
+HEADER = numpy.dtype(
+    [
+        ("x0", ">f8"),
+        ("y0", ">f8"),
+        ("z0", ">f8"),
+        ("nx", ">i4"),
+        ("ny", ">i4"),
+        ("nz", ">i4"),
+        ("dx", ">f8"),
+        ("dy", ">f8"),
+        ("dz", ">f8"),
+        ("num_subgrids", ">i4"),
+    ]
+)
+SUBGRID_HEADER = numpy.dtype(
+    [(k, ">i4") for k in ("ix", "iy", "iz", "nx", "ny", "nz", "rx", "ry", "rz")]
+)
+VALUE = numpy.dtype(">f8")
+
+# byte ranges separated by less than this are read as one request
+MERGE_GAP = 64 * 1024
+
+
+def is_local(path: str) -> bool:
+    """whether path is on the local filesystem rather than object storage"""
+    return fsspec.core.split_protocol(str(path))[0] in (None, "file")
+
+
+def split_sizes(n: int, parts: int) -> numpy.ndarray:
+    """sizes of the subgrids when n cells are split between parts processes"""
+    sizes = numpy.full(parts, n // parts, dtype="int64")
+    sizes[: n % parts] += 1
+    return sizes
+
+
+class ByteReader:
+    """
+    Reads byte ranges of a local file through a memory map, or of a remote
+    file with ranged GETs, counting the bytes requested.
+    """
+
+    def __init__(self, path: str, storage_options: Optional[dict] = None):
+        self.path = str(path)
+        self.bytes_read = 0
+        if is_local(self.path):
+            self.fs = None
+            with open(fsspec.core.strip_protocol(self.path), "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = len(self.mm)
+        else:
+            self.fs, self.fspath = fsspec.core.url_to_fs(
+                self.path, **(storage_options or {})
+            )
+            self.size = self.fs.size(self.fspath)
+
+    def read(self, start: int, end: int) -> bytes:
+        return self.read_ranges([(start, end)])[0]
+
+    def read_ranges(self, ranges: List[Tuple[int, int]]) -> List[bytes]:
+        """reads (start, end) ranges, remote ranges are requested concurrently"""
+        self.bytes_read += sum(end - start for start, end in ranges)
+        if self.fs is None:
+            return [self.mm[start:end] for start, end in ranges]
+        starts, ends = zip(*ranges)
+        n = len(ranges)
+        return self.fs.cat_ranges([self.fspath] * n, list(starts), list(ends))
+
+    def close(self):
+        if self.fs is None:
+            self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def read_layout(reader: ByteReader) -> dict:
+    """
+    Reads the file header and works out the position of every subgrid.
+
+    Returns
+    -------
+    dict
+        the file header, the subgrid counts (p, q, r), the first cell of each
+        subgrid along x, y and z, and the offset of the values of every
+        subgrid indexed as [r, q, p].
+    """
+    head = reader.read(0, HEADER.itemsize + SUBGRID_HEADER.itemsize)
+    header = {
+        k: v.item() for k, v in zip(HEADER.names, numpy.frombuffer(head, HEADER, 1)[0])
+    }
+    first = numpy.frombuffer(head, SUBGRID_HEADER, 1, HEADER.itemsize)[0]
+    nx, ny, nz = header["nx"], header["ny"], header["nz"]
+    n = header["num_subgrids"]
+
+    # every split of the subgrids into p * q * r whose first subgrid matches
+    # the one in the file, almost always exactly one
+    candidates = []
+    for p in range(1, n + 1):
+        if n % p != 0:
+            continue
+        for q in range(1, n // p + 1):
+            if (n // p) % q != 0:
+                continue
+            r = n // (p * q)
+            if (
+                p <= nx and q <= ny and r <= nz
+                and split_sizes(nx, p)[0] == first["nx"]
+                and split_sizes(ny, q)[0] == first["ny"]
+                and split_sizes(nz, r)[0] == first["nz"]
+            ):
+                candidates.append((p, q, r))
+
+    for p, q, r in candidates:
+        layout = subgrid_layout(header, p, q, r)
+        # the file size and the header of the last subgrid confirm the split
+        end = layout["offsets"][-1, -1, -1]
+        if reader.size != end + layout["sizes"][-1, -1, -1] * VALUE.itemsize:
+            continue
+        last = numpy.frombuffer(
+            reader.read(end - SUBGRID_HEADER.itemsize, end), SUBGRID_HEADER, 1
+        )[0]
+        expected = (
+            layout["x"][-1], layout["y"][-1], layout["z"][-1],
+            layout["sx"][-1], layout["sy"][-1], layout["sz"][-1],
+        )
+        if tuple(int(v) for v in list(last)[:6]) == tuple(int(v) for v in expected):
+            return layout
+    raise ValueError(f"Could not work out the subgrid layout of {reader.path}")
+
+
+def subgrid_layout(header: dict, p: int, q: int, r: int) -> dict:
+    """
+    Computes the first cell and the offset of the values of every subgrid
+    for a p x q x r split of the domain.
+    """
+    sx = split_sizes(header["nx"], p)
+    sy = split_sizes(header["ny"], q)
+    sz = split_sizes(header["nz"], r)
+
+    # number of values of each subgrid in file order, z then y then x
+    sizes = sz[:, None, None] * sy[None, :, None] * sx[None, None, :]
+    before = numpy.concatenate([[0], numpy.cumsum(sizes.ravel())[:-1]])
+    index = numpy.arange(p * q * r)
+    offsets = (
+        HEADER.itemsize
+        + (index + 1) * SUBGRID_HEADER.itemsize
+        + before * VALUE.itemsize
+    ).reshape(r, q, p)
+
+    return {
+        "header": header,
+        "p": p,
+        "q": q,
+        "r": r,
+        "x": numpy.concatenate([[0], numpy.cumsum(sx)[:-1]]),
+        "y": numpy.concatenate([[0], numpy.cumsum(sy)[:-1]]),
+        "z": numpy.concatenate([[0], numpy.cumsum(sz)[:-1]]),
+        "sx": sx,
+        "sy": sy,
+        "sz": sz,
+        "sizes": sizes,
+        "offsets": offsets,
+    }
+
+
+def overlaps(starts: numpy.ndarray, sizes: numpy.ndarray, lo: int, hi: int):
+    """subgrids along one axis that overlap the cells lo:hi"""
+    return [
+        i for i in range(len(starts)) if starts[i] < hi and starts[i] + sizes[i] > lo
+    ]
+
+
+def merge_ranges(ranges: List[Tuple[int, int]], gap: int = MERGE_GAP):
+    """merges sorted byte ranges that are less than gap bytes apart"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] < gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(m) for m in merged]
+
+
+def read_window(
+    path: str,
+    window: Tuple[int, int, int, int],
+    zwindow: Optional[Tuple[int, int]] = None,
+    storage_options: Optional[dict] = None,
+) -> Tuple[numpy.ndarray, dict]:
+    """
+    Reads a window of a PFB file, fetching only the rows of the subgrids
+    that overlap it.
+
+    Parameters
+    ----------
+    path: str
+        local path or object storage url of the PFB file.
+    window: tuple
+        (imin, imax, jmin, jmax) cells to read, upper bounds exclusive, as
+        stored in the subset index.
+    zwindow: tuple
+        (kmin, kmax) layers to read, every layer by default.
+    storage_options: dict
+        fsspec options for object storage.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, dict]
+        the values with shape (nz, ny, nx) of the window, and the file
+        header along with the bytes that were read.
+    """
+    imin, imax, jmin, jmax = window
+    with ByteReader(path, storage_options) as reader:
+        layout = read_layout(reader)
+        header = layout["header"]
+        kmin, kmax = zwindow if zwindow is not None else (0, header["nz"])
+        if not (
+            0 <= imin < imax <= header["nx"]
+            and 0 <= jmin < jmax <= header["ny"]
+            and 0 <= kmin < kmax <= header["nz"]
+        ):
+            raise ValueError(f"Window {window} {zwindow} is outside of {path}")
+
+        # one range per subgrid layer, from the first to the last needed
+        # value of the rows that overlap the window
+        pieces = []
+        for r, q, p in itertools.product(
+            overlaps(layout["z"], layout["sz"], kmin, kmax),
+            overlaps(layout["y"], layout["sy"], jmin, jmax),
+            overlaps(layout["x"], layout["sx"], imin, imax),
+        ):
+            x0, y0, z0 = layout["x"][p], layout["y"][q], layout["z"][r]
+            snx, sny = layout["sx"][p], layout["sy"][q]
+            i0, i1 = max(imin, x0), min(imax, x0 + snx)
+            j0, j1 = max(jmin, y0), min(jmax, y0 + sny)
+            for k in range(max(kmin, z0), min(kmax, z0 + layout["sz"][r])):
+                first = ((k - z0) * sny + (j0 - y0)) * snx + (i0 - x0)
+                last = ((k - z0) * sny + (j1 - 1 - y0)) * snx + (i1 - x0)
+                start = int(layout["offsets"][r, q, p] + first * VALUE.itemsize)
+                end = int(layout["offsets"][r, q, p] + last * VALUE.itemsize)
+                pieces.append((start, end, k, j0, j1, i0, i1, snx))
+
+        ranges = merge_ranges([(start, end) for start, end, *_ in pieces])
+        blocks = reader.read_ranges(ranges)
+
+        out = numpy.empty((kmax - kmin, jmax - jmin, imax - imin), dtype="float64")
+        b = 0
+        for start, end, k, j0, j1, i0, i1, snx in sorted(pieces):
+            while ranges[b][1] < end:
+                b += 1
+            pos = start - ranges[b][0]
+            n = (j1 - j0 - 1) * snx + (i1 - i0)
+            values = numpy.frombuffer(blocks[b], VALUE, n, pos)
+            # pad the last row so the values fold into whole subgrid rows
+            rows = numpy.concatenate(
+                [values, numpy.empty(snx - (i1 - i0), VALUE)]
+            ).reshape(j1 - j0, snx)[:, : i1 - i0]
+            out[k - kmin, j0 - jmin : j1 - jmin, i0 - imin : i1 - imin] = rows
+
+        info = dict(header, bytes_read=reader.bytes_read)
+    return out, info
+
+
+def write_pfb(
+    path: str,
+    data: numpy.ndarray,
+    origin: Tuple[float, float, float] = (0.0, 0.0, 0.0),
+    spacing: Tuple[float, float, float] = (1.0, 1.0, 1.0),
+    p: int = 1,
+    q: int = 1,
+    r: int = 1,
+) -> None:
+    """
+    Writes values with shape (nz, ny, nx) to a PFB file split into p x q x r
+    subgrids. The file is written to a temporary name and renamed into place.
+    """
+    nz, ny, nx = data.shape
+    header = numpy.array([(*origin, nx, ny, nz, *spacing, p * q * r)], dtype=HEADER)
+    layout = subgrid_layout({"nx": nx, "ny": ny, "nz": nz}, p, q, r)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(header.tobytes())
+        for k, j, i in itertools.product(range(r), range(q), range(p)):
+            x0, y0, z0 = layout["x"][i], layout["y"][j], layout["z"][k]
+            sx, sy, sz = layout["sx"][i], layout["sy"][j], layout["sz"][k]
+            sub = numpy.array([(x0, y0, z0, sx, sy, sz, 0, 0, 0)], dtype=SUBGRID_HEADER)
+            f.write(sub.tobytes())
+            block = data[z0 : z0 + sz, y0 : y0 + sy, x0 : x0 + sx]
+            f.write(numpy.ascontiguousarray(block, dtype=VALUE).tobytes())
+    os.replace(tmp, path)
+
+
+def clip_pfb(
+    src: str,
+    dest: str,
+    window: Tuple[int, int, int, int],
+    storage_options: Optional[dict] = None,
+) -> int:
+    """
+    Writes the window of a PFB file to a new single subgrid PFB file whose
+    origin is moved to the first cell of the window.
+
+    Returns
+    -------
+    int
+        the number of bytes read from src.
+    """
+    data, info = read_window(src, window, storage_options=storage_options)
+    imin, _, jmin, _ = window
+    origin = (
+        info["x0"] + imin * info["dx"],
+        info["y0"] + jmin * info["dy"],
+        info["z0"],
+    )
+    write_pfb(dest, data, origin, (info["dx"], info["dy"], info["dz"]))
+    return info["bytes_read"]
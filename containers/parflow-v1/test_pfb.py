@@ -0,0 +1,127 @@
+import sys
+import itertools
+from pathlib import Path
+
+import numpy
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import pfb  # noqa: E402
+
+# domains that do not divide evenly between the subgrids, so that the first
+# subgrids along each axis are one cell larger than the rest
+SHAPE = (5, 17, 23)
+LAYOUTS = [(1, 1, 1), (4, 3, 2), (5, 2, 1), (2, 7, 3), (23, 1, 1)]
+
+
+def domain(shape=SHAPE):
+    return numpy.arange(numpy.prod(shape), dtype="float64").reshape(shape)
+
+
+@pytest.fixture(params=LAYOUTS, ids=lambda l: "x".join(map(str, l)))
+def pfb_file(request, tmp_path):
+    p, q, r = request.param
+    path = tmp_path / f"domain_{p}_{q}_{r}.pfb"
+    pfb.write_pfb(str(path), domain(), (10.0, 20.0, 0.0), (1000.0, 1000.0, 2.0), p, q, r)
+    return path, (p, q, r)
+
+
+def walk_subgrids(path):
+    """(header, offset of the values) of every subgrid, read sequentially"""
+    data = Path(path).read_bytes()
+    pos = pfb.HEADER.itemsize
+    found = []
+    while pos < len(data):
+        sub = numpy.frombuffer(data, pfb.SUBGRID_HEADER, 1, pos)[0]
+        pos += pfb.SUBGRID_HEADER.itemsize
+        found.append((tuple(int(v) for v in list(sub)[:6]), pos))
+        pos += int(sub["nx"] * sub["ny"] * sub["nz"]) * pfb.VALUE.itemsize
+    return found
+
+
+def test_layout_matches_file(pfb_file):
+    path, (p, q, r) = pfb_file
+    with pfb.ByteReader(str(path)) as reader:
+        layout = pfb.read_layout(reader)
+    assert (layout["p"], layout["q"], layout["r"]) == (p, q, r)
+
+    expected = walk_subgrids(path)
+    computed = [
+        (
+            (
+                int(layout["x"][i]), int(layout["y"][j]), int(layout["z"][k]),
+                int(layout["sx"][i]), int(layout["sy"][j]), int(layout["sz"][k]),
+            ),
+            int(layout["offsets"][k, j, i]),
+        )
+        for k, j, i in itertools.product(range(r), range(q), range(p))
+    ]
+    assert computed == expected
+
+
+@pytest.mark.parametrize(
+    "window, zwindow",
+    [
+        ((0, 23, 0, 17), None),
+        ((0, 1, 0, 1), None),
+        ((22, 23, 16, 17), None),
+        ((5, 6, 5, 6), (2, 3)),
+        ((3, 19, 4, 13), None),
+        ((5, 12, 0, 17), (1, 4)),
+        ((0, 23, 6, 7), (4, 5)),
+    ],
+)
+def test_read_window(pfb_file, window, zwindow):
+    path, _ = pfb_file
+    imin, imax, jmin, jmax = window
+    kmin, kmax = zwindow or (0, SHAPE[0])
+    data, _ = pfb.read_window(str(path), window, zwindow)
+    numpy.testing.assert_array_equal(
+        data, domain()[kmin:kmax, jmin:jmax, imin:imax]
+    )
+
+
+def test_read_random_windows(pfb_file):
+    path, _ = pfb_file
+    rng = numpy.random.default_rng(0)
+    nz, ny, nx = SHAPE
+    for _ in range(25):
+        imin, imax = sorted(rng.choice(nx + 1, 2, replace=False))
+        jmin, jmax = sorted(rng.choice(ny + 1, 2, replace=False))
+        kmin, kmax = sorted(rng.choice(nz + 1, 2, replace=False))
+        data, _ = pfb.read_window(
+            str(path), (imin, imax, jmin, jmax), (kmin, kmax)
+        )
+        numpy.testing.assert_array_equal(
+            data, domain()[kmin:kmax, jmin:jmax, imin:imax]
+        )
+
+
+def test_read_window_outside(pfb_file):
+    path, _ = pfb_file
+    with pytest.raises(ValueError):
+        pfb.read_window(str(path), (0, 24, 0, 17))
+    with pytest.raises(ValueError):
+        pfb.read_window(str(path), (3, 3, 0, 17))
+
+
+def test_small_window_reads_little(tmp_path):
+    path = tmp_path / "large.pfb"
+    shape = (2, 200, 300)
+    pfb.write_pfb(str(path), domain(shape), p=3, q=4, r=1)
+    data, info = pfb.read_window(str(path), (140, 160, 90, 110))
+    numpy.testing.assert_array_equal(data, domain(shape)[:, 90:110, 140:160])
+    assert info["bytes_read"] < path.stat().st_size // 10
+
+
+def test_clip_pfb(pfb_file, tmp_path):
+    path, _ = pfb_file
+    dest = tmp_path / "clip.pfb"
+    pfb.clip_pfb(str(path), str(dest), (4, 15, 2, 16))
+
+    data, info = pfb.read_window(str(dest), (0, 11, 0, 14))
+    numpy.testing.assert_array_equal(data, domain()[:, 2:16, 4:15])
+    assert (info["nx"], info["ny"], info["nz"]) == (11, 14, 5)
+    assert (info["x0"], info["y0"], info["z0"]) == (4010.0, 2020.0, 0.0)
+    assert info["num_subgrids"] == 1